@@ -0,0 +1,199 @@
+"""
+File attachments: streaming uploads and downloads.
+
+Uploads never sit in memory: HashingUploadHandler writes each chunk to a
+temporary file and feeds it to a SHA-256 on the way, so Blob.objects.store()
+can recognise content it already has without reading the file again.
+
+Downloads go through `serve_file` after the view's membership check. When
+MESSENGER_ATTACHMENT_OFFLOAD is set the web server sends the bytes
+(X-Accel-Redirect or X-Sendfile); otherwise a FileResponse streams them in
+blocks (asynchronously under ASGI, see app.streaming), answering
+single-range requests with 206 so media can seek and interrupted downloads
+can resume.
+"""
+
+import hashlib
+import io
+import logging
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import StopUpload, TemporaryFileUploadHandler
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, quote_etag
+
+from .models import IMAGE_TYPES, Blob, blob_path
+from .streaming import file_body
+
+logger = logging.getLogger(__name__)
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+UNSATISFIABLE = object()
+
+
+class HashingUploadHandler(TemporaryFileUploadHandler):
+    """Temporary-file upload that also computes the file's SHA-256 (as `file.sha256`)
+
+    Gives up on bodies over MESSENGER_ATTACHMENT_MAX_SIZE as soon as they
+    cross it, setting `too_large`.
+    """
+
+    too_large = False
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.hash = hashlib.sha256()
+        self.received = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > settings.MESSENGER_ATTACHMENT_MAX_SIZE:
+            self.too_large = True
+            self.file.close()
+            # Drain the rest of the body so the client still gets a response
+            raise StopUpload(connection_reset=False)
+        self.hash.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded = super().file_complete(file_size)
+        uploaded.sha256 = self.hash.hexdigest()
+        return uploaded
+
+
+def parse_range(header, size):
+    """The inclusive (start, end) of a single-range `Range` header
+
+    None means send the whole file: no header, or one this doesn't handle
+    (multiple ranges, other units), which RFC 9110 allows ignoring.
+    UNSATISFIABLE means the range lies beyond the end of the file.
+    """
+    match = _RANGE.match(header.strip()) if header else None
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            return UNSATISFIABLE
+        return max(0, size - length), size - 1
+    start = int(first)
+    if start >= size:
+        return UNSATISFIABLE
+    end = min(int(last), size - 1) if last else size - 1
+    if end < start:
+        return None
+    return start, end
+
+
+class _Slice:
+    """Read at most `length` bytes of an open file, from its current position
+
+    No fileno(), so the WSGI file wrapper can't sendfile() past the range.
+    """
+
+    def __init__(self, handle, length):
+        self.handle = handle
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.handle.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.handle.close()
+
+
+def _stream(request, stored, content_type, etag):
+    size = stored.size
+    byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag:
+        # The client's partial copy is of other content; send it all
+        byte_range = None
+
+    if byte_range is UNSATISFIABLE:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    handle = stored.storage.open(stored.name, 'rb')
+    if byte_range is None:
+        response = FileResponse(handle, content_type=content_type)
+    else:
+        start, end = byte_range
+        handle.seek(start)
+        response = FileResponse(_Slice(handle, end - start + 1), status=206, content_type=content_type)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Accept-Ranges'] = 'bytes'
+    if isinstance(request, ASGIRequest):
+        # FileResponse has set the headers; under ASGI its synchronous body would be read whole
+        response.streaming_content = file_body(request, response.file_to_stream)
+    return response
+
+
+def serve_file(request, stored, content_type, filename, etag):
+    """Response for a stored file (a FieldFile) the user may download
+
+    The content behind a given ETag never changes, so the browser may keep it
+    for good and revalidations are answered with 304 without opening the file.
+    """
+    etag = quote_etag(etag)
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        not_modified['ETag'] = etag
+        return not_modified
+
+    inline = content_type in IMAGE_TYPES
+    if not inline:
+        content_type = 'application/octet-stream'
+
+    offload = settings.MESSENGER_ATTACHMENT_OFFLOAD
+    if offload == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.MESSENGER_ATTACHMENT_ACCEL_PREFIX.rstrip('/') + '/' + quote(stored.name)
+    elif offload == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = stored.path
+    else:
+        response = _stream(request, stored, content_type, etag)
+        if response.status_code == 416:
+            return response
+
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    response['Content-Disposition'] = content_disposition_header(not inline, filename)
+    return response
+
+
+def make_thumbnail(blob):
+    """Store a JPEG thumbnail of an image blob; skipped without Pillow"""
+    try:
+        from PIL import Image
+    except ImportError:
+        logger.info('Pillow is not installed, no thumbnail for blob %s', blob.id)
+        return
+
+    size = settings.MESSENGER_THUMBNAIL_SIZE
+    output = io.BytesIO()
+    try:
+        with blob.file.open('rb') as source, Image.open(source) as image:
+            image.thumbnail((size, size))
+            image.convert('RGB').save(output, 'JPEG', quality=85)
+    except (OSError, Image.DecompressionBombError):
+        # Not a readable image after all; clients fall back to the original
+        logger.warning('Could not make a thumbnail for blob %s', blob.id, exc_info=True)
+        return
+    name = default_storage.save(blob_path(blob.sha256, '.thumb.jpg'), ContentFile(output.getvalue()))
+    Blob.objects.filter(id=blob.id).update(thumbnail=name)
@@ -0,0 +1,264 @@
+"""
+Synthetic-data benchmark for the chat views.
+
+`seed_dataset` fills the database with bulk inserts: users with profiles,
+mutual contacts and messages whose per-conversation counts follow a
+heavy-tailed (Pareto) distribution, so a few conversations are far larger
+than the rest as in real use. `run_benchmark` then drives the views through
+the Django test client and reports latency percentiles, SQL query counts
+and peak Python memory for each scenario.
+
+Both the `benchmark` management command and the budget tests in app.tests
+use this module; QUERY_BUDGETS and LATENCY_BUDGETS are the limits a
+regression must not exceed. The tests only assert the query budgets, which
+are deterministic; latency depends on the machine and is checked by
+`benchmark --fail-on-budget`.
+"""
+
+import io
+import math
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import ExitStack
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from .caching import bump_conversation_version, bump_inbox_versions
+from .models import Contact, Message, UserProfile, conversation_key
+from .routers import message_db_for_key
+
+# Most queries a single request of each scenario may run, summed over every
+# configured database (message shards included, savepoints too).
+# Lower these when a change saves queries; raising one needs a reason.
+QUERY_BUDGETS = {
+    'chat': 3,
+    'chat_uncached': 5,
+    'chat_send': 8,
+    'send_api': 8,
+    'send_api_queued': 6,
+    'add_contact': 12,
+    'chat_sidebar': 0,
+    'chat_conversation': 3,
+    'unread_badge': 2,
+    'messages_latest': 3,
+    'messages_recent': 1,
+    'messages_older': 4,
+    'messages_poll': 4,
+    'messages_cached': 0,
+    'messages_not_modified': 0,
+}
+
+# p99 latency budget per scenario, in milliseconds. Generous on purpose: they
+# catch accidental O(n) work on the seeded data, not machine-to-machine noise.
+LATENCY_BUDGETS = {
+    'chat': 250,
+    'chat_uncached': 250,
+    'chat_send': 250,
+    'send_api': 150,
+    'send_api_queued': 150,
+    'add_contact': 150,
+    'chat_sidebar': 50,
+    'chat_conversation': 250,
+    'unread_badge': 50,
+    'messages_latest': 150,
+    'messages_recent': 150,
+    'messages_older': 150,
+    'messages_poll': 150,
+    'messages_cached': 50,
+    'messages_not_modified': 50,
+}
+
+# Pareto shape for conversation sizes; lower means a heavier tail
+CONVERSATION_SIZE_ALPHA = 1.5
+BATCH_SIZE = 2000
+WORDS = ['lunch', 'the meeting', 'deploy', 'weekend', 'tickets', 'the report', 'coffee', 'flights', 'invoices']
+
+
+class Dataset:
+    """Ids of the seeded rows that the scenarios need"""
+
+    def __init__(self, user_ids, conversations):
+        self.user_ids = user_ids
+        # {(user_id, peer_id): message count}, largest first
+        self.conversations = conversations
+
+    @property
+    def largest(self):
+        return next(iter(self.conversations))
+
+
+def _conversation_sizes(rng, count, mean):
+    # Pareto samples have mean alpha / (alpha - 1); rescale to the requested mean
+    scale = mean * (CONVERSATION_SIZE_ALPHA - 1) / CONVERSATION_SIZE_ALPHA
+    return [max(1, int(scale * rng.paretovariate(CONVERSATION_SIZE_ALPHA))) for _ in range(count)]
+
+
+def seed_dataset(users=100, contacts_per_user=8, messages_per_conversation=40, seed=0, prefix='bench'):
+    """Bulk-insert a synthetic dataset and return a Dataset describing it
+
+    bulk_create skips save() and signals, so profiles, conversation keys and
+    the inbox summaries are filled in here explicitly.
+    """
+    rng = random.Random(seed)
+    password = make_password('benchmark')
+
+    created = User.objects.bulk_create(
+        [User(username=f'{prefix}{i}', password=password) for i in range(users)], batch_size=BATCH_SIZE
+    )
+    user_ids = [user.id for user in created]
+    if None in user_ids:
+        # Backends without RETURNING from bulk inserts
+        user_ids = list(User.objects.filter(username__startswith=prefix).order_by('id').values_list('id', flat=True))
+    UserProfile.objects.bulk_create(
+        [UserProfile(user_id=user_id, nickname=f'{prefix.title()} {user_id}',
+                     nickname_normalized=f'{prefix} {user_id}') for user_id in user_ids],
+        batch_size=BATCH_SIZE,
+    )
+
+    pairs = set()
+    for user_id in user_ids:
+        for peer_id in rng.sample(user_ids, min(contacts_per_user, len(user_ids) - 1) + 1):
+            if peer_id != user_id:
+                pairs.add((min(user_id, peer_id), max(user_id, peer_id)))
+    pairs = sorted(pairs)
+    Contact.objects.bulk_create(
+        [Contact(user_id=a, contact_user_id=b) for a, b in pairs]
+        + [Contact(user_id=b, contact_user_id=a) for a, b in pairs],
+        batch_size=BATCH_SIZE, ignore_conflicts=True,
+    )
+
+    sizes = _conversation_sizes(rng, len(pairs), messages_per_conversation)
+    # One pending batch per database when messages are sharded
+    batches = defaultdict(list)
+    for (a, b), size in zip(pairs, sizes):
+        key = conversation_key(a, b)
+        alias = message_db_for_key(key) or 'default'
+        for i in range(size):
+            sender, receiver = (a, b) if rng.random() < 0.5 else (b, a)
+            batches[alias].append(Message(sender_id=sender, receiver_id=receiver, conversation_key=key,
+                                          content=f'Message {i} about {rng.choice(WORDS)} and {rng.choice(WORDS)}'))
+            if len(batches[alias]) >= BATCH_SIZE:
+                Message.objects.using(alias).bulk_create(batches.pop(alias))
+    for alias, batch in batches.items():
+        Message.objects.using(alias).bulk_create(batch)
+
+    call_command('rebuild_conversation_summaries', stdout=io.StringIO())
+
+    conversations = dict(sorted(zip(pairs, sizes), key=lambda item: item[1], reverse=True))
+    return Dataset(user_ids, conversations)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _scenarios(client, dataset, rng):
+    """Scenario name -> (prepare, request) callables, for the largest conversation's owner
+
+    `prepare` (untimed, may be None) runs before every measured `request`.
+    """
+    user_id, peer_id = dataset.largest
+    key = conversation_key(user_id, peer_id)
+    latest = client.get('/api/messages/', {'contact_id': peer_id}).json()
+    oldest_shown = latest['messages'][0]['id'] if latest['messages'] else 1
+    etag = client.get('/api/messages/', {'contact_id': peer_id})['ETag']
+
+    def invalidate():
+        # A new version makes both the response cache and the recent-messages cache miss
+        bump_conversation_version(key)
+
+    def send_queued():
+        # Side effects left to the worker: the request only stores the message and its jobs
+        with override_settings(MESSENGER_TASKS_EAGER=False):
+            return client.post('/api/messages/send/', {'contact_id': peer_id, 'content': 'Benchmark message'})
+
+    def invalidate_responses():
+        # ...then chat() refills the recent-messages cache, leaving only the response cache cold
+        invalidate()
+        client.get('/chat/', {'contact_id': peer_id})
+
+    return {
+        'chat': (None, lambda: client.get('/chat/', {'contact_id': peer_id})),
+        'chat_uncached': (invalidate, lambda: client.get('/chat/', {'contact_id': peer_id})),
+        'chat_send': (None, lambda: client.post(f'/chat/?contact_id={peer_id}', {'content': 'Benchmark message'})),
+        'send_api': (None, lambda: client.post(
+            '/api/messages/send/', {'contact_id': peer_id, 'content': 'Benchmark message'})),
+        'send_api_queued': (None, send_queued),
+        'add_contact': (None, lambda: client.post('/add-contact/', {'contact_user': rng.choice(dataset.user_ids)})),
+        'chat_sidebar': (None, lambda: client.get('/chat/sidebar/', {'contact_id': peer_id})),
+        'chat_conversation': (None, lambda: client.get('/chat/conversation/', {'contact_id': peer_id})),
+        'unread_badge': (lambda: bump_inbox_versions(user_id), lambda: client.get('/api/unread/')),
+        'messages_latest': (invalidate, lambda: client.get('/api/messages/', {'contact_id': peer_id})),
+        'messages_recent': (invalidate_responses, lambda: client.get('/api/messages/', {'contact_id': peer_id})),
+        'messages_older': (invalidate, lambda: client.get(
+            '/api/messages/', {'contact_id': peer_id, 'before_id': oldest_shown})),
+        'messages_poll': (invalidate, lambda: client.get(
+            '/api/messages/', {'contact_id': peer_id, 'cursor': latest['cursor']})),
+        'messages_cached': (None, lambda: client.get(
+            '/api/messages/', {'contact_id': peer_id, 'cursor': latest['cursor']})),
+        'messages_not_modified': (None, lambda: client.get(
+            '/api/messages/', {'contact_id': peer_id}, HTTP_IF_NONE_MATCH=etag)),
+    }
+
+
+def run_benchmark(dataset, iterations=20, seed=0):
+    """Drive every scenario `iterations` times; returns {scenario: stats}"""
+    rng = random.Random(seed)
+    client = Client()
+    client.force_login(User.objects.get(id=dataset.largest[0]))
+
+    results = {}
+    for name, (prepare, request) in _scenarios(client, dataset, rng).items():
+        prepare = prepare or (lambda: None)
+        # Warm-up request, also checks the scenario works at all
+        prepare()
+        response = request()
+        if response.status_code >= 400:
+            raise RuntimeError(f'{name} returned HTTP {response.status_code}')
+
+        timings, query_counts = [], []
+        for _ in range(iterations):
+            prepare()
+            with ExitStack() as stack:
+                captured = [stack.enter_context(CaptureQueriesContext(conn)) for conn in connections.all()]
+                started = time.perf_counter()
+                request()
+                timings.append((time.perf_counter() - started) * 1000)
+            query_counts.append(sum(len(queries) for queries in captured))
+
+        # Separate pass: tracemalloc slows allocation-heavy code and would skew the timings
+        prepare()
+        tracemalloc.start()
+        try:
+            request()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        results[name] = {
+            'p50_ms': percentile(timings, 0.5),
+            'p99_ms': percentile(timings, 0.99),
+            'queries': max(query_counts),
+            'peak_kb': peak / 1024,
+        }
+    return results
+
+
+def budget_violations(results):
+    """Human-readable list of every budget the results exceed"""
+    violations = []
+    for name, stats in results.items():
+        if stats['queries'] > QUERY_BUDGETS[name]:
+            violations.append(f"{name}: {stats['queries']} queries (budget {QUERY_BUDGETS[name]})")
+        if stats['p99_ms'] > LATENCY_BUDGETS[name]:
+            violations.append(f"{name}: p99 {stats['p99_ms']:.1f} ms (budget {LATENCY_BUDGETS[name]} ms)")
+    return violations
@@ -0,0 +1,276 @@
+"""
+Cache helpers for conversation reads.
+
+Every conversation has a version number in the Django cache that is bumped
+whenever something visible in it changes (a message is sent, a read or
+delivery watermark moves). Responses derived from a conversation are cached and
+ETagged under that version, so a write makes all of them stale at once
+without having to find and delete each variant. Each user's inbox has a
+version of its own, bumped whenever one of their summary rows changes, for
+the cached chat sidebar.
+
+The recent-messages cache keeps the newest page of busy conversations. It
+is written through on send and on read (see the signals and managers in
+app.models) and stamped with the version it reflects, so an entry that
+missed a write, from another process or a race, is ignored rather than
+served.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+
+def _current_version(version_key):
+    version = cache.get(version_key)
+    if version is None:
+        # A fresh clock-based start can't collide with a value issued before eviction
+        version = time.time_ns()
+        if not cache.add(version_key, version, None):
+            version = cache.get(version_key, version)
+    return version
+
+
+def _bump_version(version_key):
+    try:
+        return cache.incr(version_key)
+    except ValueError:
+        # Not cached (evicted or never read): any new value invalidates old entries
+        version = time.time_ns()
+        cache.set(version_key, version, None)
+        return version
+
+
+async def _acurrent_version(version_key):
+    version = await cache.aget(version_key)
+    if version is None:
+        version = time.time_ns()
+        if not await cache.aadd(version_key, version, None):
+            version = await cache.aget(version_key, version)
+    return version
+
+
+def conversation_version(key):
+    """Current version of a conversation, starting one if none is cached"""
+    return _current_version(f'conversation-version:{key}')
+
+
+async def aconversation_version(key):
+    return await _acurrent_version(f'conversation-version:{key}')
+
+
+def bump_conversation_version(key):
+    """Invalidate everything cached for a conversation; returns the new version"""
+    return _bump_version(f'conversation-version:{key}')
+
+
+def inbox_version(user_id):
+    """Current version of a user's inbox (their ConversationSummary rows)"""
+    return _current_version(f'inbox-version:{user_id}')
+
+
+async def ainbox_version(user_id):
+    return await _acurrent_version(f'inbox-version:{user_id}')
+
+
+def bump_inbox_versions(*user_ids):
+    """Invalidate the cached sidebars of these users"""
+    for user_id in user_ids:
+        _bump_version(f'inbox-version:{user_id}')
+
+
+# What the recent-messages cache keeps per message: enough to rebuild a
+# Message for templates and serialize_message without touching the database
+MessageRecord = namedtuple('MessageRecord', [
+    'id', 'sender_id', 'receiver_id', 'sender_nickname', 'content', 'timestamp', 'updated_at', 'attachment',
+], defaults=(None,))
+
+# How far one participant has read and received a conversation, as cached
+# with its newest page; `delivered` is never behind `read`
+Watermark = namedtuple('Watermark', ['read', 'delivered'])
+NO_WATERMARK = Watermark(0, 0)
+
+# Rough per-record cost beyond the content itself (tuple, ints, datetimes)
+RECORD_OVERHEAD = 400
+
+
+class RecentEntry:
+    """Newest page of one conversation as of `version`"""
+
+    __slots__ = ('version', 'records', 'has_more', 'watermarks', 'stored_at', 'size')
+
+    def __init__(self, version, records, has_more, watermarks, stored_at=None):
+        self.version = version
+        self.records = tuple(records)
+        self.has_more = has_more
+        self.watermarks = dict(watermarks)  # {user_id: Watermark}
+        self.stored_at = stored_at or time.time()
+        self.size = sum(len(record.content.encode()) + RECORD_OVERHEAD for record in self.records)
+
+    def replace(self, version, **changes):
+        fields = {
+            'records': self.records, 'has_more': self.has_more, 'watermarks': self.watermarks,
+            'stored_at': self.stored_at, **changes,
+        }
+        return RecentEntry(version, **fields)
+
+
+class RecentMessagesCache:
+    """Write-through cache of the newest MESSENGER_PAGE_SIZE messages per conversation
+
+    Subclasses provide storage (`_load`, `_store`, `_delete`). Entries are
+    immutable: writers replace them, so readers never see a half-applied
+    change. Hit/miss counters are per process.
+    """
+
+    def __init__(self):
+        self.ttl = settings.MESSENGER_RECENT_MESSAGES_TTL
+        self.limit = settings.MESSENGER_PAGE_SIZE
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """The entry for `key` if it reflects the conversation's current version"""
+        entry = self._load(key)
+        if (entry is None or entry.version != conversation_version(key)
+                or time.time() - entry.stored_at > self.ttl):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def fill(self, key, version, records, has_more, watermarks):
+        """Store the page read from the database; `version` must be read before the query"""
+        self._store(key, RecentEntry(version, records, has_more, watermarks))
+
+    def _write_through(self, key, version, change):
+        # Only an entry exactly one version behind saw every earlier write
+        entry = self._load(key)
+        if entry is None:
+            return
+        if entry.version != version - 1:
+            self._delete(key)
+            return
+        self._store(key, change(entry))
+
+    def message_added(self, key, version, make_record):
+        def change(entry):
+            records = entry.records + (make_record(),)
+            return entry.replace(
+                version, records=records[-self.limit:], has_more=entry.has_more or len(records) > self.limit,
+            )
+        self._write_through(key, version, change)
+
+    def watermark_moved(self, key, version, user_id, read=0, delivered=0):
+        def change(entry):
+            previous = entry.watermarks.get(user_id, NO_WATERMARK)
+            moved = Watermark(max(previous.read, read), max(previous.delivered, delivered, read))
+            return entry.replace(version, watermarks={**entry.watermarks, user_id: moved})
+        self._write_through(key, version, change)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+            'evictions': self.evictions,
+        }
+
+    def _load(self, key):
+        raise NotImplementedError
+
+    def _store(self, key, entry):
+        raise NotImplementedError
+
+    def _delete(self, key):
+        raise NotImplementedError
+
+
+class LocalRecentMessages(RecentMessagesCache):
+    """Per-process LRU bounded by MESSENGER_RECENT_MESSAGES_MAX_BYTES of message content"""
+
+    def __init__(self):
+        super().__init__()
+        self.max_bytes = settings.MESSENGER_RECENT_MESSAGES_MAX_BYTES
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _store(self, key, entry):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous.size
+            self._entries[key] = entry
+            self.bytes += entry.size
+            while self.bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
+
+    def _delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {**super().stats(), 'entries': len(self._entries), 'bytes': self.bytes,
+                    'max_bytes': self.max_bytes}
+
+
+class DjangoCacheRecentMessages(RecentMessagesCache):
+    """Entries shared between processes through the Django cache
+
+    Eviction is left to the cache server's own memory limit; write-through
+    is read-modify-write, and a lost race only costs a miss because the
+    version check rejects the older entry.
+    """
+
+    def _cache_key(self, key):
+        # v2: watermarks became Watermark tuples
+        return f'recent-messages:v2:{key}'
+
+    def _load(self, key):
+        return cache.get(self._cache_key(key))
+
+    def _store(self, key, entry):
+        cache.set(self._cache_key(key), entry, self.ttl)
+
+    def _delete(self, key):
+        cache.delete(self._cache_key(key))
+
+
+_recent_messages = None
+_recent_messages_lock = threading.Lock()
+
+
+def get_recent_messages():
+    """Return the process-wide cache configured by MESSENGER_RECENT_MESSAGES_CACHE"""
+    global _recent_messages
+    if _recent_messages is None:
+        with _recent_messages_lock:
+            if _recent_messages is None:
+                cache_path = getattr(settings, 'MESSENGER_RECENT_MESSAGES_CACHE', 'app.caching.LocalRecentMessages')
+                _recent_messages = import_string(cache_path)()
+    return _recent_messages
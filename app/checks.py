@@ -0,0 +1,63 @@
+"""
+System checks for deployment settings the messenger depends on.
+
+Conversation and inbox versions (app.caching) live in the default cache and
+drive the ETags and cached responses of the chat views. With a per-process
+cache, a version bumped by one worker is never seen by the others, which
+keep answering 304 or serving stale pages from their own copy. Production
+(MESSENGER_REQUIRE_SHARED_CACHE) therefore refuses a local-memory cache,
+for those and for cache-backed sessions, and likewise the in-process broker,
+whose /ws/ events never reach sockets held by another worker; `migrate` runs
+these checks, so a deploy without them fails at build time.
+"""
+
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+# Backends whose contents are private to one process
+LOCAL_CACHE_BACKENDS = {'django.core.cache.backends.locmem.LocMemCache'}
+LOCAL_BROKERS = {'app.pubsub.InProcessBroker'}
+CACHED_SESSION_ENGINES = {'django.contrib.sessions.backends.cache', 'django.contrib.sessions.backends.cached_db'}
+
+
+def cache_is_shared(alias='default'):
+    return settings.CACHES[alias]['BACKEND'] not in LOCAL_CACHE_BACKENDS
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    if not settings.MESSENGER_REQUIRE_SHARED_CACHE or cache_is_shared():
+        return []
+    return [Error(
+        'The default cache is local to each process, so cache versions and ETags diverge between workers.',
+        hint='Set REDIS_URL to a Redis server shared by every web and worker process, or '
+             'MESSENGER_REQUIRE_SHARED_CACHE=0 when running a single process.',
+        id='app.E001',
+    )]
+
+
+@register(Tags.caches)
+def check_session_cache(app_configs, **kwargs):
+    """Cache-backed sessions in a per-process cache outlive a logout in another process"""
+    if cache_is_shared(getattr(settings, 'SESSION_CACHE_ALIAS', 'default')):
+        return []
+    if settings.SESSION_ENGINE not in CACHED_SESSION_ENGINES or not settings.MESSENGER_REQUIRE_SHARED_CACHE:
+        return []
+    return [Error(
+        f'{settings.SESSION_ENGINE} keeps sessions in a cache local to each process, '
+        'so a logout or password change in one worker is not seen by the others.',
+        hint="Set REDIS_URL, or MESSENGER_SESSION_PROFILE='db'.",
+        id='app.E002',
+    )]
+
+
+@register()
+def check_shared_broker(app_configs, **kwargs):
+    """An in-process broker misses sockets held by other workers"""
+    if not settings.MESSENGER_REQUIRE_SHARED_CACHE or settings.MESSENGER_BROKER not in LOCAL_BROKERS:
+        return []
+    return [Error(
+        f'{settings.MESSENGER_BROKER} only delivers /ws/ events to sockets of the worker that published them.',
+        hint="Set REDIS_URL, which selects 'app.pubsub.RedisBroker'.",
+        id='app.E003',
+    )]
@@ -0,0 +1,291 @@
+"""
+Streaming export of message history, and the matching bulk import.
+
+Exports walk each conversation in keyset batches on (timestamp, id), the
+order of app_msg_conversation_idx, reading each batch with
+.iterator(chunk_size=...): no query holds a cursor open while a slow client
+downloads, and no result cache grows with the history. Rows are serialized
+as they are read, as NDJSON (what import_records reads back) or CSV, and
+optionally gzip-compressed on the fly, so memory stays flat however large
+the export. The /api/export/ view and the export_messages and
+import_messages commands use this module.
+
+NDJSON lines carry a "type": "message", and "contact" for the contacts of
+a user's export. Users appear by username as well as id, since ids differ
+between deployments.
+"""
+
+import csv
+import json
+import zlib
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Case, Q, Value, When
+from django.utils.dateparse import parse_datetime
+
+from .caching import bump_conversation_version
+from .models import Contact, Conversation, Membership, Message, conversation_key
+from .routers import message_db_for_key
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+CSV_COLUMNS = ['id', 'conversation_key', 'timestamp', 'sender_id', 'sender', 'receiver_id', 'receiver',
+               'content', 'attachment']
+BATCH_SIZE = 1000
+# Text is gathered into blocks of about this size before it is encoded and sent
+BLOCK_SIZE = 64 * 1024
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def user_conversation_keys(user_id):
+    """Keys of every conversation the user takes part in, direct and group"""
+    return list(
+        Membership.objects.filter(user_id=user_id).order_by('conversation_id').values_list('conversation_id', flat=True)
+    )
+
+
+def iter_messages(keys, batch_size):
+    """The messages of conversations `keys`, one conversation after another, each oldest first"""
+    for key in keys:
+        messages = Message.objects.in_conversation(key).only(
+            'id', 'sender_id', 'receiver_id', 'conversation_key', 'content', 'timestamp', 'attachment',
+        ).order_by('timestamp', 'id')
+        after = None
+        while True:
+            page = messages
+            if after is not None:
+                page = page.filter(Q(timestamp__gt=after[0]) | Q(timestamp=after[0], id__gt=after[1]))
+            count = 0
+            for message in page[:batch_size].iterator(chunk_size=batch_size):
+                count += 1
+                after = (message.timestamp, message.id)
+                yield message
+            if count < batch_size:
+                break
+
+
+def message_rows(messages, batch_size):
+    """Export records for messages; usernames are looked up once per batch"""
+    usernames = {}
+    for batch in _batches(messages, batch_size):
+        missing = {
+            user_id for message in batch for user_id in (message.sender_id, message.receiver_id)
+            if user_id is not None and user_id not in usernames
+        }
+        if missing:
+            usernames.update(User.objects.filter(id__in=missing).values_list('id', 'username'))
+        for message in batch:
+            yield {
+                'type': 'message',
+                'id': message.id,
+                'conversation_key': message.conversation_key,
+                'timestamp': message.timestamp.isoformat(),
+                'sender_id': message.sender_id,
+                'sender': usernames.get(message.sender_id),
+                'receiver_id': message.receiver_id,
+                'receiver': usernames.get(message.receiver_id),
+                'content': message.content,
+                'attachment': message.attachment,
+            }
+
+
+def contact_rows(user_id):
+    for contact_user_id, username, created_at in (
+        Contact.objects.filter(user_id=user_id).order_by('id')
+        .values_list('contact_user_id', 'contact_user__username', 'created_at').iterator()
+    ):
+        yield {
+            'type': 'contact',
+            'user_id': user_id,
+            'contact_user_id': contact_user_id,
+            'contact': username,
+            'created_at': created_at.isoformat(),
+        }
+
+
+def export_rows(keys, contacts_of=None, batch_size=BATCH_SIZE):
+    """Records of the conversations `keys`, then the contacts of user `contacts_of` if given"""
+    yield from message_rows(iter_messages(keys, batch_size), batch_size)
+    if contacts_of is not None:
+        for row in contact_rows(contacts_of.id):
+            yield dict(row, user=contacts_of.username)
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + '\n'
+
+
+class _Echo:
+    """File-like object for csv.writer that hands each line back instead of storing it"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    """Message records as CSV; contacts don't fit its columns and are left out"""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for row in rows:
+        if row['type'] != 'message':
+            continue
+        attachment = row['attachment']
+        values = dict(row, attachment=attachment['name'] if attachment else '')
+        yield writer.writerow([values[column] for column in CSV_COLUMNS])
+
+
+def encode(lines, compress=False):
+    """Bytes of `lines` in blocks of about BLOCK_SIZE, gzip-compressed as they go if `compress`"""
+    compressor = zlib.compressobj(wbits=31) if compress else None  # 31: gzip container
+    block, size = [], 0
+    for line in lines:
+        block.append(line)
+        size += len(line)
+        if size < BLOCK_SIZE:
+            continue
+        data = ''.join(block).encode()
+        block, size = [], 0
+        data = compressor.compress(data) if compressor else data
+        if data:
+            yield data
+    data = ''.join(block).encode()
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+def export_stream(rows, format='ndjson', compress=False):
+    lines = csv_lines(rows) if format == 'csv' else ndjson_lines(rows)
+    return encode(lines, compress)
+
+
+def import_records(lines, source, batch_size=BATCH_SIZE):
+    """Bulk-load exported NDJSON lines; returns {'messages', 'contacts', 'skipped'} counts
+
+    Users are matched by username and must already exist. Each message is
+    stored with the idempotency key "<source>:<exported id>", and keys
+    already present are skipped, so an interrupted import can simply be run
+    again. Attachments are not carried over (their files stay behind), and
+    group messages are only imported into groups that already exist here.
+    Inbox rows are left to the caller (see the import_messages command).
+    """
+    counts = {'messages': 0, 'contacts': 0, 'skipped': 0}
+    user_ids = {}
+    group_keys = set()
+    touched_keys = set()
+    for batch in _batches(lines, batch_size):
+        records = [json.loads(line) for line in batch if line.strip()]
+        usernames = {
+            name for record in records
+            for name in (record.get('sender'), record.get('receiver'), record.get('user'), record.get('contact'))
+            if name and name not in user_ids
+        }
+        if usernames:
+            user_ids.update(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+        groups = {
+            record['conversation_key'] for record in records
+            if record['type'] == 'message' and not record.get('receiver') and record['conversation_key'] not in group_keys
+        }
+        if groups:
+            group_keys.update(Conversation.objects.filter(key__in=groups, is_group=True).values_list('key', flat=True))
+
+        messages_by_db, contacts = {}, []
+        for record in records:
+            if record['type'] == 'contact':
+                user_id, contact_id = user_ids.get(record.get('user')), user_ids.get(record.get('contact'))
+                if user_id and contact_id:
+                    contacts.append(Contact(user_id=user_id, contact_user_id=contact_id))
+                else:
+                    counts['skipped'] += 1
+                continue
+
+            message = _imported_message(record, source, user_ids, group_keys)
+            if message is None:
+                counts['skipped'] += 1
+                continue
+            messages_by_db.setdefault(message_db_for_key(message.conversation_key) or 'default', []).append(message)
+
+        for alias, messages in messages_by_db.items():
+            stored = _store_messages(alias, messages)
+            counts['messages'] += len(stored)
+            counts['skipped'] += len(messages) - len(stored)
+            touched_keys.update(message.conversation_key for message in stored)
+        if contacts:
+            stored = _store_contacts(contacts)
+            counts['contacts'] += stored
+            counts['skipped'] += len(contacts) - stored
+
+    for key in touched_keys:
+        bump_conversation_version(key)
+    return counts
+
+
+def _imported_message(record, source, user_ids, group_keys):
+    sender_id = user_ids.get(record.get('sender'))
+    if sender_id is None:
+        return None
+    if record.get('receiver'):
+        receiver_id = user_ids.get(record['receiver'])
+        if receiver_id is None:
+            return None
+        key = conversation_key(sender_id, receiver_id)
+    elif record['conversation_key'] in group_keys:
+        receiver_id, key = None, record['conversation_key']
+    else:
+        return None
+    return Message(
+        sender_id=sender_id, receiver_id=receiver_id, conversation_key=key, content=record['content'],
+        timestamp=parse_datetime(record['timestamp']), idempotency_key=f"{source}:{record['id']}",
+    )
+
+
+def _store_contacts(contacts):
+    """Insert the contacts not present yet; returns how many were inserted"""
+    existing = set(Contact.objects.filter(
+        user_id__in={contact.user_id for contact in contacts},
+        contact_user_id__in={contact.contact_user_id for contact in contacts},
+    ).values_list('user_id', 'contact_user_id'))
+    new = {(contact.user_id, contact.contact_user_id): contact for contact in contacts}
+    new = [contact for pair, contact in new.items() if pair not in existing]
+    # A contact added in the meantime is simply left as it is
+    Contact.objects.bulk_create(new, ignore_conflicts=True)
+    return len(new)
+
+
+def _store_messages(alias, messages):
+    """Insert the messages not imported before; returns those inserted"""
+    existing = set(
+        Message.objects.using(alias).filter(
+            sender_id__in={message.sender_id for message in messages},
+            idempotency_key__in=[message.idempotency_key for message in messages],
+        ).values_list('sender_id', 'idempotency_key')
+    )
+    new = [message for message in messages if (message.sender_id, message.idempotency_key) not in existing]
+    if not new:
+        return []
+
+    timestamps = {message.idempotency_key: message.timestamp for message in new}
+    with transaction.atomic(using=alias):
+        # Bypasses save() and the post_save signal; updated_at becomes now, so syncing clients pick the rows up
+        created = Message.objects.using(alias).bulk_create(new)
+        if None in (message.id for message in created):
+            # Backends without RETURNING from bulk inserts
+            created = list(Message.objects.using(alias).filter(
+                sender_id__in={message.sender_id for message in new}, idempotency_key__in=list(timestamps)
+            ).only('id', 'idempotency_key', 'conversation_key'))
+        # auto_now_add replaced the original send times on insert; restore them in one UPDATE
+        Message.objects.using(alias).filter(id__in=[message.id for message in created]).update(timestamp=Case(
+            *[When(id=message.id, then=Value(timestamps[message.idempotency_key])) for message in created]
+        ))
+    return created
@@ -129,3 +129,11 @@ class ProfileUpdateForm(forms.ModelForm):
                 'class': 'form-control'
             })
         }
+
+    def save(self, commit=True):
+        # The instance may be the cached request.user's profile, so write only
+        # the edited columns rather than every (possibly stale) one
+        profile = super().save(commit=False)
+        if commit:
+            profile.save(update_fields=self._meta.fields)
+        return profile
@@ -0,0 +1,137 @@
+"""
+HTTP load test for comparing server profiles (WSGI workers vs ASGI workers).
+
+Unlike app.benchmark, which drives the views in-process through the test
+client, this talks to running servers over real sockets: `concurrency`
+simulated clients, each a thread with its own keep-alive connection and
+logged-in session, poll /api/messages/ the way the chat page does
+(If-None-Match with the last ETag, then `think_time` seconds of idle) and
+now and then send a message through /api/messages/send/. Every server gets
+the same clients and mix in turn, so the numbers are directly comparable.
+
+The `loadtest` management command uses this module; sessions are created
+straight in the session store, so the servers must share its database (and
+cache, for the cache-backed session profile).
+"""
+
+import http.client
+import random
+import threading
+import time
+from collections import Counter
+from importlib import import_module
+from urllib.parse import urlencode, urlsplit
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.middleware.csrf import CSRF_SECRET_LENGTH
+from django.utils.crypto import get_random_string
+
+from .benchmark import percentile
+from .models import Contact
+
+
+class LoadClient:
+    """A logged-in user and the contact whose conversation it polls"""
+
+    def __init__(self, user, peer_id):
+        self.peer_id = peer_id
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        self.csrf_token = get_random_string(CSRF_SECRET_LENGTH)
+        self.cookie = (f'{settings.SESSION_COOKIE_NAME}={session.session_key}; '
+                       f'{settings.CSRF_COOKIE_NAME}={self.csrf_token}')
+
+
+def load_clients(prefix, count, seed=0):
+    """Up to `count` LoadClients for users named `prefix`* that have contacts"""
+    pairs = list(
+        Contact.objects.filter(user__username__startswith=prefix).order_by('id').values_list('user_id', 'contact_user_id')
+    )
+    random.Random(seed).shuffle(pairs)
+    chosen = {}
+    for user_id, peer_id in pairs:
+        chosen.setdefault(user_id, peer_id)
+        if len(chosen) == count:
+            break
+    users = User.objects.in_bulk(list(chosen))
+    return [LoadClient(users[user_id], peer_id) for user_id, peer_id in chosen.items()]
+
+
+def _worker(base_url, client, deadline, think_time, send_ratio, rng, record):
+    parts = urlsplit(base_url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    connection = connection_class(parts.netloc, timeout=30)
+    headers = {'Cookie': client.cookie, 'Referer': base_url, 'Origin': base_url}
+    poll_path = f"{parts.path.rstrip('/')}/api/messages/?{urlencode({'contact_id': client.peer_id})}"
+    send_path = f"{parts.path.rstrip('/')}/api/messages/send/"
+    etag = None
+    while time.monotonic() < deadline:
+        if rng.random() < send_ratio:
+            kind, method, path = 'send', 'POST', send_path
+            body = urlencode({'contact_id': client.peer_id, 'content': 'Load test message'})
+            request_headers = dict(headers, **{
+                'Content-Type': 'application/x-www-form-urlencoded', 'X-CSRFToken': client.csrf_token,
+            })
+        else:
+            kind, method, path, body = 'poll', 'GET', poll_path, None
+            request_headers = dict(headers, **({'If-None-Match': etag} if etag else {}))
+        started = time.perf_counter()
+        try:
+            connection.request(method, path, body=body, headers=request_headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+            if kind == 'poll' and status == 200:
+                etag = response.getheader('ETag')
+        except (OSError, http.client.HTTPException):
+            status = None
+            connection.close()
+        record(kind, status, (time.perf_counter() - started) * 1000)
+        if think_time:
+            time.sleep(rng.uniform(0, 2 * think_time))
+    connection.close()
+
+
+def run_load(base_url, clients, duration=10, think_time=0.0, send_ratio=0.05, seed=0):
+    """Drive `base_url` with one thread per client for `duration` seconds
+
+    Returns {'requests', 'rps', 'p50_ms', 'p99_ms', 'statuses', 'errors'},
+    where errors counts connection failures and 4xx/5xx responses.
+    """
+    lock = threading.Lock()
+    timings, statuses = [], Counter()
+
+    def record(kind, status, elapsed_ms):
+        with lock:
+            timings.append(elapsed_ms)
+            statuses[f'{kind} {status or "failed"}'] += 1
+
+    deadline = time.monotonic() + duration
+    threads = [
+        threading.Thread(target=_worker, args=(
+            base_url, client, deadline, think_time, send_ratio, random.Random(seed + i), record,
+        ), daemon=True)
+        for i, client in enumerate(clients)
+    ]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    errors = sum(count for key, count in statuses.items()
+                 if key.endswith('failed') or int(key.rsplit(' ', 1)[1]) >= 400)
+    return {
+        'requests': len(timings),
+        'rps': len(timings) / elapsed,
+        'p50_ms': percentile(timings, 0.5) if timings else 0.0,
+        'p99_ms': percentile(timings, 0.99) if timings else 0.0,
+        'statuses': dict(statuses),
+        'errors': errors,
+    }
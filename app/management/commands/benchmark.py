@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from app.benchmark import budget_violations, run_benchmark, seed_dataset
+
+
+class Command(BaseCommand):
+    help = 'Seed a throwaway test database with synthetic data and benchmark the chat views'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--contacts', type=int, default=10, help='Contacts per user')
+        parser.add_argument('--messages', type=int, default=50, help='Mean messages per conversation')
+        parser.add_argument('--iterations', type=int, default=30, help='Requests per scenario')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--fail-on-budget', action='store_true',
+                            help='Exit with an error if any query or latency budget is exceeded')
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError('--users must be at least 2')
+
+        # Never touch the configured database: build and drop a test one
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            dataset = seed_dataset(
+                users=options['users'],
+                contacts_per_user=options['contacts'],
+                messages_per_conversation=options['messages'],
+                seed=options['seed'],
+            )
+            sizes = list(dataset.conversations.values())
+            self.stdout.write(
+                f'Seeded {len(dataset.user_ids)} users, {len(sizes)} conversations, {sum(sizes)} messages '
+                f'(largest conversation: {sizes[0]})'
+            )
+            results = run_benchmark(dataset, iterations=options['iterations'], seed=options['seed'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(f"{'scenario':<24}{'p50 ms':>9}{'p99 ms':>9}{'queries':>9}{'peak KiB':>10}")
+        for name, stats in results.items():
+            self.stdout.write(
+                f"{name:<24}{stats['p50_ms']:>9.1f}{stats['p99_ms']:>9.1f}{stats['queries']:>9}{stats['peak_kb']:>10.0f}"
+            )
+
+        violations = budget_violations(results)
+        for violation in violations:
+            self.stdout.write(self.style.WARNING(f'Over budget: {violation}'))
+        if violations and options['fail_on_budget']:
+            raise CommandError(f'{len(violations)} budget(s) exceeded')
+        if not violations:
+            self.stdout.write(self.style.SUCCESS('All scenarios within budget'))
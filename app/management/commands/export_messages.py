@@ -0,0 +1,41 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from app.exports import BATCH_SIZE, FORMATS, export_rows, export_stream, user_conversation_keys
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream a user's or a conversation's messages to a file as NDJSON or CSV, in constant memory; "
+        "NDJSON exports can be loaded elsewhere with import_messages"
+    )
+
+    def add_arguments(self, parser):
+        target = parser.add_mutually_exclusive_group(required=True)
+        target.add_argument('--user', help='Username; exports all their conversations and their contacts')
+        target.add_argument('--conversation', help='Conversation key ("low:high" user ids, or a group key)')
+        parser.add_argument('--format', choices=list(FORMATS), default='ndjson')
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument('--output', default='-', help='File to write, or - for standard output')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+            if user is None:
+                raise CommandError(f"No user named {options['user']}")
+            rows = export_rows(user_conversation_keys(user.id), user, options['batch_size'])
+        else:
+            rows = export_rows([options['conversation']], batch_size=options['batch_size'])
+
+        output = sys.stdout.buffer if options['output'] == '-' else open(options['output'], 'wb')
+        try:
+            for data in export_stream(rows, options['format'], options['gzip']):
+                output.write(data)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+        if options['output'] != '-':
+            self.stdout.write(self.style.SUCCESS(f"Exported to {options['output']}"))
@@ -0,0 +1,46 @@
+import gzip
+import io
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from app.exports import BATCH_SIZE, import_records
+
+# Room for the exported message id in Message.idempotency_key (64 characters)
+MAX_SOURCE_LENGTH = 40
+
+
+class Command(BaseCommand):
+    help = (
+        'Bulk-load an NDJSON export (from export_messages or /api/export/, optionally gzipped) into '
+        'Message and Contact, matching users by username, then rebuild the inbox tables'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument(
+            '--source', default='import',
+            help='Label of the exporting deployment; messages already imported under it are skipped, '
+                 'so an interrupted import can be re-run',
+        )
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if len(options['source']) > MAX_SOURCE_LENGTH:
+            raise CommandError(f'--source can be at most {MAX_SOURCE_LENGTH} characters')
+
+        with open(options['path'], 'rb') as raw:
+            compressed = raw.read(2) == b'\x1f\x8b'
+            raw.seek(0)
+            stream = gzip.GzipFile(fileobj=raw) if compressed else raw
+            counts = import_records(
+                io.TextIOWrapper(stream, encoding='utf-8'), options['source'], options['batch_size']
+            )
+
+        if counts['messages'] or counts['contacts']:
+            # bulk_create skipped the signals that keep inbox rows and conversations up to date
+            call_command('rebuild_conversation_summaries', batch_size=options['batch_size'], stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {counts['messages']} messages and {counts['contacts']} contacts, "
+            f"skipped {counts['skipped']} records"
+        ))
@@ -0,0 +1,47 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from app.benchmark import seed_dataset
+from app.loadtest import load_clients, run_load
+
+
+class Command(BaseCommand):
+    help = 'Load-test running servers over HTTP with polling and sending clients, to compare WSGI and ASGI profiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('urls', nargs='+', help='Base URL of each server to test, e.g. http://127.0.0.1:8000')
+        parser.add_argument('--concurrency', type=int, default=50, help='Simulated clients, one thread each')
+        parser.add_argument('--duration', type=float, default=15, help='Seconds per server')
+        parser.add_argument('--think-time', type=float, default=0.0,
+                            help='Mean idle seconds between a client\'s requests (0: back to back)')
+        parser.add_argument('--send-ratio', type=float, default=0.05, help='Share of requests that send a message')
+        parser.add_argument('--prefix', default='load', help='Username prefix of the load-test users')
+        parser.add_argument('--seed-users', type=int, default=0,
+                            help='First seed this many synthetic users into the configured database')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        prefix = options['prefix']
+        if options['seed_users']:
+            if User.objects.filter(username__startswith=prefix).exists():
+                raise CommandError(f'Users named {prefix}* already exist; drop --seed-users to reuse them')
+            # Unlike the benchmark command this writes to the real database: the servers must see the data
+            seed_dataset(users=options['seed_users'], seed=options['seed'], prefix=prefix)
+
+        clients = load_clients(prefix, options['concurrency'], seed=options['seed'])
+        if not clients:
+            raise CommandError(f'No users named {prefix}* with contacts; pass --seed-users to create some')
+        self.stdout.write(f"{len(clients)} clients, {options['duration']:g} s per server, "
+                          f"think time {options['think_time']:g} s, send ratio {options['send_ratio']:g}")
+
+        self.stdout.write(f"{'server':<32}{'requests':>10}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}")
+        for url in options['urls']:
+            stats = run_load(url, clients, duration=options['duration'], think_time=options['think_time'],
+                             send_ratio=options['send_ratio'], seed=options['seed'])
+            self.stdout.write(
+                f"{url:<32}{stats['requests']:>10}{stats['rps']:>9.0f}{stats['p50_ms']:>9.1f}"
+                f"{stats['p99_ms']:>9.1f}{stats['errors']:>8}"
+            )
+            if options['verbosity'] > 1:
+                for status, count in sorted(stats['statuses'].items()):
+                    self.stdout.write(f'    {status}: {count}')
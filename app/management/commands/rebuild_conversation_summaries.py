@@ -0,0 +1,88 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from app.models import Contact, Conversation, ConversationSummary, Message, PREVIEW_LENGTH
+from app.routers import message_databases
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the ConversationSummary inbox table (and group inbox fields) from Message and Contact rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--if-empty', action='store_true',
+            help='Only build the table when it has no rows yet, e.g. on the first deploy with it (build.sh)',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if options['if_empty'] and ConversationSummary.objects.exists():
+            self.stdout.write('Conversation summaries already exist; nothing to do')
+            return
+        contacts = set(Contact.objects.values_list('user_id', 'contact_user_id'))
+
+        summaries = {}
+        # Messages and their read watermarks share a database (one per shard when sharded)
+        for alias in message_databases():
+            self._add_message_summaries(summaries, alias, contacts, batch_size)
+
+        # Contacts nobody has written to yet still belong in the inbox
+        for contact in Contact.objects.only('user_id', 'contact_user_id', 'created_at'):
+            key = (contact.user_id, contact.contact_user_id)
+            if key not in summaries:
+                summaries[key] = ConversationSummary(
+                    user_id=contact.user_id,
+                    peer_id=contact.contact_user_id,
+                    last_activity_at=contact.created_at,
+                    is_contact=True,
+                )
+
+        with transaction.atomic():
+            # Everyone who had or now has an inbox gets their cached sidebar dropped
+            user_ids = set(ConversationSummary.objects.values_list('user_id', flat=True))
+            user_ids.update(user_id for user_id, _ in summaries)
+            ConversationSummary.objects.all().delete()
+            ConversationSummary.objects.bulk_create(summaries.values(), batch_size=batch_size)
+            ConversationSummary.objects.changed(*user_ids)
+            # bulk_create skips the summary manager, which would give new pairs their Conversation
+            Conversation.objects.add_direct(summaries, batch_size)
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {len(summaries)} conversation summaries'))
+
+    def _add_message_summaries(self, summaries, alias, contacts, batch_size):
+        messages = Message.objects.using(alias)
+
+        # Newest message per conversation, from one grouped query
+        message_ids = list(
+            messages.order_by().values('conversation_key')
+            .annotate(last_id=Max('id')).values_list('last_id', flat=True)
+        )
+
+        # Unread = received after the receiver's read watermark
+        unread = ConversationSummary.objects.count_unread(alias)
+
+        for start in range(0, len(message_ids), batch_size):
+            batch = messages.only('sender_id', 'receiver_id', 'conversation_key', 'content', 'timestamp').in_bulk(
+                message_ids[start:start + batch_size]
+            )
+            # Groups: one set of inbox fields on the Conversation for all members
+            Conversation.objects.record_messages(
+                [message for message in batch.values() if message.receiver_id is None]
+            )
+            for message in batch.values():
+                if message.receiver_id is None:
+                    continue
+                for user_id, peer_id in ((message.sender_id, message.receiver_id),
+                                         (message.receiver_id, message.sender_id)):
+                    summaries[user_id, peer_id] = ConversationSummary(
+                        user_id=user_id,
+                        peer_id=peer_id,
+                        last_message_id=message.id,
+                        last_message_preview=message.content[:PREVIEW_LENGTH],
+                        last_message_is_mine=message.sender_id == user_id,
+                        last_activity_at=message.timestamp,
+                        unread_count=unread.get((user_id, peer_id), 0),
+                        is_contact=(user_id, peer_id) in contacts,
+                    )
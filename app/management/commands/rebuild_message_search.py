@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from app.search import rebuild_message_index
+
+
+class Command(BaseCommand):
+    help = 'Create (if missing) and repopulate the full-text index used by message search'
+
+    def handle(self, *args, **options):
+        rebuild_message_index()
+        self.stdout.write(self.style.SUCCESS('Message search index rebuilt'))
@@ -0,0 +1,38 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.tasks import claim, run_jobs, worker_id
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs (inbox rows, unread counters, contact upserts) until interrupted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.MESSENGER_TASKS_BATCH_SIZE)
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty')
+        parser.add_argument('--only', action='append', metavar='NAME', help='Run only jobs called NAME (repeatable)')
+        parser.add_argument(
+            '--exclude', action='append', default=[], metavar='NAME', help='Leave jobs called NAME to another worker (repeatable)'
+        )
+
+    def handle(self, *args, **options):
+        worker = worker_id()
+        self.stdout.write(f'Worker {worker} started')
+        total = 0
+        try:
+            while True:
+                jobs = claim(worker, options['batch_size'], options['only'], options['exclude'])
+                if jobs:
+                    done = run_jobs(jobs)
+                    total += done
+                    if options['verbosity'] > 1:
+                        self.stdout.write(f'Ran {done} of {len(jobs)} jobs')
+                elif options['once']:
+                    break
+                else:
+                    time.sleep(settings.MESSENGER_TASKS_POLL_INTERVAL)
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(f'Worker {worker} stopped after {total} jobs'))
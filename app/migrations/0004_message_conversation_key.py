@@ -0,0 +1,61 @@
+from django.db import migrations, models
+from django.db.models import CharField, Value
+from django.db.models.functions import Cast, Concat, Greatest, Least
+
+BACKFILL_BATCH_SIZE = 5000
+
+
+def backfill_conversation_keys(apps, schema_editor):
+    """Fill conversation_key with one UPDATE per id range, never loading rows into Python"""
+    Message = apps.get_model('app', 'Message')
+    db_alias = schema_editor.connection.alias
+    messages = Message.objects.using(db_alias)
+    key = Concat(
+        Cast(Least('sender_id', 'receiver_id'), CharField()),
+        Value(':'),
+        Cast(Greatest('sender_id', 'receiver_id'), CharField()),
+        output_field=CharField(),
+    )
+
+    last_id = messages.order_by('-id').values_list('id', flat=True).first() or 0
+    for start in range(0, last_id + 1, BACKFILL_BATCH_SIZE):
+        messages.filter(
+            id__gte=start, id__lt=start + BACKFILL_BATCH_SIZE, conversation_key=''
+        ).update(conversation_key=key)
+
+
+class Migration(migrations.Migration):
+
+    # Each backfill batch commits on its own so a large table never holds one long transaction
+    atomic = False
+
+    dependencies = [
+        ('app', '0003_conversationsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='conversation_key',
+            field=models.CharField(default='', editable=False, max_length=41),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_conversation_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation_key', 'timestamp', 'id'], name='app_msg_conversation_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation_key', 'updated_at'], name='app_msg_conv_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('status', 'sent')), fields=['receiver', 'sender'], name='app_msg_unread_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+from django.db import migrations, models
+from django.db.models.functions import Lower
+
+
+def backfill_normalized_nicknames(apps, schema_editor):
+    UserProfile = apps.get_model('app', 'UserProfile')
+    UserProfile.objects.using(schema_editor.connection.alias).update(nickname_normalized=Lower('nickname'))
+
+
+def create_trigram_index(apps, schema_editor):
+    # Substring search on Postgres; SQLite relies on the plain prefix index
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS app_profile_nick_trgm_idx '
+        'ON app_userprofile USING gin (nickname_normalized gin_trgm_ops)'
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS app_profile_nick_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_message_conversation_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='nickname_normalized',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=50),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_normalized_nicknames, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
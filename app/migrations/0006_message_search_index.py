@@ -0,0 +1,74 @@
+from django.db import migrations
+
+# The full-text index as this migration created it; app.search keeps the
+# current definition, which later migrations must not change underneath this one.
+# Migrations that make SQLite rebuild app_message re-create the triggers with
+# recreate_triggers below.
+SQLITE_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS app_message_fts_ai AFTER INSERT ON app_message BEGIN "
+    "INSERT INTO app_message_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS app_message_fts_ad AFTER DELETE ON app_message BEGIN "
+    "INSERT INTO app_message_fts(app_message_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS app_message_fts_au AFTER UPDATE OF content ON app_message BEGIN "
+    "INSERT INTO app_message_fts(app_message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO app_message_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+SQLITE_CREATE = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS app_message_fts USING fts5("
+    "content, content='app_message', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    *SQLITE_TRIGGERS,
+    # Index rows that existed before the triggers
+    "INSERT INTO app_message_fts(app_message_fts) VALUES ('rebuild')",
+]
+SQLITE_DROP = [
+    'DROP TRIGGER IF EXISTS app_message_fts_ai',
+    'DROP TRIGGER IF EXISTS app_message_fts_ad',
+    'DROP TRIGGER IF EXISTS app_message_fts_au',
+    'DROP TABLE IF EXISTS app_message_fts',
+]
+POSTGRES_CREATE = [
+    "ALTER TABLE app_message ADD COLUMN IF NOT EXISTS search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED",
+    'CREATE INDEX IF NOT EXISTS app_message_search_idx ON app_message USING gin (search_vector)',
+]
+POSTGRES_DROP = [
+    'DROP INDEX IF EXISTS app_message_search_idx',
+    'ALTER TABLE app_message DROP COLUMN IF EXISTS search_vector',
+]
+
+
+def _execute_all(schema_editor, statements):
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def create_index(apps, schema_editor):
+    _execute_all(schema_editor, {'sqlite': SQLITE_CREATE, 'postgresql': POSTGRES_CREATE})
+
+
+def drop_index(apps, schema_editor):
+    _execute_all(schema_editor, {'sqlite': SQLITE_DROP, 'postgresql': POSTGRES_DROP})
+
+
+def recreate_triggers(apps, schema_editor):
+    """Put back the triggers a SQLite table rebuild of app_message dropped
+
+    The app_message_fts table and the Postgres column survive such a rebuild.
+    Databases this migration skipped (message shards) have no table to
+    trigger on until migration 0017.
+    """
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        if 'app_message_fts' in connection.introspection.table_names(cursor):
+            _execute_all(schema_editor, {'sqlite': SQLITE_TRIGGERS})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_userprofile_nickname_normalized'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
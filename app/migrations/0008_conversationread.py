@@ -0,0 +1,58 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def backfill_read_watermarks(apps, schema_editor):
+    """Seed each reader's watermark from the newest message already marked read"""
+    Message = apps.get_model('app', 'Message')
+    ConversationRead = apps.get_model('app', 'ConversationRead')
+    db_alias = schema_editor.connection.alias
+
+    rows = (
+        Message.objects.using(db_alias).filter(status='read').order_by()
+        .values('receiver_id', 'conversation_key').annotate(last_read=Max('id'))
+    )
+    ConversationRead.objects.using(db_alias).bulk_create(
+        (
+            ConversationRead(
+                user_id=row['receiver_id'],
+                conversation_key=row['conversation_key'],
+                last_read_message_id=row['last_read'],
+            )
+            for row in rows.iterator()
+        ),
+        batch_size=BACKFILL_BATCH_SIZE,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_presence_last_seen'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationRead',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('conversation_key', models.CharField(max_length=41)),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'conversation_key')},
+            },
+        ),
+        migrations.RunPython(backfill_read_watermarks, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='app_msg_unread_idx',
+        ),
+    ]
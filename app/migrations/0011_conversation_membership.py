@@ -0,0 +1,79 @@
+from importlib import import_module
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+# SQLite rebuilds app_message to make receiver nullable, taking the full-text triggers with it
+search_index = import_module('app.migrations.0006_message_search_index')
+
+
+def create_direct_conversations(apps, schema_editor):
+    """One Conversation with two memberships for every pair that has messages or an inbox row"""
+    Conversation = apps.get_model('app', 'Conversation')
+    ConversationSummary = apps.get_model('app', 'ConversationSummary')
+    Membership = apps.get_model('app', 'Membership')
+    Message = apps.get_model('app', 'Message')
+    db = schema_editor.connection.alias
+
+    # Inbox rows cover every pair with messages, including those on other shards
+    keys = set(Message.objects.using(db).order_by().values_list('conversation_key', flat=True).distinct())
+    for user_id, peer_id in ConversationSummary.objects.using(db).values_list('user_id', 'peer_id'):
+        low, high = sorted((user_id, peer_id))
+        keys.add(f'{low}:{high}')
+    keys = sorted(keys)
+
+    for start in range(0, len(keys), BATCH_SIZE):
+        batch = keys[start:start + BATCH_SIZE]
+        Conversation.objects.using(db).bulk_create([Conversation(key=key) for key in batch], ignore_conflicts=True)
+        Membership.objects.using(db).bulk_create([
+            Membership(conversation_id=key, user_id=int(user_id))
+            for key in batch for user_id in key.split(':')
+        ], ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_shardable_conversation_tables'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=41, unique=True)),
+                ('is_group', models.BooleanField(default=False)),
+                ('title', models.CharField(blank=True, max_length=100)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_message_id', models.BigIntegerField(blank=True, null=True)),
+                ('last_message_preview', models.CharField(blank=True, max_length=100)),
+                ('last_sender_id', models.BigIntegerField(blank=True, null=True)),
+                ('last_activity_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Membership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('joined_at', models.DateTimeField(auto_now_add=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='app.conversation', to_field='key')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'conversation'], name='app_membership_user_idx')],
+                'unique_together': {('conversation', 'user')},
+            },
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='receiver',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='received_messages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(search_index.recreate_triggers, migrations.RunPython.noop, hints={'model_name': 'message'}),
+        migrations.RunPython(create_direct_conversations, migrations.RunPython.noop, hints={'model_name': 'conversation'}),
+    ]
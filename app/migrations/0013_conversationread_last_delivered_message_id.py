@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationread',
+            name='last_delivered_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
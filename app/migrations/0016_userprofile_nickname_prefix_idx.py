@@ -0,0 +1,35 @@
+from django.db import migrations
+
+
+def create_prefix_index(apps, schema_editor):
+    # Prefix search is a LIKE 'query%' on nickname_normalized (see app.search).
+    # Postgres only turns that into an index range with the pattern operator
+    # class under a non-C collation; SQLite's LIKE ignores ASCII case, so it
+    # needs a NOCASE index (the column is lower-cased already)
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS app_profile_nick_prefix_idx '
+            'ON app_userprofile (nickname_normalized varchar_pattern_ops)'
+        )
+    elif vendor == 'sqlite':
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS app_profile_nick_prefix_idx '
+            'ON app_userprofile (nickname_normalized COLLATE NOCASE)'
+        )
+
+
+def drop_prefix_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        schema_editor.execute('DROP INDEX IF EXISTS app_profile_nick_prefix_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_message_timestamp_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_prefix_index, drop_prefix_index, hints={'model_name': 'userprofile'}),
+    ]
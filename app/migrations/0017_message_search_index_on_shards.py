@@ -0,0 +1,33 @@
+from importlib import import_module
+
+from django.db import migrations
+
+search_index = import_module('app.migrations.0006_message_search_index')
+
+
+def create_missing_index(apps, schema_editor):
+    """Run migration 0006 on message shards, which skip its unhinted RunPython
+
+    Databases that already have the index (default, or a shard created by
+    an earlier copy of 0006 that carried the hint) are left as they are.
+    """
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            exists = 'app_message_fts' in connection.introspection.table_names(cursor)
+        else:
+            columns = connection.introspection.get_table_description(cursor, 'app_message')
+            exists = any(column.name == 'search_vector' for column in columns)
+    if not exists:
+        search_index.create_index(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_userprofile_nickname_prefix_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_missing_index, migrations.RunPython.noop, hints={'model_name': 'message'}),
+    ]
@@ -1,15 +1,31 @@
-from django.db import models
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.db import models, router, transaction, IntegrityError
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
 
+from .caching import (
+    NO_WATERMARK, MessageRecord, Watermark, bump_conversation_version, bump_inbox_versions, get_recent_messages,
+)
+from .routers import message_db_for_key
+from .sessions import invalidate_session_user
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     nickname = models.CharField(max_length=50, unique=True)
+    # Lower-cased nickname for index-backed search (see app.search)
+    nickname_normalized = models.CharField(max_length=50, db_index=True, editable=False)
     avatar_emoji = models.CharField(max_length=10, default='😊')
-    is_online = models.BooleanField(default=False)
-    last_seen = models.DateTimeField(auto_now=True)
+    # Online state lives in app.presence; last_seen is flushed there in batches
+    last_seen = models.DateTimeField(default=timezone.now)
     theme_preference = models.CharField(
         max_length=10,
         choices=[('light', 'Light'), ('dark', 'Dark')],
@@ -19,6 +35,13 @@ class UserProfile(models.Model):
     def __str__(self):
         return f"{self.nickname} ({self.user.username})"
     
+    def save(self, *args, **kwargs):
+        self.nickname_normalized = self.nickname.lower()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'nickname' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'nickname_normalized'}
+        super().save(*args, **kwargs)
+    
     @property
     def display_name(self):
         return self.nickname or self.user.username
@@ -28,22 +51,69 @@ def create_user_profile(sender, instance, created, **kwargs):
     if created:
         UserProfile.objects.create(user=instance, nickname=instance.username)
 
+# request.user comes from a cache (app.sessions); drop it once the change is committed
 @receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    if hasattr(instance, 'userprofile'):
-        instance.userprofile.save()
+@receiver(post_delete, sender=User)
+def invalidate_session_user_on_user_change(sender, instance, using, **kwargs):
+    transaction.on_commit(lambda: invalidate_session_user(instance.pk), using=using)
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_session_user_on_profile_change(sender, instance, using, **kwargs):
+    transaction.on_commit(lambda: invalidate_session_user(instance.user_id), using=using)
+
+class ContactManager(models.Manager):
+    def add_mutual(self, user_id, peer_id):
+        """Make two users each other's contacts with a single INSERT, leaving existing rows alone"""
+        self.bulk_create(
+            [Contact(user_id=user_id, contact_user_id=peer_id), Contact(user_id=peer_id, contact_user_id=user_id)],
+            ignore_conflicts=True,
+        )
+        # bulk_create skips post_save, so flag the inbox rows here; both usually
+        # exist already (a message was just recorded), which makes this one UPDATE
+        pairs = models.Q(user_id=user_id, peer_id=peer_id) | models.Q(user_id=peer_id, peer_id=user_id)
+        if ConversationSummary.objects.filter(pairs).update(is_contact=True) < 2:
+            ConversationSummary.objects.set_contact(user_id, peer_id, True)
+            ConversationSummary.objects.set_contact(peer_id, user_id, True)
+        else:
+            ConversationSummary.objects.changed(user_id, peer_id)
 
 class Contact(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='contacts')
     contact_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='contacted_by')
     created_at = models.DateTimeField(auto_now_add=True)
     
+    objects = ContactManager()
+    
     class Meta:
         unique_together = ('user', 'contact_user')
     
     def __str__(self):
         return f"{self.user.userprofile.display_name} - {self.contact_user.userprofile.display_name}"
 
+def conversation_key(user_a_id, user_b_id):
+    """Direction-independent key shared by every message between two users"""
+    low, high = sorted((int(user_a_id), int(user_b_id)))
+    return f"{low}:{high}"
+
+class MessageQuerySet(models.QuerySet):
+    def in_conversation(self, key):
+        """Messages of one conversation, read from the shard that holds it"""
+        queryset = self.filter(conversation_key=key)
+        alias = message_db_for_key(key)
+        return queryset.using(alias) if alias else queryset
+    
+    def with_profiles(self, *relations):
+        """Load the profiles of the given user relations ('sender', 'receiver') along with the messages
+        
+        A join when possible; a separate query when messages are sharded,
+        since a shard cannot join to the user tables.
+        """
+        lookups = [f'{relation}__userprofile' for relation in relations]
+        if settings.MESSENGER_MESSAGE_SHARDS:
+            return self.prefetch_related(*lookups)
+        return self.select_related(*lookups)
+
 class Message(models.Model):
     STATUS_CHOICES = [
         ('sent', 'Sent'),
@@ -51,14 +121,595 @@ class Message(models.Model):
         ('read', 'Read'),
     ]
     
-    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
-    receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages')
+    # No database-level constraints: with MESSENGER_MESSAGE_SHARDS, messages live
+    # on shard databases that have no user rows (see app.routers)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages', db_constraint=False)
+    # Empty for group messages, which are stored once for all members
+    receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_messages',
+                                 null=True, blank=True, db_constraint=False)
+    # Conversation.key: the ordered "low:high" user-id pair of a direct chat, so
+    # one index range covers a conversation; "g<hex>" for groups
+    conversation_key = models.CharField(max_length=41, editable=False)
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Compatibility field: no longer written on read. Views derive it from the
+    # ConversationRead watermarks via ConversationRead.objects.apply_status()
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='sent')
+    # Bumped whenever the row changes so clients can sync deltas
+    updated_at = models.DateTimeField(auto_now=True)
+    # Client-generated key for the send API: a retried send returns the original message
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True, editable=False)
+    # Attachment.summary() of the file sent with the message, copied here so
+    # pages and the recent-messages cache need no extra query
+    attachment = models.JSONField(null=True, blank=True, editable=False)
+    
+    objects = MessageQuerySet.as_manager()
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['conversation_key', 'timestamp', 'id'], name='app_msg_conversation_idx'),
+            models.Index(fields=['conversation_key', 'updated_at'], name='app_msg_conv_updated_idx'),
+            # Date ranges across all conversations, for the admin (see app.admin)
+            models.Index(fields=['timestamp'], name='app_msg_timestamp_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['sender', 'idempotency_key'],
+                condition=models.Q(idempotency_key__isnull=False),
+                name='app_msg_idempotency_uniq',
+            ),
+        ]
+    
+    def clean(self):
+        # The key of a direct chat follows from its users; a group's can't be guessed
+        if not self.conversation_key and self.receiver_id is None:
+            raise ValidationError({'receiver': 'Choose a receiver; group messages are sent from the group.'})
+    
+    def save(self, *args, **kwargs):
+        if not self.conversation_key:
+            if self.receiver_id is None:
+                raise ValueError('A message without a receiver needs the conversation_key of its group')
+            self.conversation_key = conversation_key(self.sender_id, self.receiver_id)
+        super().save(*args, **kwargs)
+    
+    def to_record(self):
+        """Snapshot kept by the recent-messages cache (see app.caching)"""
+        return MessageRecord(
+            self.id, self.sender_id, self.receiver_id, self.sender.userprofile.nickname,
+            self.content, self.timestamp, self.updated_at, self.attachment,
+        )
+    
+    @classmethod
+    def from_record(cls, key, record):
+        """Rebuild a Message, sender profile included, without a query"""
+        msg = cls(
+            id=record.id, sender_id=record.sender_id, receiver_id=record.receiver_id, conversation_key=key,
+            content=record.content, timestamp=record.timestamp, updated_at=record.updated_at,
+            attachment=record.attachment,
+        )
+        msg._state.adding = False
+        sender = User(id=record.sender_id)
+        sender.userprofile = UserProfile(user_id=record.sender_id, nickname=record.sender_nickname)
+        msg.sender = sender
+        return msg
     
     def __str__(self):
+        if self.receiver_id is None:
+            return f"From {self.sender.userprofile.display_name} to group {self.conversation_key} at {self.timestamp}"
         return f"From {self.sender.userprofile.display_name} to {self.receiver.userprofile.display_name} at {self.timestamp}"
+
+
+PREVIEW_LENGTH = 100
+
+class ConversationSummaryManager(models.Manager):
+    def changed(self, *user_ids):
+        """Invalidate the users' cached sidebars once the current transaction commits"""
+        transaction.on_commit(lambda: bump_inbox_versions(*user_ids), using=router.db_for_write(self.model))
+    
+    def _upsert(self, user_id, peer_id, unread_increment=0, **fields):
+        """Update the (user, peer) row in place, creating it on first use"""
+        def update():
+            return self.filter(user_id=user_id, peer_id=peer_id).update(
+                unread_count=F('unread_count') + unread_increment, **fields
+            )
+        
+        if update():
+            return
+        try:
+            with transaction.atomic():
+                self.create(user_id=user_id, peer_id=peer_id, unread_count=unread_increment, **fields)
+        except IntegrityError:
+            # Another request created the row first
+            update()
+        else:
+            # First contact between the two: give them their direct Conversation
+            Conversation.objects.add_direct([(user_id, peer_id)])
+    
+    def record_messages(self, messages, check_read=True):
+        """Apply new direct messages to both participants' inbox rows
+        
+        A batch is coalesced: two upserts per conversation however many of
+        its messages it holds, with the newest one as the preview. Queued
+        jobs can run after the receiver has already read the messages, so
+        only those past the receiver's read watermark count as unread;
+        `check_read=False` skips that lookup when nothing can have been read
+        yet (the job runs inside the send).
+        """
+        newest, by_pair = {}, defaultdict(list)
+        for message in messages:
+            pair = (min(message.sender_id, message.receiver_id), max(message.sender_id, message.receiver_id))
+            if pair not in newest or message.id > newest[pair].id:
+                newest[pair] = message
+            by_pair[pair].append(message)
+        
+        for (low, high), message in newest.items():
+            read_up_to = {}
+            if check_read:
+                read_up_to = dict(ConversationRead.objects.in_conversation(message.conversation_key).filter(
+                    user_id__in=(low, high)
+                ).values_list('user_id', 'last_read_message_id'))
+            received = defaultdict(int)
+            for pair_message in by_pair[low, high]:
+                if pair_message.id > read_up_to.get(pair_message.receiver_id, 0):
+                    received[pair_message.receiver_id, pair_message.sender_id] += 1
+            last_message = {
+                'last_message_id': message.id,
+                'last_message_preview': message.content[:PREVIEW_LENGTH],
+                'last_activity_at': message.timestamp,
+            }
+            for user_id, peer_id in ((low, high), (high, low)):
+                self._upsert(user_id, peer_id, unread_increment=received[user_id, peer_id],
+                             last_message_is_mine=message.sender_id == user_id, **last_message)
+        if newest:
+            self.changed(*{user_id for pair in newest for user_id in pair})
+    
+    def mark_read(self, user, peer, up_to_id):
+        unread = self.filter(user=user, peer=peer, unread_count__gt=0)
+        # Usually the newest message was just read and nothing is left
+        if unread.filter(last_message_id__lte=up_to_id).update(unread_count=0):
+            self.changed(user.id)
+            return
+        # Newer messages remain, perhaps only the reader's own replies: recount
+        # the peer's messages past the read point
+        remaining = Message.objects.in_conversation(conversation_key(user.id, peer.id)).filter(
+            sender_id=peer.id, id__gt=up_to_id
+        ).count()
+        if unread.filter(unread_count__gt=remaining).update(unread_count=remaining):
+            self.changed(user.id)
+    
+    def set_contact(self, user_id, peer_id, is_contact):
+        self._upsert(user_id, peer_id, is_contact=is_contact)
+        self.changed(user_id)
+    
+    def unread_by_peer(self, user):
+        """{peer id: unread count} of the user's direct chats with anything unread"""
+        return dict(self.filter(user=user, unread_count__gt=0).values_list('peer_id', 'unread_count'))
+    
+    def count_unread(self, using):
+        """{(user id, peer id): unread count} recounted from the direct messages
+        and read watermarks on one database, for rebuilding or checking the counters"""
+        read_up_to = ConversationRead.objects.using(using).filter(
+            user=OuterRef('receiver'), conversation_key=OuterRef('conversation_key')
+        ).values('last_read_message_id')[:1]
+        return {
+            (row['receiver'], row['sender']): row['count']
+            for row in Message.objects.using(using).filter(receiver__isnull=False)
+            .annotate(read_up_to=Subquery(read_up_to))
+            .filter(Q(read_up_to__isnull=True) | Q(id__gt=F('read_up_to'))).order_by()
+            .values('sender', 'receiver').annotate(count=Count('id'))
+        }
+
+class ConversationSummary(models.Model):
+    """One inbox row per user per peer, maintained on send, read and contact changes"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversation_summaries')
+    peer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True)
+    last_message_is_mine = models.BooleanField(default=False)
+    # Last message time, or when the contact was added if nothing was sent yet
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    unread_count = models.PositiveIntegerField(default=0)
+    is_contact = models.BooleanField(default=False)
+    
+    objects = ConversationSummaryManager()
+    
+    class Meta:
+        unique_together = ('user', 'peer')
+        indexes = [
+            models.Index(fields=['user', '-last_activity_at'], name='app_summary_inbox_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Inbox of user {self.user_id}: peer {self.peer_id}"
+
+class ConversationReadManager(models.Manager):
+    def in_conversation(self, key):
+        queryset = self.filter(conversation_key=key)
+        alias = message_db_for_key(key)
+        return queryset.using(alias) if alias else queryset
+    
+    def watermarks(self, key):
+        """{user_id: Watermark(read, delivered)} for the participants of a conversation"""
+        return {
+            user_id: Watermark(read, max(read, delivered))
+            for user_id, read, delivered in self.in_conversation(key).values_list(
+                'user_id', 'last_read_message_id', 'last_delivered_message_id'
+            )
+        }
+    
+    def _advance(self, user_id, key, message_id, kind):
+        """Move the user's `kind` ('read' or 'delivered') point forward to `message_id`, never backwards"""
+        field = f'last_{kind}_message_id'
+        
+        def update():
+            return self.in_conversation(key).filter(
+                user_id=user_id, **{f'{field}__lt': message_id}
+            ).update(**{field: message_id}, updated_at=timezone.now())
+        
+        db = message_db_for_key(key) or router.db_for_write(self.model)
+        if update():
+            moved = True
+        else:
+            try:
+                with transaction.atomic(using=db):
+                    self.db_manager(db).create(user_id=user_id, conversation_key=key, **{field: message_id})
+                moved = True
+            except IntegrityError:
+                # The row exists: either already past message_id or created concurrently
+                moved = bool(update())
+        if moved:
+            transaction.on_commit(lambda: get_recent_messages().watermark_moved(
+                key, bump_conversation_version(key), user_id, **{kind: message_id}
+            ), using=db)
+        return moved
+    
+    def advance(self, user_id, key, message_id):
+        """Mark everything up to `message_id` read by the user"""
+        return self._advance(user_id, key, message_id, 'read')
+    
+    def acknowledge(self, user_id, key, message_id):
+        """Mark everything up to `message_id` delivered to the user: one UPDATE however many messages it covers"""
+        return self._advance(user_id, key, message_id, 'delivered')
+    
+    def apply_status(self, messages, watermarks, member_ids=()):
+        """Fill in Message.status from the receivers' watermarks
+        
+        A group message (no receiver) is read, or delivered, once every other
+        member of `member_ids` has read or received it.
+        """
+        for msg in messages:
+            if msg.receiver_id is not None:
+                read_up_to, delivered_up_to = watermarks.get(msg.receiver_id, NO_WATERMARK)
+            else:
+                others = [watermarks.get(user_id, NO_WATERMARK) for user_id in member_ids if user_id != msg.sender_id]
+                read_up_to = min((watermark.read for watermark in others), default=0)
+                delivered_up_to = min((watermark.delivered for watermark in others), default=0)
+            if msg.id <= read_up_to:
+                msg.status = 'read'
+            elif msg.id <= delivered_up_to:
+                msg.status = 'delivered'
+            else:
+                msg.status = 'sent'
+        return messages
+
+class ConversationRead(models.Model):
+    """How far a user has read and received a conversation: one row per (reader, conversation)"""
+    # Sharded with the conversation's messages, hence no database-level constraint
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', db_constraint=False)
+    conversation_key = models.CharField(max_length=41)
+    last_read_message_id = models.BigIntegerField(default=0)
+    # Acknowledged by one of the user's clients; may lag behind the read point
+    last_delivered_message_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    objects = ConversationReadManager()
+    
+    class Meta:
+        unique_together = ('user', 'conversation_key')
+    
+    def __str__(self):
+        return f"User {self.user_id} read {self.conversation_key} up to {self.last_read_message_id}"
+
+def group_conversation_key():
+    """Key for a new group; can't collide with the "low:high" keys of direct chats"""
+    return f'g{uuid.uuid4().hex}'
+
+def _conversation_key_cache_key(conversation_id):
+    return f'conversation-key:{conversation_id}'
+
+def _members_cache_key(key):
+    # By key, which memberships carry, so a membership change can clear it without a query
+    return f'conversation-members:{key}'
+
+class ConversationManager(models.Manager):
+    def add_direct(self, pairs, batch_size=1000):
+        """Give each (user id, peer id) pair its 1:1 conversation and both
+        memberships, leaving existing ones alone; two INSERTs per batch"""
+        keys = sorted({conversation_key(user_id, peer_id) for user_id, peer_id in pairs})
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            self.bulk_create([Conversation(key=key) for key in batch], ignore_conflicts=True)
+            Membership.objects.bulk_create([
+                Membership(conversation_id=key, user_id=int(user_id))
+                for key in batch for user_id in key.split(':')
+            ], ignore_conflicts=True)
+    
+    def create_group(self, creator, title, member_ids):
+        """New group conversation; the creator is always a member"""
+        with transaction.atomic():
+            conversation = self.create(key=group_conversation_key(), title=title, is_group=True)
+            Membership.objects.bulk_create([
+                Membership(conversation=conversation, user_id=user_id) for user_id in {creator.id, *member_ids}
+            ])
+        return conversation
+    
+    def members(self, conversation_id):
+        """(key, frozenset of member ids) of a conversation, or None if it doesn't exist
+        
+        The key is cached for good (it never changes) and the members until
+        the membership changes, so permission checks on the messages API cost
+        no query.
+        """
+        key = cache.get(_conversation_key_cache_key(conversation_id))
+        if key is None:
+            key = self.filter(id=conversation_id).values_list('key', flat=True).first()
+            if key is None:
+                return None
+            cache.set(_conversation_key_cache_key(conversation_id), key, None)
+        member_ids = cache.get(_members_cache_key(key))
+        if member_ids is None:
+            member_ids = frozenset(Membership.objects.filter(conversation_id=key).values_list('user_id', flat=True))
+            cache.set(_members_cache_key(key), member_ids, None)
+        return key, member_ids
+    
+    async def amembers(self, conversation_id):
+        """members() for async views"""
+        key = await cache.aget(_conversation_key_cache_key(conversation_id))
+        if key is None:
+            key = await self.filter(id=conversation_id).values_list('key', flat=True).afirst()
+            if key is None:
+                return None
+            await cache.aset(_conversation_key_cache_key(conversation_id), key, None)
+        member_ids = await cache.aget(_members_cache_key(key))
+        if member_ids is None:
+            member_ids = Membership.objects.filter(conversation_id=key).values_list('user_id', flat=True)
+            member_ids = frozenset([user_id async for user_id in member_ids])
+            await cache.aset(_members_cache_key(key), member_ids, None)
+        return key, member_ids
+    
+    def has_member(self, key, user_id):
+        """Whether the user takes part in conversation `key`; no query for direct chats"""
+        if not key.startswith('g'):
+            return str(user_id) in key.split(':')
+        return Membership.objects.filter(conversation_id=key, user_id=user_id).exists()
+    
+    def record_messages(self, messages):
+        """Update the groups' inbox fields, one row per group however many
+        members it has, and refresh the members' unread badges"""
+        newest = {}
+        for message in messages:
+            if message.conversation_key not in newest or message.id > newest[message.conversation_key].id:
+                newest[message.conversation_key] = message
+        
+        for key, message in newest.items():
+            # A retried job can arrive after a newer message; never move backwards
+            self.filter(Q(last_message_id__isnull=True) | Q(last_message_id__lte=message.id), key=key).update(
+                last_message_id=message.id,
+                last_message_preview=message.content[:PREVIEW_LENGTH],
+                last_sender_id=message.sender_id,
+                last_activity_at=message.timestamp,
+            )
+        if newest:
+            ConversationSummary.objects.changed(*set(
+                Membership.objects.filter(conversation_id__in=newest).values_list('user_id', flat=True)
+            ))
+
+class Conversation(models.Model):
+    """A direct (1:1) or group chat; messages refer to it by `key`
+    
+    Messages and read watermarks may live on another database (see
+    app.routers), so they carry the key rather than a foreign key. Direct
+    chats keep their per-user inbox rows in ConversationSummary; groups keep
+    one set of inbox fields here, and each member's unread count is computed
+    from their read watermark when the inbox is read.
+    """
+    key = models.CharField(max_length=41, unique=True)
+    is_group = models.BooleanField(default=False)
+    title = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True)
+    last_sender_id = models.BigIntegerField(null=True, blank=True)
+    last_activity_at = models.DateTimeField(default=timezone.now, db_index=True)
+    
+    objects = ConversationManager()
+    
+    def __str__(self):
+        return self.title or self.key
+
+class MembershipManager(models.Manager):
+    def group_inbox(self, user):
+        """The user's group memberships, newest activity first, each with an `unread_count`
+        
+        Fan-out on read: a group message is written once, and each member's
+        count is the others' messages past their watermark, counted in one
+        grouped query per database, only for groups with something new.
+        """
+        memberships = list(
+            self.filter(user=user, conversation__is_group=True).select_related('conversation')
+            .order_by('-conversation__last_activity_at')
+        )
+        last_ids = {}
+        keys_by_db = defaultdict(list)
+        for membership in memberships:
+            key = membership.conversation.key
+            last_ids[key] = membership.conversation.last_message_id or 0
+            keys_by_db[message_db_for_key(key) or 'default'].append(key)
+        
+        unread = {}
+        for alias, keys in keys_by_db.items():
+            watermarks = dict(ConversationRead.objects.using(alias).filter(
+                user=user, conversation_key__in=keys
+            ).values_list('conversation_key', 'last_read_message_id'))
+            pending = Q()
+            for key in keys:
+                if last_ids[key] > watermarks.get(key, 0):
+                    pending |= Q(conversation_key=key, id__gt=watermarks.get(key, 0))
+            if pending:
+                unread.update(
+                    Message.objects.using(alias).filter(pending).exclude(sender=user).order_by()
+                    .values('conversation_key').annotate(count=Count('id')).values_list('conversation_key', 'count')
+                )
+        for membership in memberships:
+            membership.unread_count = unread.get(membership.conversation.key, 0)
+        return memberships
+
+class Membership(models.Model):
+    # By key, so memberships can be written without first reading the conversation's id
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='memberships', to_field='key')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='memberships')
+    joined_at = models.DateTimeField(auto_now_add=True)
+    
+    objects = MembershipManager()
+    
+    class Meta:
+        unique_together = ('conversation', 'user')
+        indexes = [
+            models.Index(fields=['user', 'conversation'], name='app_membership_user_idx'),
+        ]
+    
+    def __str__(self):
+        return f"User {self.user_id} in {self.conversation_id}"
+
+# Served inline and thumbnailed; anything else is a download, so an uploaded
+# HTML or SVG file can never run in the site's origin
+IMAGE_TYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp'}
+
+def blob_path(sha256, suffix=''):
+    # Fanned out by hash prefix so no directory grows too large
+    return f'attachments/{sha256[:2]}/{sha256[2:4]}/{sha256}{suffix}'
+
+class BlobManager(models.Manager):
+    def store(self, uploaded):
+        """The Blob with an uploaded file's content, written to storage only if it is new
+        
+        `uploaded.sha256` is filled in while the upload streams in (see
+        app.attachments.HashingUploadHandler).
+        """
+        blob = self.filter(sha256=uploaded.sha256).first()
+        if blob is not None:
+            return blob
+        name = default_storage.save(blob_path(uploaded.sha256), uploaded)
+        try:
+            with transaction.atomic():
+                return self.create(
+                    sha256=uploaded.sha256, size=uploaded.size, file=name,
+                    content_type=uploaded.content_type or 'application/octet-stream',
+                )
+        except IntegrityError:
+            # The same content was uploaded concurrently; keep the other copy
+            default_storage.delete(name)
+            return self.get(sha256=uploaded.sha256)
+
+class Blob(models.Model):
+    """Stored file content, once per SHA-256 however often it is sent"""
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    # As declared by the first uploader
+    content_type = models.CharField(max_length=100)
+    file = models.FileField(max_length=255)
+    # Filled in by the make_thumbnails job for images
+    thumbnail = models.FileField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    objects = BlobManager()
+    
+    @property
+    def is_image(self):
+        return self.content_type in IMAGE_TYPES
+    
+    def __str__(self):
+        return self.sha256
+
+class Attachment(models.Model):
+    """A file sent to a conversation; only its participants may download it"""
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, related_name='attachments')
+    conversation_key = models.CharField(max_length=41, db_index=True)
+    uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name='attachments')
+    name = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def summary(self):
+        """What messages keep of the attachment (Message.attachment)"""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'size': self.blob.size,
+            'content_type': self.blob.content_type,
+            'is_image': self.blob.is_image,
+        }
+    
+    def __str__(self):
+        return self.name
+
+class Job(models.Model):
+    """A deferred side effect, run by the worker (see app.tasks)"""
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    # Set while a worker holds the job; an expired lease frees it for another
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    # Gave up after MESSENGER_TASKS_MAX_ATTEMPTS; kept for inspection
+    failed = models.BooleanField(default=False)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['failed', 'run_after'], name='app_job_due_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.name} job {self.id}"
+
+def _message_committed(message):
+    key = message.conversation_key
+    get_recent_messages().message_added(key, bump_conversation_version(key), message.to_record)
+
+# Cache invalidation runs after commit, so nothing cached under the new
+# version can predate the write
+@receiver(post_save, sender=Message)
+def update_summaries_on_message(sender, instance, created, using, **kwargs):
+    if created:
+        # Inbox rows and counters are left to the worker (app.tasks imports the models)
+        from .tasks import enqueue, message_payload
+        enqueue('record_messages', message_payload(instance))
+        transaction.on_commit(lambda: _message_committed(instance), using=using)
+    else:
+        transaction.on_commit(lambda: bump_conversation_version(instance.conversation_key), using=using)
+
+@receiver(post_delete, sender=Message)
+def invalidate_conversation_on_message_deleted(sender, instance, using, **kwargs):
+    transaction.on_commit(lambda: bump_conversation_version(instance.conversation_key), using=using)
+
+@receiver(post_save, sender=Contact)
+def update_summary_on_contact_added(sender, instance, created, **kwargs):
+    if created:
+        ConversationSummary.objects.set_contact(instance.user_id, instance.contact_user_id, True)
+
+@receiver(post_delete, sender=Contact)
+def update_summary_on_contact_removed(sender, instance, **kwargs):
+    if ConversationSummary.objects.filter(
+        user_id=instance.user_id, peer_id=instance.contact_user_id
+    ).update(is_contact=False):
+        ConversationSummary.objects.changed(instance.user_id)
+
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+def invalidate_members_on_membership_change(sender, instance, using, **kwargs):
+    # conversation_id is the conversation's key (to_field='key')
+    members_key = _members_cache_key(instance.conversation_id)
+    transaction.on_commit(lambda: cache.delete(members_key), using=using)
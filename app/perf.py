@@ -0,0 +1,233 @@
+"""
+Opt-in per-request performance instrumentation.
+
+With MESSENGER_PERF_INSTRUMENTATION on, PerformanceMiddleware times every
+request and splits it into SQL (through an execute wrapper on each thread's
+connections, which finds the request's recorder through a context variable,
+so ORM calls that async views run in sync_to_async threads are counted too),
+template rendering (through the TimedDjangoTemplates backend) and the rest.
+The split is sent back as a Server-Timing header, aggregated into rolling
+per-view histograms for the staff-only /api/perf/ endpoint, and repeated
+queries within one request (the usual N+1 signature) are logged with the
+line of application code that issued them.
+"""
+
+import contextvars
+import logging
+import re
+import threading
+import time
+import traceback
+from collections import Counter, deque
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.backends.django import DjangoTemplates, Template
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (ms) of the histogram buckets; the last bucket is open-ended
+HISTOGRAM_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+_current = contextvars.ContextVar('perf_recorder', default=None)
+# Parameter lists of any length are the same query shape
+_IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+
+
+class RequestRecorder:
+    """SQL and template timings collected during one request"""
+
+    def __init__(self, duplicate_threshold):
+        self.duplicate_threshold = duplicate_threshold
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.query_shapes = Counter()
+        self.duplicates = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - started
+            self.sql_count += 1
+            shape = _IN_LIST.sub('IN (...)', sql)
+            self.query_shapes[shape] += 1
+            if self.query_shapes[shape] == self.duplicate_threshold:
+                # Only walk the stack once a shape crosses the threshold
+                self.duplicates[shape] = _caller_location()
+
+
+def _record_query(execute, sql, params, many, context):
+    recorder = _current.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+def _install_query_recorder():
+    """Report queries on this thread's connections to the current request's recorder (idempotent)"""
+    for alias in connections:
+        wrappers = connections[alias].execute_wrappers
+        if _record_query not in wrappers:
+            wrappers.append(_record_query)
+
+
+def _caller_location():
+    """file:line of the innermost project frame (not Django, not installed packages, not this module)"""
+    project_dir = str(settings.BASE_DIR)
+    for frame in reversed(traceback.extract_stack()[:-2]):
+        filename = frame.filename
+        if filename.startswith(project_dir) and 'site-packages' not in filename and filename != __file__:
+            return f'{filename}:{frame.lineno} in {frame.name}'
+    return 'unknown location'
+
+
+class ViewStats:
+    """Rolling window of the last `window` requests of one view"""
+
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+        self.total_requests = 0
+
+    def add(self, total_ms, sql_ms, sql_count, template_ms):
+        self.samples.append((total_ms, sql_ms, sql_count, template_ms))
+        self.total_requests += 1
+
+    def summary(self):
+        totals = sorted(sample[0] for sample in self.samples)
+        count = len(totals)
+        buckets = Counter()
+        for total in totals:
+            bucket = next((f'le_{edge}' for edge in HISTOGRAM_BUCKETS if total <= edge), 'inf')
+            buckets[bucket] += 1
+        return {
+            'requests': self.total_requests,
+            'window': count,
+            'p50_ms': round(totals[(count - 1) // 2], 2),
+            'p90_ms': round(totals[int((count - 1) * 0.9)], 2),
+            'p99_ms': round(totals[int((count - 1) * 0.99)], 2),
+            'mean_sql_ms': round(sum(sample[1] for sample in self.samples) / count, 2),
+            'mean_sql_count': round(sum(sample[2] for sample in self.samples) / count, 2),
+            'mean_template_ms': round(sum(sample[3] for sample in self.samples) / count, 2),
+            'histogram_ms': {
+                **{f'le_{edge}': buckets[f'le_{edge}'] for edge in HISTOGRAM_BUCKETS},
+                'inf': buckets['inf'],
+            },
+        }
+
+
+_view_stats = {}
+_view_stats_lock = threading.Lock()
+
+
+def record_view(view_name, total_ms, sql_ms, sql_count, template_ms):
+    with _view_stats_lock:
+        stats = _view_stats.get(view_name)
+        if stats is None:
+            stats = _view_stats[view_name] = ViewStats(settings.MESSENGER_PERF_WINDOW)
+        stats.add(total_ms, sql_ms, sql_count, template_ms)
+
+
+def view_stats():
+    """{view name: rolling summary} for every view seen by this process"""
+    with _view_stats_lock:
+        return {name: stats.summary() for name, stats in sorted(_view_stats.items())}
+
+
+def reset_view_stats():
+    with _view_stats_lock:
+        _view_stats.clear()
+
+
+class PerformanceMiddleware:
+    """Server-Timing header, per-view histograms and a duplicate-query log
+
+    Disabled (removed from the chain at startup) unless
+    MESSENGER_PERF_INSTRUMENTATION is set. Place it first in MIDDLEWARE so
+    session and auth queries are counted too.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.MESSENGER_PERF_INSTRUMENTATION:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder = RequestRecorder(settings.MESSENGER_PERF_DUPLICATE_THRESHOLD)
+        token = _current.set(recorder)
+        started = time.perf_counter()
+        try:
+            _install_query_recorder()
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, recorder, started)
+
+    async def __acall__(self, request):
+        recorder = RequestRecorder(settings.MESSENGER_PERF_DUPLICATE_THRESHOLD)
+        token = _current.set(recorder)
+        started = time.perf_counter()
+        try:
+            # The ORM runs in the request's thread-sensitive executor, with that
+            # thread's connections: one hop to install the wrapper there
+            await sync_to_async(_install_query_recorder)()
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, recorder, started)
+
+    def _finish(self, request, response, recorder, started):
+        total_ms = (time.perf_counter() - started) * 1000
+        sql_ms = recorder.sql_time * 1000
+        template_ms = recorder.template_time * 1000
+
+        response['Server-Timing'] = ', '.join([
+            f'db;dur={sql_ms:.1f};desc="{recorder.sql_count} queries"',
+            f'tpl;dur={template_ms:.1f}',
+            f'app;dur={max(total_ms - sql_ms - template_ms, 0):.1f}',
+            f'total;dur={total_ms:.1f}',
+        ])
+
+        match = request.resolver_match
+        view_name = match.view_name if match else 'unresolved'
+        record_view(view_name, total_ms, sql_ms, recorder.sql_count, template_ms)
+        for shape, location in recorder.duplicates.items():
+            logger.warning(
+                'Possible N+1 in %s: query ran %d times in one request, from %s: %s',
+                view_name, recorder.query_shapes[shape], location, shape,
+            )
+        return response
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        recorder = _current.get()
+        if recorder is None:
+            return super().render(context, request)
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            recorder.template_time += time.perf_counter() - started
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """The stock Django template backend, with rendering time reported to PerformanceMiddleware"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return TimedTemplate(template.template, self)
@@ -0,0 +1,89 @@
+"""
+Presence: who is online right now, and when everyone was last seen.
+
+Online state is a TTL map in the Django cache: each heartbeat refreshes a
+short-lived key, so a closed tab simply expires. ``last_seen`` is only
+persisted in periodic bulk UPDATEs of the heartbeats this process received,
+never one profile save per request.
+"""
+
+import atexit
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, DateTimeField, Value, When
+
+from .models import UserProfile
+
+_pending_last_seen = {}
+_pending_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+
+def _key(user_id):
+    return f'presence:{user_id}'
+
+
+def heartbeat(user_id):
+    """Mark the user online for MESSENGER_PRESENCE_TTL seconds"""
+    now = time.time()
+    cache.set(_key(user_id), now, settings.MESSENGER_PRESENCE_TTL)
+    with _pending_lock:
+        _pending_last_seen[user_id] = now
+    maybe_flush()
+
+
+def mark_offline(user_id):
+    cache.delete(_key(user_id))
+    with _pending_lock:
+        _pending_last_seen[user_id] = time.time()
+    flush()
+
+
+def online_user_ids(user_ids):
+    """Subset of `user_ids` with a live heartbeat, in one cache round trip"""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return set()
+    found = cache.get_many([_key(user_id) for user_id in user_ids])
+    return {user_id for user_id in user_ids if _key(user_id) in found}
+
+
+async def aonline_user_ids(user_ids):
+    """online_user_ids for async views"""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return set()
+    found = await cache.aget_many([_key(user_id) for user_id in user_ids])
+    return {user_id for user_id in user_ids if _key(user_id) in found}
+
+
+def maybe_flush():
+    if time.monotonic() - _last_flush >= settings.MESSENGER_PRESENCE_FLUSH_INTERVAL:
+        flush()
+
+
+def flush():
+    """Write buffered last_seen values with a single UPDATE"""
+    global _last_flush
+    with _pending_lock:
+        pending = dict(_pending_last_seen)
+        _pending_last_seen.clear()
+        _last_flush = time.monotonic()
+    if not pending:
+        return
+
+    UserProfile.objects.filter(user_id__in=pending).update(last_seen=Case(
+        *[
+            When(user_id=user_id, then=Value(datetime.fromtimestamp(seen, tz=dt_timezone.utc)))
+            for user_id, seen in pending.items()
+        ],
+        output_field=DateTimeField(),
+    ))
+
+
+# Don't lose the last interval's heartbeats when a worker shuts down cleanly
+atexit.register(flush)
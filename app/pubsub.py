@@ -0,0 +1,182 @@
+"""
+Pub/sub layer used to push events to connected WebSocket sessions.
+
+Views publish to a user id; every socket that user has open receives the
+event. The broker class is configured with ``MESSENGER_BROKER``: the
+in-process one for a single worker, or RedisBroker, which reaches the
+sockets of every worker and is the default wherever REDIS_URL is set.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """One socket's inbox. Events are handed over from any thread."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+    def deliver(self, event):
+        # Publishers usually run in a sync view thread, never on this loop
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class BaseBroker:
+    """Interface every broker implements.
+
+    ``subscribe``/``unsubscribe`` are called from the socket's event loop,
+    ``publish`` may be called from any thread. A cross-process broker
+    forwards ``publish`` to its transport and calls ``deliver`` on local
+    subscriptions when the event comes back.
+    """
+
+    def subscribe(self, user_id):
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription):
+        raise NotImplementedError
+
+    def publish(self, user_id, event):
+        raise NotImplementedError
+
+
+class InProcessBroker(BaseBroker):
+    """Delivers only to sockets held by this process.
+
+    Enough for a single ASGI worker and for tests; with several workers use a
+    broker backed by shared infrastructure.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def subscribe(self, user_id):
+        subscription = Subscription(user_id)
+        with self._lock:
+            self._subscriptions[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            user_subscriptions = self._subscriptions.get(subscription.user_id)
+            if user_subscriptions is not None:
+                user_subscriptions.discard(subscription)
+                if not user_subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def publish(self, user_id, event):
+        with self._lock:
+            targets = list(self._subscriptions.get(user_id, ()))
+        for subscription in targets:
+            subscription.deliver(event)
+
+
+class RedisBroker(InProcessBroker):
+    """Delivers through Redis pub/sub, to sockets held by any process.
+
+    ``publish`` sends the event to the user's channel on
+    MESSENGER_BROKER_URL. Each process runs one listener thread, started by
+    its first socket, subscribed only to the channels of users with a socket
+    open here; it hands their events to those sockets. Events published
+    while Redis is unreachable are lost, and clients catch up by polling.
+    """
+
+    channel_prefix = 'messenger:user:'
+    # How long the listener waits for a message before applying (un)subscribes
+    poll_timeout = 0.2  # seconds
+
+    def __init__(self, client=None):
+        super().__init__()
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(settings.MESSENGER_BROKER_URL)
+        self._redis = client
+        self._listener = None
+        # Set when the users with local sockets change; the listener resubscribes
+        self._users_changed = threading.Event()
+
+    def _channel(self, user_id):
+        return f'{self.channel_prefix}{user_id}'
+
+    def subscribe(self, user_id):
+        subscription = super().subscribe(user_id)
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='messenger-broker', daemon=True)
+                self._listener.start()
+        self._users_changed.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        super().unsubscribe(subscription)
+        self._users_changed.set()
+
+    def publish(self, user_id, event):
+        self._redis.publish(self._channel(user_id), json.dumps(event))
+
+    def _sync_channels(self, pubsub, subscribed):
+        # The listener thread owns `pubsub`: redis-py's PubSub is not thread-safe
+        self._users_changed.clear()
+        with self._lock:
+            wanted = {self._channel(user_id) for user_id in self._subscriptions}
+        if wanted - subscribed:
+            pubsub.subscribe(*(wanted - subscribed))
+        if subscribed - wanted:
+            pubsub.unsubscribe(*(subscribed - wanted))
+        return wanted
+
+    def _listen(self):
+        while True:
+            pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+            subscribed = set()
+            try:
+                while True:
+                    if self._users_changed.is_set():
+                        subscribed = self._sync_channels(pubsub, subscribed)
+                    message = pubsub.get_message(timeout=self.poll_timeout)
+                    if message is None:
+                        continue
+                    channel = message['channel']
+                    user_id = int((channel.decode() if isinstance(channel, bytes) else channel).rsplit(':', 1)[1])
+                    super().publish(user_id, json.loads(message['data']))
+            except Exception:
+                # Whatever broke (connection, a bad payload), start over with a
+                # new connection subscribed to the current users
+                logger.exception('Redis broker listener failed; resubscribing')
+                self._users_changed.set()
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+                time.sleep(1)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """Return the process-wide broker configured by MESSENGER_BROKER"""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                broker_path = getattr(settings, 'MESSENGER_BROKER', 'app.pubsub.InProcessBroker')
+                _broker = import_string(broker_path)()
+    return _broker
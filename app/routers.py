@@ -0,0 +1,147 @@
+"""
+Database routing: read replicas for history and inbox reads, and optional
+sharding of conversation-scoped tables.
+
+Replicas (MESSENGER_REPLICA_DATABASES) serve reads of Message and
+ConversationSummary during safe (GET/HEAD) requests. Any write pins the
+user to the primary for MESSENGER_REPLICA_STICKY_SECONDS, so they always
+see their own messages and read marks.
+
+Shards (MESSENGER_MESSAGE_SHARDS) hold Message and ConversationRead rows,
+placed by a hash of the conversation key. Every query for one conversation
+hits one shard: use Message.objects.in_conversation(key) or
+message_db_for_key(key). Users, contacts and inbox summaries stay on the
+default database; shard tables have no foreign key constraints to them.
+"""
+
+import contextvars
+import random
+import zlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+
+# Models whose reads may be served by a replica
+REPLICA_MODELS = {'message', 'conversationsummary'}
+# Conversation-scoped models stored on the shards
+SHARDED_MODELS = {'message', 'conversationread'}
+
+_routing = contextvars.ContextVar('db_routing', default=None)
+
+
+class _RequestRouting:
+    def __init__(self, use_replicas):
+        self.use_replicas = use_replicas
+        self.wrote = False
+
+
+def message_db_for_key(key):
+    """Alias of the shard holding conversation `key`, or None when not sharding"""
+    shards = settings.MESSENGER_MESSAGE_SHARDS
+    if not shards:
+        return None
+    return shards[zlib.crc32(key.encode()) % len(shards)]
+
+
+def message_databases():
+    """Every alias that holds Message rows, for queries spanning conversations"""
+    return list(settings.MESSENGER_MESSAGE_SHARDS) or ['default']
+
+
+def _is_app_model(model, names):
+    return model._meta.app_label == 'app' and model._meta.model_name in names
+
+
+class MessengerRouter:
+    def _shard_or_default(self, model, hints):
+        if _is_app_model(model, SHARDED_MODELS):
+            key = getattr(hints.get('instance'), 'conversation_key', None)
+            return message_db_for_key(key) if key else None
+        # Everything else lives on default, even when reached from a sharded
+        # row (Django would otherwise follow message.sender to the shard)
+        return 'default'
+
+    def db_for_read(self, model, **hints):
+        state = _routing.get()
+        replicas = settings.MESSENGER_REPLICA_DATABASES
+        if replicas and state and state.use_replicas and not state.wrote and _is_app_model(model, REPLICA_MODELS):
+            if not (settings.MESSENGER_MESSAGE_SHARDS and _is_app_model(model, SHARDED_MODELS)):
+                return random.choice(replicas)
+        if settings.MESSENGER_MESSAGE_SHARDS:
+            return self._shard_or_default(model, hints)
+        return None
+
+    def db_for_write(self, model, **hints):
+        state = _routing.get()
+        if state:
+            # Later reads in this request, and the user's next few requests, use the primary
+            state.wrote = True
+        if settings.MESSENGER_MESSAGE_SHARDS:
+            return self._shard_or_default(model, hints)
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Sharded rows point at users that live on the default database
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in settings.MESSENGER_REPLICA_DATABASES:
+            # Replicas get their schema from the primary
+            return False
+        if db != 'default' and db in settings.MESSENGER_MESSAGE_SHARDS and app_label == 'app':
+            return model_name in SHARDED_MODELS
+        return None
+
+
+def _sticky_key(user_id):
+    return f'db-primary:{user_id}'
+
+
+class ReplicaRoutingMiddleware:
+    """Decides per request whether replica reads are allowed
+
+    Must come after AuthenticationMiddleware. Removed from the chain at
+    startup when no replicas are configured.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.MESSENGER_REPLICA_DATABASES:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        user_id = request.user.id if request.user.is_authenticated else None
+        sticky = user_id and cache.get(_sticky_key(user_id))
+        state = _RequestRouting(request.method in ('GET', 'HEAD') and not sticky)
+        token = _routing.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _routing.reset(token)
+        if state.wrote and user_id:
+            cache.set(_sticky_key(user_id), True, settings.MESSENGER_REPLICA_STICKY_SECONDS)
+        return response
+
+    async def __acall__(self, request):
+        user = await request.auser()
+        user_id = user.id if user.is_authenticated else None
+        sticky = user_id and await cache.aget(_sticky_key(user_id))
+        state = _RequestRouting(request.method in ('GET', 'HEAD') and not sticky)
+        # Context variables follow the request into the threads that run its queries
+        token = _routing.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _routing.reset(token)
+        if state.wrote and user_id:
+            await cache.aset(_sticky_key(user_id), True, settings.MESSENGER_REPLICA_STICKY_SECONDS)
+        return response
@@ -0,0 +1,338 @@
+"""
+Search helpers used by the API views.
+
+Message search runs against a full-text index that lives outside the ORM:
+an FTS5 table kept in sync by triggers on SQLite, and a generated tsvector
+column with a GIN index on Postgres. Both are created by migration 0006
+(and re-created by the rebuild_message_search command).
+"""
+
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.db import NotSupportedError, connections, router
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .exports import user_conversation_keys
+from .models import Message, UserProfile
+from .routers import message_databases, message_db_for_key
+
+
+class PrefixCache:
+    """Small in-process LRU of recent user-search results with a TTL.
+
+    A result list shorter than the search limit is complete, so a longer
+    query that extends a cached one can be answered by filtering it locally
+    (typing "alic" after "ali" costs no query). Only cached queries of at
+    least `min_reuse_length` characters are reused this way, since shorter
+    ones skipped the substring phase.
+    """
+
+    def __init__(self, max_entries, ttl, min_reuse_length):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.min_reuse_length = min_reuse_length
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query, limit):
+        now = time.monotonic()
+        with self._lock:
+            for end in range(len(query), 0, -1):
+                if end < len(query) and end < self.min_reuse_length:
+                    break
+                prefix = query[:end]
+                entry = self._entries.get(prefix)
+                if entry is None:
+                    continue
+                stored_at, results = entry
+                if now - stored_at > self.ttl:
+                    del self._entries[prefix]
+                    continue
+                if prefix == query:
+                    self._entries.move_to_end(prefix)
+                    return results
+                if len(results) < limit:
+                    return _rank([r for r in results if query in r['nickname'].lower()], query)
+                # A full page for a shorter prefix may have cut off matches
+                return None
+        return None
+
+    def set(self, query, results):
+        with self._lock:
+            self._entries[query] = (time.monotonic(), results)
+            self._entries.move_to_end(query)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _rank(results, query):
+    # Prefix matches first, then substring matches, each alphabetical
+    return sorted(results, key=lambda r: (not r['nickname'].lower().startswith(query), r['nickname'].lower()))
+
+
+# Shorter substrings cannot use a trigram index, only the prefix range
+MIN_SUBSTRING_QUERY = 3
+
+_user_search_cache = PrefixCache(
+    max_entries=getattr(settings, 'MESSENGER_USER_SEARCH_CACHE_SIZE', 256),
+    ttl=getattr(settings, 'MESSENGER_USER_SEARCH_CACHE_TTL', 30),
+    min_reuse_length=MIN_SUBSTRING_QUERY,
+)
+
+
+def _lookup_users(query, limit):
+    profiles = UserProfile.objects.only('user_id', 'nickname', 'avatar_emoji')
+
+    # Prefix match on the normalized column: an index range on every backend
+    # whatever its collation (app_profile_nick_prefix_idx, migration 0016)
+    found = list(profiles.filter(nickname_normalized__startswith=query).order_by('nickname_normalized')[:limit])
+    if len(found) < limit and len(query) >= MIN_SUBSTRING_QUERY:
+        found += profiles.filter(nickname_normalized__contains=query).exclude(
+            nickname_normalized__startswith=query
+        ).order_by('nickname_normalized')[:limit - len(found)]
+
+    return [
+        {'id': profile.user_id, 'nickname': profile.nickname, 'avatar_emoji': profile.avatar_emoji}
+        for profile in found
+    ]
+
+
+def search_users(query, exclude_user_id=None, limit=None):
+    """Users whose nickname starts with or contains `query`, at most `limit` of them"""
+    limit = limit or settings.MESSENGER_USER_SEARCH_LIMIT
+    query = query.strip().lower()
+    if not query:
+        return []
+
+    # One extra so excluding the requesting user still leaves a full page
+    fetch = limit + 1
+    results = None
+    if _user_search_cache.max_entries:
+        results = _user_search_cache.get(query, fetch)
+    if results is None:
+        results = _lookup_users(query, fetch)
+        if _user_search_cache.max_entries:
+            _user_search_cache.set(query, results)
+
+    return [r for r in results if r['id'] != exclude_user_id][:limit]
+
+
+# Highlight markers: control characters never typed by users, swapped for
+# <mark> only after the snippet has been HTML-escaped
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+SQLITE_CREATE_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS app_message_fts USING fts5("
+    "content, content='app_message', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS app_message_fts_ai AFTER INSERT ON app_message BEGIN "
+    "INSERT INTO app_message_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS app_message_fts_ad AFTER DELETE ON app_message BEGIN "
+    "INSERT INTO app_message_fts(app_message_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    # Only content edits touch the index; status updates do not
+    "CREATE TRIGGER IF NOT EXISTS app_message_fts_au AFTER UPDATE OF content ON app_message BEGIN "
+    "INSERT INTO app_message_fts(app_message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO app_message_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+SQLITE_DROP_INDEX = [
+    'DROP TRIGGER IF EXISTS app_message_fts_ai',
+    'DROP TRIGGER IF EXISTS app_message_fts_ad',
+    'DROP TRIGGER IF EXISTS app_message_fts_au',
+    'DROP TABLE IF EXISTS app_message_fts',
+]
+POSTGRES_CREATE_INDEX = [
+    "ALTER TABLE app_message ADD COLUMN IF NOT EXISTS search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED",
+    'CREATE INDEX IF NOT EXISTS app_message_search_idx ON app_message USING gin (search_vector)',
+]
+POSTGRES_DROP_INDEX = [
+    'DROP INDEX IF EXISTS app_message_search_idx',
+    'ALTER TABLE app_message DROP COLUMN IF EXISTS search_vector',
+]
+
+
+def _execute_all(db, statements):
+    with db.cursor() as cursor:
+        for statement in statements.get(db.vendor, []):
+            cursor.execute(statement)
+
+
+def create_message_index(db):
+    """Create the full-text index objects on connection `db` (idempotent)"""
+    _execute_all(db, {'sqlite': SQLITE_CREATE_INDEX, 'postgresql': POSTGRES_CREATE_INDEX})
+
+
+def drop_message_index(db):
+    _execute_all(db, {'sqlite': SQLITE_DROP_INDEX, 'postgresql': POSTGRES_DROP_INDEX})
+
+
+def rebuild_message_index():
+    """Repopulate the full-text index from app_message, on every database holding messages"""
+    for alias in message_databases():
+        db = connections[alias]
+        create_message_index(db)
+        with db.cursor() as cursor:
+            if db.vendor == 'sqlite':
+                cursor.execute("INSERT INTO app_message_fts(app_message_fts) VALUES ('rebuild')")
+            elif db.vendor == 'postgresql':
+                # The generated column is always current; only the index can bloat
+                cursor.execute('REINDEX INDEX app_message_search_idx')
+
+
+def _fts5_query(query):
+    """Quote each term so user input is never parsed as FTS5 syntax; the last term matches as a prefix"""
+    terms = ['"%s"' % term.replace('"', '""') for term in query.split()]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+# Filled in with the conversations to search ({conversations}) and, past
+# the first page, the keyset condition ({after})
+SQLITE_SEARCH = f"""
+    SELECT m.id, snippet(app_message_fts, 0, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}', '…', 12),
+        bm25(app_message_fts)
+    FROM app_message_fts
+    JOIN app_message m ON m.id = app_message_fts.rowid
+    WHERE app_message_fts MATCH %s AND m.conversation_key IN ({{conversations}}){{after}}
+    ORDER BY bm25(app_message_fts), m.id DESC
+    LIMIT %s
+"""
+
+POSTGRES_SEARCH = f"""
+    SELECT m.id, ts_headline('simple', m.content, q,
+        'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, MaxWords=24, MinWords=8, ShortWord=1'),
+        -ts_rank(m.search_vector, q)
+    FROM app_message m, websearch_to_tsquery('simple', %s) q
+    WHERE m.search_vector @@ q AND m.conversation_key IN ({{conversations}}){{after}}
+    ORDER BY ts_rank(m.search_vector, q) DESC, m.id DESC
+    LIMIT %s
+"""
+
+SEARCH_RANK = {'sqlite': 'bm25(app_message_fts)', 'postgresql': '-ts_rank(m.search_vector, q)'}
+
+# Rows ranked after the cursor: a worse rank, or the same rank and an older id
+SEARCH_AFTER = ' AND ({rank} > %s OR ({rank} = %s AND m.id {op} %s))'
+
+MEMBERSHIP_KEYS = 'SELECT conversation_id FROM app_membership WHERE user_id = %s'
+
+
+def matching_messages(queryset, query):
+    """`queryset` narrowed to messages whose content matches `query`, through the full-text index"""
+    db = connections[queryset.db]
+    if db.vendor == 'sqlite':
+        matches = RawSQL('SELECT rowid FROM app_message_fts WHERE app_message_fts MATCH %s', [_fts5_query(query)])
+    elif db.vendor == 'postgresql':
+        matches = RawSQL(
+            "SELECT id FROM app_message WHERE search_vector @@ websearch_to_tsquery('simple', %s)", [query]
+        )
+    else:
+        raise NotSupportedError(f'Message search is not available on {db.vendor}')
+    return queryset.filter(id__in=matches)
+
+
+def _highlight(snippet):
+    html = escape(snippet).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>')
+    return mark_safe(html)
+
+
+def _search_database(alias, user, query, limit, keys=None, after=None):
+    """(sort key, alias, message id, snippet) rows from one database, best first
+    
+    Searches the conversations `keys`, or every conversation the user is a
+    member of when the database also holds the memberships. `after` is a
+    parsed cursor; only rows that sort after it are returned.
+    """
+    db = connections[alias]
+    if db.vendor == 'sqlite':
+        sql, match = SQLITE_SEARCH, _fts5_query(query)
+    elif db.vendor == 'postgresql':
+        sql, match = POSTGRES_SEARCH, query
+    else:
+        raise NotSupportedError(f'Message search is not available on {db.vendor}')
+
+    if keys is None:
+        conversations, params = MEMBERSHIP_KEYS, [match, user.id]
+    else:
+        conversations, params = ', '.join(['%s'] * len(keys)), [match, *keys]
+    condition = ''
+    if after is not None:
+        rank, message_id, after_alias = after
+        # Rows of the same rank and id on a later shard still sort after the cursor
+        condition = SEARCH_AFTER.format(rank=SEARCH_RANK[db.vendor], op='<=' if alias > after_alias else '<')
+        params += [rank, rank, message_id]
+
+    with db.cursor() as cursor:
+        cursor.execute(sql.format(conversations=conversations, after=condition), [*params, limit])
+        # Both queries return a rank where lower is better
+        return [(rank, -message_id, alias, message_id, snippet) for message_id, snippet, rank in cursor.fetchall()]
+
+
+def _parse_cursor(cursor):
+    """(rank, message id, alias) from a `next_cursor` value, or None if it is malformed"""
+    try:
+        rank, message_id, alias = (cursor or '').split(':', 2)
+        return float(rank), int(message_id), alias
+    except ValueError:
+        return None
+
+
+def _format_cursor(row):
+    rank, _, alias, message_id, _ = row
+    return f'{rank!r}:{message_id}:{alias}'
+
+
+def search_messages(user, query, cursor=None, per_page=None):
+    """Ranked full-text search over the conversations `user` is a member of
+    
+    Returns (results, next_cursor); each result holds the Message and an
+    HTML-safe highlighted snippet, and `next_cursor` (None on the last page)
+    fetches the page after them. Pages are keyset-paged on (rank, id), so
+    every page costs the same. With sharded messages each shard is searched
+    for its own conversations and the results merged by rank.
+    """
+    per_page = per_page or settings.MESSENGER_MESSAGE_SEARCH_PAGE_SIZE
+    query = query.strip()
+    if not query:
+        return [], None
+
+    after = _parse_cursor(cursor)
+    if not settings.MESSENGER_MESSAGE_SHARDS:
+        alias = router.db_for_read(Message) or 'default'
+        if after is not None:
+            # Any replica continues the cursor: the alias only orders shards
+            after = (*after[:2], alias)
+        rows = _search_database(alias, user, query, per_page + 1, after=after)
+    else:
+        # Memberships live on default only, so each shard gets its keys as parameters
+        keys_by_db = defaultdict(list)
+        for key in user_conversation_keys(user.id):
+            keys_by_db[message_db_for_key(key)].append(key)
+        rows = sorted(
+            row for alias, keys in keys_by_db.items()
+            for row in _search_database(alias, user, query, per_page + 1, keys, after)
+        )
+
+    next_cursor = _format_cursor(rows[per_page - 1]) if len(rows) > per_page else None
+    rows = rows[:per_page]
+    messages = {}
+    for alias in {row[2] for row in rows}:
+        found = Message.objects.using(alias).with_profiles('sender', 'receiver').in_bulk(
+            [row[3] for row in rows if row[2] == alias]
+        )
+        messages.update({(alias, message_id): msg for message_id, msg in found.items()})
+    results = [
+        {'message': messages[alias, message_id], 'snippet': _highlight(snippet)}
+        for _, _, alias, message_id, snippet in rows
+        if (alias, message_id) in messages
+    ]
+    return results, next_cursor
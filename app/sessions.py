@@ -0,0 +1,119 @@
+"""
+Request-scoped user loading.
+
+Django's AuthenticationMiddleware fetches the User on first access to
+request.user, and every later `request.user.userprofile` is another query.
+SessionUserMiddleware replaces that with one joined User + UserProfile
+query, and keeps the result in the Django cache so most requests need no
+query at all. The cached user is still checked against the session's auth
+hash on every request, so a password change logs other sessions out as
+before; saving a User or UserProfile drops the cached copy (see the signals
+in app.models).
+"""
+
+from functools import partial
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.utils.crypto import constant_time_compare
+from django.utils.functional import SimpleLazyObject
+
+
+def _cache_key(user_id):
+    return f'session-user:{user_id}'
+
+
+def invalidate_session_user(user_id):
+    cache.delete(_cache_key(user_id))
+
+
+def _model_backend(user_id, session_hash, backend_path):
+    """The ModelBackend a plain password login was made with, or None for
+    anything django.contrib.auth should handle itself"""
+    if user_id is None or not session_hash or backend_path not in settings.AUTHENTICATION_BACKENDS:
+        return None
+    backend = auth.load_backend(backend_path)
+    return backend if isinstance(backend, ModelBackend) else None
+
+
+def _verified(user, backend, session_hash):
+    return backend.user_can_authenticate(user) and constant_time_compare(session_hash, user.get_session_auth_hash())
+
+
+def get_user(request):
+    """request.user, with its profile, from the cache or a single query
+
+    Anything unusual (no session hash, a custom backend, a hash that only a
+    fallback secret verifies) goes through django.contrib.auth.get_user,
+    which knows how to re-sign or flush the session.
+    """
+    session = request.session
+    user_id = session.get(auth.SESSION_KEY)
+    session_hash = session.get(auth.HASH_SESSION_KEY)
+    backend = _model_backend(user_id, session_hash, session.get(auth.BACKEND_SESSION_KEY))
+    if backend is None:
+        return auth.get_user(request)
+
+    key = _cache_key(user_id)
+    user = cache.get(key)
+    if user is None:
+        user = User.objects.select_related('userprofile').filter(pk=user_id).first()
+        if user is None:
+            return auth.get_user(request)
+        cache.set(key, user, settings.MESSENGER_SESSION_USER_TTL)
+
+    if not _verified(user, backend, session_hash):
+        return auth.get_user(request)
+    return user
+
+
+async def _aget_user(request):
+    session = request.session
+    user_id = await session.aget(auth.SESSION_KEY)
+    session_hash = await session.aget(auth.HASH_SESSION_KEY)
+    backend = _model_backend(user_id, session_hash, await session.aget(auth.BACKEND_SESSION_KEY))
+    if backend is None:
+        return await auth.aget_user(request)
+
+    key = _cache_key(user_id)
+    user = await cache.aget(key)
+    if user is None:
+        user = await User.objects.select_related('userprofile').filter(pk=user_id).afirst()
+        if user is None:
+            return await auth.aget_user(request)
+        await cache.aset(key, user, settings.MESSENGER_SESSION_USER_TTL)
+
+    if not _verified(user, backend, session_hash):
+        return await auth.aget_user(request)
+    return user
+
+
+async def aget_user(request):
+    """get_user for async views (as request.auser()), using the async session,
+    cache and ORM APIs; the user also becomes request.user, so sync code called
+    later in the request doesn't load it again"""
+    if not hasattr(request, '_acached_user'):
+        request._acached_user = await _aget_user(request)
+        request.user = request._acached_user
+    return request._acached_user
+
+
+class SessionUserMiddleware:
+    """Lazily loads request.user through get_user; place right after AuthenticationMiddleware"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        request.user = SimpleLazyObject(lambda: get_user(request))
+        request.auser = partial(aget_user, request)
+        return self.get_response(request)
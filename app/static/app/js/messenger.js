@@ -1,11 +1,28 @@
 class Messenger {
     constructor() {
         this.currentContactId = null;
+        this.currentConversationId = null;
         this.messagesContainer = null;
         this.messageInput = null;
         this.sendButton = null;
         this.refreshInterval = null;
-        this.lastMessageCount = 0;
+        this.syncCursor = null;
+        this.readUpTo = 0;
+        this.deliveredUpTo = 0;
+        this.pendingAcks = new Map();
+        this.ackedUpTo = new Map();
+        this.ackTimer = null;
+        this.readSentUpTo = new Map();
+        this.readTimer = null;
+        this.hasOlder = false;
+        this.isLoadingOlder = false;
+        this.socket = null;
+        this.socketRetryDelay = 1000;
+        this.isDestroyed = false;
+        this.presenceInterval = null;
+        this.sidebarRefreshTimer = null;
+        this.unreadInterval = null;
+        this.baseTitle = document.title;
         this.notificationSound = null;
         this.hasNotificationPermission = false;
         this.isMobile = window.innerWidth <= 768;
@@ -18,8 +35,13 @@ class Messenger {
         this.initTheme();
         this.initMessageInput();
         this.initContactSelection();
+        this.initContactSearch();
         this.initAutoRefresh();
+        this.initRealtime();
+        this.initPresence();
+        this.initUnreadBadge();
         this.initSendMessage();
+        this.initAttachments();
         this.initNotifications();
         this.initMobileFeatures();
         this.initSoundNotification();
@@ -31,9 +53,8 @@ class Messenger {
         if (!this.isMobile) return;
         
         const urlParams = new URLSearchParams(window.location.search);
-        const contactId = urlParams.get('contact_id');
         
-        if (contactId) {
+        if (urlParams.get('contact_id') || urlParams.get('conversation_id')) {
             this.showChatScreen();
         } else {
             this.showContactsScreen();
@@ -47,9 +68,10 @@ class Messenger {
         this.mobileState = 'contacts';
         document.body.classList.remove('mobile-chat-active');
         
-        // Update URL without contact_id
+        // Update URL without contact_id or conversation_id
         const url = new URL(window.location);
         url.searchParams.delete('contact_id');
+        url.searchParams.delete('conversation_id');
         window.history.replaceState({}, '', url);
     }
     
@@ -116,51 +138,444 @@ class Messenger {
     }
     
     initContactSelection() {
-        const contactItems = document.querySelectorAll('.contact-item');
         const urlParams = new URLSearchParams(window.location.search);
         this.currentContactId = urlParams.get('contact_id');
+        this.currentConversationId = urlParams.get('conversation_id');
+        this.markActiveContact();
         
-        contactItems.forEach(item => {
-            const contactId = item.getAttribute('href')?.split('contact_id=')[1];
+        // Delegated, so it keeps working after refreshSidebar() replaces the list
+        document.querySelector('.chat-sidebar')?.addEventListener('click', (e) => {
+            const item = e.target.closest('.contact-item');
+            if (!item) return;
             
-            if (contactId === this.currentContactId) {
-                item.classList.add('active');
+            e.preventDefault();
+            const href = item.getAttribute('href');
+            // Group entries carry a conversation id, direct chats the peer's user id
+            const target = item.dataset.conversationId
+                ? { conversation_id: item.dataset.conversationId }
+                : { contact_id: item.dataset.userId };
+            
+            if (this.isMobile) {
+                // In mobile, show chat screen immediately
+                
+                // Update URL
+                const url = new URL(window.location);
+                url.search = new URLSearchParams(target);
+                window.history.pushState({}, '', url);
+                
+                // Show chat screen
+                this.showChatScreen();
+                
+                // Navigate to the chat
+                window.location.href = href;
+            } else {
+                // Desktop behavior: swap the conversation pane in place
+                this.openConversation(target, href);
+            }
+        });
+        
+        // Panes swapped in by openConversation have no page of their own to go back to
+        window.addEventListener('popstate', () => window.location.reload());
+    }
+    
+    markActiveContact() {
+        document.querySelectorAll('.contact-item').forEach(item => {
+            item.classList.toggle('active', item.dataset.conversationId
+                ? item.dataset.conversationId === this.currentConversationId
+                : !this.currentConversationId && item.dataset.userId === this.currentContactId);
+        });
+    }
+    
+    // The open chat as API parameters: { contact_id }, { conversation_id } for a group, or null
+    currentTarget() {
+        if (this.currentConversationId) return { conversation_id: this.currentConversationId };
+        if (this.currentContactId) return { contact_id: this.currentContactId };
+        return null;
+    }
+    
+    isCurrentChat(event) {
+        return event.conversation_id
+            ? String(event.conversation_id) === this.currentConversationId
+            : !this.currentConversationId && String(event.contact_id) === this.currentContactId;
+    }
+    
+    // CONVERSATION PANE - fetched as an HTML fragment instead of reloading the page
+    async openConversation(target, href) {
+        try {
+            const response = await fetch(`/chat/conversation/?${new URLSearchParams(target)}`);
+            if (!response.ok) throw new Error('Failed to load conversation');
+            document.querySelector('.chat-main').innerHTML = await response.text();
+        } catch (error) {
+            console.error('Error loading conversation:', error);
+            window.location.href = href;
+            return;
+        }
+        
+        window.history.pushState({}, '', href);
+        this.currentContactId = target.contact_id ? String(target.contact_id) : null;
+        this.currentConversationId = target.conversation_id ? String(target.conversation_id) : null;
+        this.markActiveContact();
+        this.initConversationPane();
+        // Opening it may have cleared an unread badge
+        this.refreshSidebar();
+    }
+    
+    initConversationPane() {
+        this.initMessageInput();
+        this.initSendMessage();
+        this.initAttachments();
+        this.readUpTo = 0;
+        this.deliveredUpTo = 0;
+        this.messagesContainer = document.querySelector('.messages-container');
+        this.syncCursor = this.messagesContainer?.dataset.syncCursor || null;
+        this.initHistoryPaging();
+        
+        this.stopMessageRefresh();
+        if (!this.socket || this.socket.readyState !== WebSocket.OPEN) {
+            this.startMessageRefresh();
+        }
+        this.scrollToBottom();
+    }
+    
+    // SIDEBAR - re-fetch the contact list fragment; unchanged lists come back as 304s
+    refreshSidebar() {
+        // Bursts of events (several incoming messages) cost one request
+        if (this.sidebarRefreshTimer) return;
+        this.sidebarRefreshTimer = setTimeout(async () => {
+            this.sidebarRefreshTimer = null;
+            const list = document.querySelector('.contacts-list');
+            if (!list) return;
+            
+            try {
+                const params = new URLSearchParams(this.currentTarget() || {});
+                const response = await fetch(`/chat/sidebar/?${params}`);
+                if (!response.ok) throw new Error('Failed to refresh contacts');
+                list.outerHTML = await response.text();
+            } catch (error) {
+                console.error('Error refreshing contacts:', error);
+            }
+            this.refreshUnread();
+        }, 250);
+    }
+    
+    // UNREAD BADGE - total unread in the tab title; unchanged counts come back as 304s
+    initUnreadBadge() {
+        if (!document.querySelector('.chat-container')) return;
+        
+        this.refreshUnread();
+        // Socket events already refresh it; polling only covers a dropped socket
+        this.unreadInterval = setInterval(() => {
+            if (!this.socket || this.socket.readyState !== WebSocket.OPEN) {
+                this.refreshUnread();
             }
+        }, 30000);
+    }
+    
+    async refreshUnread() {
+        try {
+            const response = await fetch('/api/unread/');
+            if (!response.ok) throw new Error('Failed to fetch unread counts');
             
-            item.addEventListener('click', (e) => {
-                if (this.isMobile) {
-                    // In mobile, show chat screen immediately
-                    e.preventDefault();
-                    
-                    const href = item.getAttribute('href');
-                    const contactId = href.split('contact_id=')[1];
-                    
-                    // Update URL
-                    const url = new URL(window.location);
-                    url.searchParams.set('contact_id', contactId);
-                    window.history.pushState({}, '', url);
-                    
-                    // Show chat screen
-                    this.showChatScreen();
+            const data = await response.json();
+            document.title = data.total ? `(${data.total}) ${this.baseTitle}` : this.baseTitle;
+        } catch (error) {
+            console.error('Error refreshing unread counts:', error);
+        }
+    }
+    
+    // ADD CONTACT - nickname typeahead backed by /api/users/search/
+    initContactSearch() {
+        const form = document.querySelector('.add-contact-form');
+        const input = form?.querySelector('.contact-search-input');
+        if (!input) return;
+        
+        const selectedId = form.querySelector('[name="contact_user"]');
+        const resultsList = form.querySelector('.contact-search-results');
+        let debounceTimer = null;
+        let requestSeq = 0;
+        
+        const hideResults = () => {
+            resultsList.hidden = true;
+            resultsList.innerHTML = '';
+        };
+        
+        const pick = (user) => {
+            selectedId.value = user.id;
+            input.value = user.nickname;
+            hideResults();
+        };
+        
+        input.addEventListener('input', () => {
+            selectedId.value = '';
+            clearTimeout(debounceTimer);
+            
+            const query = input.value.trim();
+            if (!query) {
+                hideResults();
+                return;
+            }
+            
+            debounceTimer = setTimeout(async () => {
+                const seq = ++requestSeq;
+                try {
+                    const response = await fetch(`/api/users/search/?${new URLSearchParams({ q: query })}`);
+                    if (!response.ok) throw new Error('Failed to search users');
                     
-                    // Navigate to the chat
-                    window.location.href = href;
-                } else {
-                    // Desktop behavior
-                    contactItems.forEach(c => c.classList.remove('active'));
-                    item.classList.add('active');
+                    const data = await response.json();
+                    // A newer keystroke already fired its own request
+                    if (seq !== requestSeq) return;
+                    this.renderContactResults(resultsList, data.results, pick);
+                } catch (error) {
+                    console.error('Error searching users:', error);
                 }
-            });
+            }, 200);
+        });
+        
+        form.addEventListener('submit', (e) => {
+            if (selectedId.value) return;
+            
+            // Enter without picking: take the top match if there is one
+            const first = resultsList.querySelector('li[data-user-id]');
+            if (first) {
+                selectedId.value = first.dataset.userId;
+            } else {
+                e.preventDefault();
+                input.focus();
+            }
+        });
+        
+        document.addEventListener('click', (e) => {
+            if (!form.contains(e.target)) {
+                hideResults();
+            }
         });
     }
     
+    renderContactResults(resultsList, users, onPick) {
+        resultsList.innerHTML = '';
+        
+        if (!users.length) {
+            const empty = document.createElement('li');
+            empty.textContent = 'No users found';
+            resultsList.appendChild(empty);
+        }
+        
+        users.forEach(user => {
+            const item = document.createElement('li');
+            item.dataset.userId = user.id;
+            item.textContent = `${user.avatar_emoji} ${user.nickname}`;
+            item.addEventListener('click', () => onPick(user));
+            resultsList.appendChild(item);
+        });
+        
+        resultsList.hidden = false;
+    }
+    
     initAutoRefresh() {
-        if (this.currentContactId) {
+        if (this.currentTarget()) {
             this.messagesContainer = document.querySelector('.messages-container');
+            // The page render already contains everything up to this cursor
+            this.syncCursor = this.messagesContainer?.dataset.syncCursor || null;
+            this.initHistoryPaging();
             this.startMessageRefresh();
         }
     }
     
+    // HISTORY PAGING - fetch older pages when scrolled to the top
+    initHistoryPaging() {
+        if (!this.messagesContainer) return;
+        
+        this.hasOlder = this.messagesContainer.dataset.hasOlder === 'true';
+        
+        this.messagesContainer.addEventListener('scroll', () => {
+            if (this.messagesContainer.scrollTop < 100) {
+                this.loadOlderMessages();
+            }
+        });
+        
+        this.messagesContainer.addEventListener('click', (e) => {
+            if (e.target.closest('.load-older')) {
+                e.preventDefault();
+                this.loadOlderMessages();
+            }
+        });
+    }
+    
+    async loadOlderMessages() {
+        if (!this.hasOlder || this.isLoadingOlder) return;
+        
+        const oldest = this.messagesContainer.querySelector('.message');
+        if (!oldest) return;
+        
+        this.isLoadingOlder = true;
+        try {
+            const params = new URLSearchParams({
+                ...this.currentTarget(),
+                before_id: oldest.dataset.messageId
+            });
+            const response = await fetch(`/api/messages/?${params}`);
+            if (!response.ok) throw new Error('Failed to fetch older messages');
+            
+            const data = await response.json();
+            const fragment = document.createDocumentFragment();
+            data.messages.forEach(msg => {
+                fragment.appendChild(this.createMessageElement(msg));
+            });
+            
+            // Keep the viewport anchored on what the user was reading
+            const previousHeight = this.messagesContainer.scrollHeight;
+            oldest.before(fragment);
+            this.messagesContainer.scrollTop += this.messagesContainer.scrollHeight - previousHeight;
+            
+            this.setHasOlder(data.has_more);
+            this.applyReadWatermark(data.read_up_to);
+        } catch (error) {
+            console.error('Error loading older messages:', error);
+        } finally {
+            this.isLoadingOlder = false;
+        }
+    }
+    
+    setHasOlder(hasOlder) {
+        this.hasOlder = hasOlder;
+        let link = this.messagesContainer.querySelector('.load-older');
+        
+        if (!hasOlder) {
+            link?.remove();
+            return;
+        }
+        if (!link) {
+            link = document.createElement('a');
+            link.className = 'load-older';
+            link.href = '#';
+            link.textContent = 'Load older messages';
+            this.messagesContainer.prepend(link);
+        }
+    }
+    
+    newestMessageId() {
+        const rendered = this.messagesContainer.querySelectorAll('.message');
+        return rendered.length ? Number(rendered[rendered.length - 1].dataset.messageId) : 0;
+    }
+    
+    // REAL-TIME DELIVERY - WebSocket push, polling only while the socket is down
+    initRealtime() {
+        if (!('WebSocket' in window)) return;
+        this.connectSocket();
+    }
+    
+    connectSocket() {
+        const scheme = window.location.protocol === 'https:' ? 'wss' : 'ws';
+        this.socket = new WebSocket(`${scheme}://${window.location.host}/ws/`);
+        
+        this.socket.addEventListener('open', () => {
+            this.socketRetryDelay = 1000;
+            this.stopMessageRefresh();
+            // Catch up on anything sent while we were polling or disconnected
+            this.refreshMessages();
+        });
+        
+        this.socket.addEventListener('message', (e) => {
+            this.handleSocketEvent(JSON.parse(e.data));
+        });
+        
+        this.socket.addEventListener('close', () => {
+            this.socket = null;
+            if (this.isDestroyed) return;
+            
+            if (this.currentTarget() && !this.refreshInterval) {
+                this.startMessageRefresh();
+            }
+            setTimeout(() => this.connectSocket(), this.socketRetryDelay);
+            this.socketRetryDelay = Math.min(this.socketRetryDelay * 2, 30000);
+        });
+    }
+    
+    handleSocketEvent(event) {
+        if (event.type === 'read' || event.type === 'delivered') {
+            if (!this.isCurrentChat(event)) return;
+            if (event.conversation_id) {
+                // One member's receipt; a poll returns the lowest watermark among them
+                this.refreshMessages();
+            } else if (event.type === 'read') {
+                this.applyReadWatermark(event.read_up_to);
+            } else {
+                this.applyDeliveredWatermark(event.delivered_up_to);
+            }
+            return;
+        }
+        if (event.type !== 'message') return;
+        
+        if (!event.message.is_mine) {
+            const target = event.conversation_id
+                ? { conversation_id: String(event.conversation_id) }
+                : { contact_id: String(event.contact_id) };
+            this.queueAck(target, event.message.id);
+        }
+        // New last-message preview, and an unread badge unless it is this chat
+        this.refreshSidebar();
+        if (this.messagesContainer && this.isCurrentChat(event)) {
+            this.applyMessageDelta([event.message]);
+            this.queueRead();
+        } else if (!event.message.is_mine) {
+            // Message in another chat: alert only
+            this.playNotificationSound();
+            this.showDesktopNotification(event.message);
+        }
+    }
+    
+    // PRESENCE - heartbeats keep us online; one batch call refreshes sidebar dots
+    initPresence() {
+        if (!document.querySelector('.chat-container')) return;
+        
+        this.sendHeartbeat();
+        this.presenceInterval = setInterval(() => {
+            // Hidden tabs stop heartbeating and drop offline when the TTL expires
+            if (document.visibilityState === 'visible') {
+                this.sendHeartbeat();
+                this.refreshPresence();
+            }
+        }, 25000);
+        
+        document.addEventListener('visibilitychange', () => {
+            if (document.visibilityState === 'visible') {
+                this.sendHeartbeat();
+                this.refreshPresence();
+                // Messages that arrived while the tab was hidden are seen now
+                this.queueRead();
+            }
+        });
+    }
+    
+    sendHeartbeat() {
+        fetch('/api/presence/heartbeat/', {
+            method: 'POST',
+            headers: { 'X-CSRFToken': this.getCSRFToken() }
+        }).catch(error => console.error('Error sending heartbeat:', error));
+    }
+    
+    async refreshPresence() {
+        const items = document.querySelectorAll('.contact-item[data-user-id]');
+        if (!items.length) return;
+        
+        const ids = Array.from(items, item => item.dataset.userId);
+        try {
+            const response = await fetch(`/api/presence/?ids=${ids.join(',')}`);
+            if (!response.ok) throw new Error('Failed to fetch presence');
+            
+            const data = await response.json();
+            const online = new Set(data.online.map(String));
+            items.forEach(item => {
+                const indicator = item.querySelector('.online-indicator');
+                if (indicator) {
+                    indicator.hidden = !online.has(item.dataset.userId);
+                }
+            });
+        } catch (error) {
+            console.error('Error refreshing presence:', error);
+        }
+    }
+    
     startMessageRefresh() {
         // Refresh messages every 3 seconds
         this.refreshInterval = setInterval(() => {
@@ -176,14 +591,34 @@ class Messenger {
     }
     
     async refreshMessages() {
-        if (!this.currentContactId || !this.messagesContainer) return;
+        const target = this.currentTarget();
+        if (!target || !this.messagesContainer) return;
         
         try {
-            const response = await fetch(`/api/messages/?contact_id=${this.currentContactId}`);
+            const params = new URLSearchParams(target);
+            if (this.syncCursor) {
+                params.set('cursor', this.syncCursor);
+            }
+            
+            const response = await fetch(`/api/messages/?${params}`);
             if (!response.ok) throw new Error('Failed to fetch messages');
             
             const data = await response.json();
-            this.updateMessagesDisplay(data.messages);
+            if (data.is_delta) {
+                this.applyMessageDelta(data.messages);
+            } else {
+                this.updateMessagesDisplay(data.messages);
+                this.setHasOlder(data.has_more);
+            }
+            this.syncCursor = data.cursor;
+            this.applyReadWatermark(data.read_up_to);
+            this.applyDeliveredWatermark(data.delivered_up_to);
+            
+            const received = data.messages.filter(msg => !msg.is_mine).map(msg => msg.id);
+            if (received.length) {
+                this.queueAck(target, Math.max(...received));
+            }
+            this.queueRead();
         } catch (error) {
             console.error('Error refreshing messages:', error);
         }
@@ -320,60 +755,250 @@ class Messenger {
         }
     }
     
+    // Latest page (no usable cursor): replace everything
     updateMessagesDisplay(messages) {
-        const currentMessages = this.messagesContainer.querySelectorAll('.message');
-        
-        // Check for new messages and play sound/show notification
-        if (messages.length > this.lastMessageCount && this.lastMessageCount > 0) {
-            const newMessages = messages.slice(this.lastMessageCount);
-            newMessages.forEach(msg => {
-                if (!msg.is_mine) {
-                    this.playNotificationSound();
-                    this.showDesktopNotification(msg);
-                }
-            });
-        }
+        this.messagesContainer.innerHTML = '';
         
-        this.lastMessageCount = messages.length;
+        messages.forEach(msg => {
+            const messageEl = this.createMessageElement(msg);
+            this.messagesContainer.appendChild(messageEl);
+        });
         
-        // Only update if message count has changed
-        if (messages.length !== currentMessages.length) {
-            this.messagesContainer.innerHTML = '';
+        this.scrollToBottom();
+    }
+    
+    // Delta since the last cursor: append new messages, patch status of known ones
+    applyMessageDelta(messages) {
+        let appended = false;
+        const newestId = this.newestMessageId();
+        
+        messages.forEach(msg => {
+            const existing = this.messagesContainer.querySelector(`[data-message-id="${msg.id}"]`);
+            if (existing) {
+                const statusEl = existing.querySelector('.message-status');
+                if (statusEl) {
+                    statusEl.innerHTML = this.statusIcon(msg.status);
+                }
+                return;
+            }
+            // Status change of an older message that was never loaded
+            if (msg.id < newestId) return;
             
-            messages.forEach(msg => {
-                const messageEl = this.createMessageElement(msg);
-                this.messagesContainer.appendChild(messageEl);
-            });
+            this.messagesContainer.appendChild(this.createMessageElement(msg));
+            appended = true;
             
+            if (!msg.is_mine) {
+                this.playNotificationSound();
+                this.showDesktopNotification(msg);
+            }
+        });
+        
+        if (appended) {
             this.scrollToBottom();
         }
     }
     
+    // The contact has read everything up to this id: mark our messages read
+    applyReadWatermark(readUpTo) {
+        if (!readUpTo || !this.messagesContainer) return;
+        this.readUpTo = Math.max(this.readUpTo, readUpTo);
+        
+        this.messagesContainer.querySelectorAll('.message.sent[data-message-id]').forEach(el => {
+            const statusEl = el.querySelector('.message-status');
+            if (statusEl && Number(el.dataset.messageId) <= this.readUpTo) {
+                statusEl.innerHTML = this.statusIcon('read');
+            }
+        });
+    }
+    
+    applyDeliveredWatermark(deliveredUpTo) {
+        if (!deliveredUpTo || !this.messagesContainer) return;
+        this.deliveredUpTo = Math.max(this.deliveredUpTo, deliveredUpTo);
+        
+        this.messagesContainer.querySelectorAll('.message.sent[data-message-id]').forEach(el => {
+            const statusEl = el.querySelector('.message-status');
+            // Only single ticks: a read receipt is never downgraded
+            if (statusEl?.querySelector('.fa-check') && Number(el.dataset.messageId) <= this.deliveredUpTo) {
+                statusEl.innerHTML = this.statusIcon('delivered');
+            }
+        });
+    }
+    
+    // DELIVERY RECEIPTS - one ack per conversation per burst, covering everything up to its newest message
+    queueAck(target, messageId) {
+        const key = JSON.stringify(target);
+        // Polls return the same page until something changes; ack it once
+        if (messageId <= (this.ackedUpTo.get(key) || 0)) return;
+        this.pendingAcks.set(key, Math.max(this.pendingAcks.get(key) || 0, messageId));
+        if (this.ackTimer) return;
+        this.ackTimer = setTimeout(() => this.flushAcks(), 500);
+    }
+    
+    flushAcks() {
+        this.ackTimer = null;
+        const acks = this.pendingAcks;
+        this.pendingAcks = new Map();
+        
+        acks.forEach((messageId, key) => {
+            this.ackedUpTo.set(key, messageId);
+            const ack = { ...JSON.parse(key), message_id: messageId };
+            if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+                this.socket.send(JSON.stringify({ type: 'ack', ...ack }));
+                return;
+            }
+            fetch('/api/messages/ack/', {
+                method: 'POST',
+                headers: { 'X-CSRFToken': this.getCSRFToken() },
+                body: new URLSearchParams(ack)
+            }).catch(error => console.error('Error acknowledging messages:', error));
+        });
+    }
+    
+    // READ RECEIPTS - what arrives in the open chat while the tab is visible is read, one call per burst
+    queueRead() {
+        if (!this.currentTarget() || !this.messagesContainer || document.visibilityState !== 'visible') return;
+        if (this.readTimer) return;
+        this.readTimer = setTimeout(() => this.flushRead(), 500);
+    }
+    
+    flushRead() {
+        this.readTimer = null;
+        const target = this.currentTarget();
+        if (!target || !this.messagesContainer) return;
+        const received = this.messagesContainer.querySelectorAll('.message.received[data-message-id]');
+        if (!received.length) return;
+        const key = JSON.stringify(target);
+        const messageId = Number(received[received.length - 1].dataset.messageId);
+        if (messageId <= (this.readSentUpTo.get(key) || 0)) return;
+        this.readSentUpTo.set(key, messageId);
+        fetch(target.conversation_id ? '/api/groups/read/' : '/api/messages/read/', {
+            method: 'POST',
+            headers: { 'X-CSRFToken': this.getCSRFToken() },
+            body: new URLSearchParams({ ...target, message_id: messageId })
+        }).then(() => this.refreshSidebar())
+          .catch(error => console.error('Error marking messages read:', error));
+    }
+    
+    statusIcon(status) {
+        if (status === 'read') {
+            return '<i class="fas fa-check-double" style="color: var(--primary-color);"></i>';
+        }
+        if (status === 'delivered') {
+            return '<i class="fas fa-check-double"></i>';
+        }
+        return '<i class="fas fa-check"></i>';
+    }
+    
     createMessageElement(message) {
         const messageDiv = document.createElement('div');
         messageDiv.className = `message ${message.is_mine ? 'sent' : 'received'}`;
+        messageDiv.dataset.messageId = message.id;
         
         const bubbleDiv = document.createElement('div');
         bubbleDiv.className = 'message-bubble';
         
-        const contentP = document.createElement('p');
-        contentP.className = 'message-content';
-        contentP.textContent = message.content;
+        if (this.currentConversationId && !message.is_mine) {
+            const senderDiv = document.createElement('div');
+            senderDiv.className = 'message-sender';
+            senderDiv.textContent = message.sender;
+            bubbleDiv.appendChild(senderDiv);
+        }
+        
+        if (message.attachment) {
+            bubbleDiv.appendChild(this.createAttachmentElement(message.attachment));
+        }
         
         const timeDiv = document.createElement('div');
         timeDiv.className = 'message-time';
         timeDiv.innerHTML = `
             ${message.timestamp}
-            ${message.is_mine ? `<span class="message-status">✓</span>` : ''}
+            ${message.is_mine ? `<span class="message-status">${this.statusIcon(message.status)}</span>` : ''}
         `;
         
-        bubbleDiv.appendChild(contentP);
+        // A file sent without a caption carries its name, already shown above
+        if (!message.attachment || message.content !== message.attachment.name) {
+            const contentP = document.createElement('p');
+            contentP.className = 'message-content';
+            contentP.textContent = message.content;
+            bubbleDiv.appendChild(contentP);
+        }
         bubbleDiv.appendChild(timeDiv);
         messageDiv.appendChild(bubbleDiv);
         
         return messageDiv;
     }
     
+    createAttachmentElement(attachment) {
+        const attachmentDiv = document.createElement('div');
+        attachmentDiv.className = 'message-attachment';
+        
+        const link = document.createElement('a');
+        link.href = attachment.url;
+        if (attachment.thumbnail_url) {
+            link.target = '_blank';
+            const img = document.createElement('img');
+            img.src = attachment.thumbnail_url;
+            img.alt = attachment.name;
+            img.loading = 'lazy';
+            // No thumbnail (yet): show the original
+            img.onerror = () => {
+                img.onerror = null;
+                img.src = attachment.url;
+            };
+            link.appendChild(img);
+        } else {
+            link.download = '';
+            link.innerHTML = '<i class="fas fa-paperclip"></i> ';
+            link.appendChild(document.createTextNode(`${attachment.name} (${formatFileSize(attachment.size)})`));
+        }
+        attachmentDiv.appendChild(link);
+        return attachmentDiv;
+    }
+    
+    // ATTACHMENTS - a picked file is sent right away, with any typed text as its caption
+    initAttachments() {
+        const fileInput = document.querySelector('.attachment-input');
+        if (!fileInput) return;
+        
+        fileInput.addEventListener('change', () => {
+            const file = fileInput.files[0];
+            fileInput.value = '';
+            if (file) this.uploadAttachment(file);
+        });
+    }
+    
+    async uploadAttachment(file) {
+        const target = this.currentTarget();
+        if (!target) return;
+        
+        const caption = this.messageInput ? this.messageInput.value.trim() : '';
+        const formData = new FormData();
+        // Fields before the file, so the server has them before the upload streams in
+        Object.entries(target).forEach(([name, value]) => formData.append(name, value));
+        formData.append('content', caption);
+        formData.append('file', file);
+        
+        try {
+            const response = await fetch('/api/attachments/', {
+                method: 'POST',
+                body: formData,
+                headers: { 'X-CSRFToken': this.getCSRFToken() }
+            });
+            const data = await response.json();
+            if (!response.ok) throw new Error(data.error || 'Failed to send file');
+            
+            if (caption && this.messageInput.value.trim() === caption) {
+                this.messageInput.value = '';
+            }
+            this.applyMessageDelta([data.message]);
+            this.queueRead();
+            this.refreshSidebar();
+        } catch (error) {
+            console.error('Error sending file:', error);
+            showNotification(error.message, 'error');
+        }
+    }
+    
     initSendMessage() {
         if (this.sendButton) {
             this.sendButton.addEventListener('click', (e) => {
@@ -393,7 +1018,7 @@ class Messenger {
     }
     
     sendMessage() {
-        if (!this.messageInput || !this.messageInput.value.trim()) return;
+        if (!this.messageInput || !this.messageInput.value.trim() || !this.currentTarget()) return;
         
         const content = this.messageInput.value.trim();
         this.messageInput.value = '';
@@ -403,35 +1028,58 @@ class Messenger {
             this.sendButton.disabled = true;
         }
         
-        // Create form data
+        // Same key on every retry, so the server stores the message only once
+        const idempotencyKey = window.crypto && crypto.randomUUID
+            ? crypto.randomUUID()
+            : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+        
+        this.postMessage(content, idempotencyKey)
+            .then(data => {
+                // The response carries the stored message: no history refetch
+                this.applyMessageDelta([data.message]);
+                // Replying reads the backlog, as the old reload after a send did
+                this.queueRead();
+                this.refreshSidebar();
+            })
+            .catch(error => {
+                console.error('Error sending message:', error);
+                // Give the text back rather than losing it
+                if (!this.messageInput.value) {
+                    this.messageInput.value = content;
+                }
+            })
+            .finally(() => {
+                if (this.sendButton) {
+                    this.sendButton.disabled = false;
+                }
+            });
+    }
+    
+    async postMessage(content, idempotencyKey, attempts = 3) {
         const formData = new FormData();
+        Object.entries(this.currentTarget()).forEach(([name, value]) => formData.append(name, value));
         formData.append('content', content);
-        formData.append('csrfmiddlewaretoken', this.getCSRFToken());
+        formData.append('idempotency_key', idempotencyKey);
         
-        // Send message via AJAX
-        fetch(window.location.href, {
-            method: 'POST',
-            body: formData,
-            headers: {
-                'X-Requested-With': 'XMLHttpRequest'
-            }
-        })
-        .then(response => {
-            if (response.ok) {
-                // Immediately refresh messages to show the new message
-                this.refreshMessages();
-            } else {
-                console.error('Failed to send message');
-            }
-        })
-        .catch(error => {
-            console.error('Error sending message:', error);
-        })
-        .finally(() => {
-            if (this.sendButton) {
-                this.sendButton.disabled = false;
+        for (let attempt = 1; ; attempt++) {
+            try {
+                const response = await fetch('/api/messages/send/', {
+                    method: 'POST',
+                    body: formData,
+                    headers: { 'X-CSRFToken': this.getCSRFToken() }
+                });
+                // Client errors won't get better on retry
+                if (response.ok || response.status < 500) {
+                    const data = await response.json();
+                    if (!response.ok) throw new Error(data.error || 'Failed to send message');
+                    return data;
+                }
+                if (attempt >= attempts) throw new Error('Failed to send message');
+            } catch (error) {
+                if (attempt >= attempts || !(error instanceof TypeError)) throw error;
             }
-        });
+            await new Promise(resolve => setTimeout(resolve, 500 * attempt));
+        }
     }
     
     getCSRFToken() {
@@ -465,7 +1113,17 @@ class Messenger {
     
     // Public method to clean up when leaving the page
     destroy() {
+        this.isDestroyed = true;
         this.stopMessageRefresh();
+        if (this.presenceInterval) {
+            clearInterval(this.presenceInterval);
+        }
+        if (this.unreadInterval) {
+            clearInterval(this.unreadInterval);
+        }
+        if (this.socket) {
+            this.socket.close();
+        }
     }
 }
 
@@ -484,6 +1142,17 @@ function showNotification(message, type = 'info') {
     }, 5000);
 }
 
+function formatFileSize(bytes) {
+    const units = ['B', 'KB', 'MB', 'GB'];
+    let size = bytes;
+    let unit = 0;
+    while (size >= 1024 && unit < units.length - 1) {
+        size /= 1024;
+        unit++;
+    }
+    return `${unit ? size.toFixed(1) : size} ${units[unit]}`;
+}
+
 function formatTime(date) {
     return date.toLocaleTimeString('en-US', {
         hour: '2-digit',
@@ -0,0 +1,37 @@
+"""
+WhiteNoise for both the WSGI and the ASGI server profile.
+
+WhiteNoiseMiddleware is synchronous only, and Django runs a synchronous
+middleware, together with everything behind it, in a worker thread for the
+whole request: under ASGI that would tie up a thread per request again,
+which is what the async views avoid. This subclass is async-capable. It
+looks up static files without blocking and serves them the same way.
+"""
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from whitenoise import middleware
+
+
+class WhiteNoiseMiddleware(middleware.WhiteNoiseMiddleware):
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = self.find_file(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
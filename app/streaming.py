@@ -0,0 +1,37 @@
+"""
+Streaming response bodies that stay streaming under both server profiles.
+
+Under WSGI a StreamingHttpResponse is iterated block by block as the client
+reads it. Under ASGI, Django can only stream an asynchronous iterator: a
+synchronous one is read to the end with sync_to_async(list) before the
+first byte goes out, which would hold a whole export or file in memory.
+`response_body` hands ASGI requests an async iterator that produces each
+block in the request's thread as the client takes it.
+"""
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+
+# Blocks read from files at a time under ASGI, each a hop to a thread
+FILE_BLOCK_SIZE = 64 * 1024
+
+
+def response_body(request, chunks):
+    """`chunks` (an iterable of bytes) as a streaming body for the server handling `request`"""
+    if not isinstance(request, ASGIRequest):
+        return chunks
+    return _aiterate(chunks)
+
+
+def file_body(request, filelike):
+    """The rest of an open file as a streaming body for the server handling `request`"""
+    return response_body(request, iter(lambda: filelike.read(FILE_BLOCK_SIZE), b''))
+
+
+async def _aiterate(chunks):
+    # Thread-sensitive, so every block runs in the request's thread: database
+    # cursors and connections opened by the iterator stay usable between blocks
+    next_chunk = sync_to_async(next)
+    iterator = iter(chunks)
+    while (chunk := await next_chunk(iterator, None)) is not None:
+        yield chunk
@@ -0,0 +1,159 @@
+"""
+Background jobs: side effects of a request that need not finish before it
+returns (inbox rows, unread counters, contact upserts, thumbnails).
+
+`enqueue(name, payload)` inserts a Job row in the caller's transaction, so a
+job exists exactly when the write that caused it committed. The worker
+(`manage.py run_worker`) claims due jobs in batches and hands each handler
+all of its jobs from a batch at once, so it can coalesce them: ten messages
+in one conversation become one inbox update. A handler's writes commit
+together with the deletion of its jobs; a failed job is retried with
+exponential backoff and kept as `failed` after MESSENGER_TASKS_MAX_ATTEMPTS.
+
+With MESSENGER_TASKS_EAGER the handler runs immediately instead, inside the
+caller's transaction, for development and tests without a worker.
+"""
+
+import logging
+import os
+import socket
+import traceback
+import uuid
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .attachments import make_thumbnail
+from .models import PREVIEW_LENGTH, Blob, Contact, Conversation, ConversationSummary, Job, Message
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+
+
+def task(name):
+    """Register a handler for jobs called `name`; it receives a list of payloads"""
+    def register(handler):
+        _handlers[name] = handler
+        return handler
+    return register
+
+
+def enqueue(name, payload):
+    """Schedule `name` with a JSON-serializable payload, or run it now when eager"""
+    if settings.MESSENGER_TASKS_EAGER:
+        _handlers[name]([payload])
+    else:
+        Job.objects.create(name=name, payload=payload)
+
+
+def worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+def claim(worker, batch_size, only=None, exclude=()):
+    """Lease up to `batch_size` due jobs to `worker`, oldest first
+
+    One conditional UPDATE hands each row to a single worker, so it works on
+    databases without SELECT ... SKIP LOCKED. `only` and `exclude` restrict
+    the job names, for jobs that must run where their files are.
+    """
+    now = timezone.now()
+    free = Q(locked_until__isnull=True) | Q(locked_until__lt=now)
+    due = Job.objects.filter(free, failed=False, run_after__lte=now).exclude(name__in=exclude)
+    if only:
+        due = due.filter(name__in=only)
+    ids = list(due.order_by('id').values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return []
+    Job.objects.filter(free, id__in=ids).update(
+        locked_by=worker, locked_until=now + timedelta(seconds=settings.MESSENGER_TASKS_LEASE)
+    )
+    return list(Job.objects.filter(id__in=ids, locked_by=worker).order_by('id'))
+
+
+def run_jobs(jobs):
+    """Run claimed jobs, each handler once with all of its payloads; returns how many succeeded
+
+    When a batch fails, its jobs are retried one by one so a single bad
+    payload doesn't hold back the rest.
+    """
+    by_name = {}
+    for job in jobs:
+        by_name.setdefault(job.name, []).append(job)
+
+    done = 0
+    for name, group in by_name.items():
+        if len(group) > 1 and _run(name, group):
+            done += len(group)
+            continue
+        for job in group:
+            if _run(name, [job]):
+                done += 1
+            else:
+                _failed(job)
+    return done
+
+
+def _run(name, jobs):
+    try:
+        with transaction.atomic():
+            _handlers[name]([job.payload for job in jobs])
+            Job.objects.filter(id__in=[job.id for job in jobs]).delete()
+    except Exception:
+        if len(jobs) == 1:
+            jobs[0].last_error = traceback.format_exc()
+        return False
+    return True
+
+
+def _failed(job):
+    job.attempts += 1
+    job.failed = job.attempts >= settings.MESSENGER_TASKS_MAX_ATTEMPTS
+    job.run_after = timezone.now() + timedelta(seconds=2 ** job.attempts)
+    job.locked_by, job.locked_until = '', None
+    job.save(update_fields=['attempts', 'failed', 'run_after', 'locked_by', 'locked_until', 'last_error'])
+    log = logger.error if job.failed else logger.warning
+    log('Job %s (%s) failed, attempt %s:\n%s', job.id, job.name, job.attempts, job.last_error)
+
+
+def message_payload(message):
+    """What the inbox handlers need of a new message, without reading it back from its shard"""
+    return {
+        'id': message.id,
+        'sender_id': message.sender_id,
+        'receiver_id': message.receiver_id,
+        'conversation_key': message.conversation_key,
+        'content': message.content[:PREVIEW_LENGTH],
+        'timestamp': message.timestamp.isoformat(),
+    }
+
+
+@task('record_messages')
+def record_messages(payloads):
+    """Inbox rows and unread counters: per user for direct chats, on the Conversation for groups"""
+    messages = [
+        Message(**dict(payload, timestamp=datetime.fromisoformat(payload['timestamp']))) for payload in payloads
+    ]
+    # Run eagerly, inside the send, the receiver cannot have read them yet
+    ConversationSummary.objects.record_messages(
+        [message for message in messages if message.receiver_id is not None],
+        check_read=not settings.MESSENGER_TASKS_EAGER,
+    )
+    Conversation.objects.record_messages([message for message in messages if message.receiver_id is None])
+
+
+@task('add_mutual_contacts')
+def add_mutual_contacts(payloads):
+    pairs = {tuple(sorted((payload['user_id'], payload['peer_id']))) for payload in payloads}
+    for user_id, peer_id in sorted(pairs):
+        Contact.objects.add_mutual(user_id, peer_id)
+
+
+@task('make_thumbnails')
+def make_thumbnails(payloads):
+    for blob in Blob.objects.filter(id__in={payload['blob_id'] for payload in payloads}, thumbnail=''):
+        make_thumbnail(blob)
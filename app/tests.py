@@ -1,3 +1,937 @@
-from django.test import TestCase
+import asyncio
+import io
+from importlib import import_module
+import queue
+import re
+import shutil
+import tempfile
+import warnings
+from datetime import timedelta
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncClient, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import perf, presence
+from .benchmark import QUERY_BUDGETS, run_benchmark, seed_dataset
+from .caching import get_recent_messages
+from .checks import check_shared_broker
+from .exports import import_records
+from .models import (
+    Attachment, Blob, Contact, Conversation, ConversationRead, ConversationSummary, Job, Membership, Message,
+    UserProfile, conversation_key,
+)
+from .pubsub import InProcessBroker, RedisBroker
+from .routers import message_db_for_key
+from .search import _user_search_cache, search_users
+from .sessions import get_user
+from .tasks import claim, run_jobs
+from .views import encode_sync_cursor, send_group_message, send_message
+
+
+class MessengerTestCase(TransactionTestCase):
+    """Alice, Bob and Carol with empty caches, and the client logged in as Alice"""
+
+    def setUp(self):
+        cache.clear()
+        get_recent_messages().clear()
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+        self.carol = User.objects.create_user('carol', password='pw')
+        self.client.force_login(self.alice)
+
+
+class PerformanceBudgetTests(TransactionTestCase):
+    """Query-count budgets for the main views on seeded data
+
+    A TransactionTestCase, so on_commit cache write-through runs as in
+    production. Latency budgets are not asserted here since timings vary
+    from machine to machine; `python manage.py benchmark --fail-on-budget`
+    runs the same scenarios on a larger dataset and checks both.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        dataset = seed_dataset(users=40, contacts_per_user=6, messages_per_conversation=60)
+        cls.results = run_benchmark(dataset, iterations=10)
+
+    def test_query_budgets(self):
+        for name, budget in QUERY_BUDGETS.items():
+            with self.subTest(scenario=name):
+                self.assertLessEqual(self.results[name]['queries'], budget)
+
+
+class MessagesDeltaTests(MessengerTestCase):
+    """Polling /api/messages/ with a cursor returns every change since it"""
+
+    def poll(self, **params):
+        return self.client.get('/api/messages/', {'contact_id': self.bob.id, **params}).json()
+
+    def test_burst_larger_than_cached_page(self):
+        limit = settings.MESSENGER_PAGE_SIZE
+        for i in range(limit + 5):
+            send_message(self.bob, self.alice, f'old {i}')
+        self.poll()  # fills the recent-messages cache
+        key = conversation_key(self.alice.id, self.bob.id)
+        recent = get_recent_messages()
+        # As if the page had been cached a while before the client's last poll
+        entry = recent.get(key)
+        recent._store(key, entry.replace(entry.version, stored_at=entry.stored_at - 60))
+        cursor = encode_sync_cursor(timezone.now())
+
+        for i in range(limit + 10):
+            send_message(self.bob, self.alice, f'new {i}')
+        response = self.poll(cursor=cursor)
+
+        contents = [message['content'] for message in response['messages']]
+        if response['is_delta']:
+            self.assertEqual(contents, [f'new {i}' for i in range(limit + 10)])
+        else:
+            # Too many changes for a delta: the client starts over from the latest page
+            self.assertEqual(contents, [f'new {i}' for i in range(10, limit + 10)])
+            self.assertTrue(response['has_more'])
+
+    def test_small_delta_from_cache(self):
+        send_message(self.bob, self.alice, 'first')
+        cursor = self.poll()['cursor']
+        send_message(self.bob, self.alice, 'second')
+        response = self.poll(cursor=cursor)
+        self.assertTrue(response['is_delta'])
+        self.assertEqual([message['content'] for message in response['messages']][-1], 'second')
+
+    def test_quiet_conversation_sends_only_receipts(self):
+        message, _ = send_message(self.alice, self.bob, 'hi')
+        # Synced a while ago: the message is outside the SYNC_LAG window and not re-sent
+        Message.objects.update(updated_at=timezone.now() - timedelta(minutes=1))
+        get_recent_messages().clear()
+        cursor = encode_sync_cursor(timezone.now())
+        response = self.poll(cursor=cursor)
+        self.assertEqual((response['is_delta'], response['messages'], response['read_up_to']), (True, [], 0))
+
+        self.client.force_login(self.bob)
+        self.client.post('/api/messages/read/', {'contact_id': self.alice.id, 'message_id': message.id})
+        self.client.force_login(self.alice)
+        response = self.poll(cursor=cursor)
+        self.assertEqual((response['messages'], response['read_up_to']), ([], message.id))
+
+
+class ConversationSummaryTests(MessengerTestCase):
+    """The inbox table follows sends and contacts, and the rebuild command reproduces it from scratch"""
+
+    def inbox(self, user):
+        return list(ConversationSummary.objects.filter(user=user).order_by('-last_activity_at').values_list(
+            'peer__username', 'last_message_preview', 'last_message_is_mine', 'unread_count', 'is_contact',
+        ))
+
+    def test_send_and_rebuild(self):
+        self.client.post('/add-contact/', {'contact_user': self.carol.id})
+        send_message(self.bob, self.alice, 'hi')
+        send_message(self.bob, self.alice, 'are you there?')
+        expected = [('bob', 'are you there?', False, 2, True), ('carol', '', False, 0, True)]
+        self.assertEqual(self.inbox(self.alice), expected)
+
+        ConversationSummary.objects.all().delete()
+        call_command('rebuild_conversation_summaries', stdout=io.StringIO())
+        self.assertEqual(self.inbox(self.alice), expected)
+        self.assertEqual(self.inbox(self.bob), [('alice', 'are you there?', True, 0, True)])
+
+    def test_sidebar_newest_first(self):
+        send_message(self.bob, self.alice, 'hi')
+        send_message(self.carol, self.alice, 'hey')
+        cache.clear()
+        response = self.client.get('/chat/sidebar/')
+        self.assertEqual([summary.peer.username for summary in response.context['inbox']], ['carol', 'bob'])
+
+
+class ConversationKeyTests(MessengerTestCase):
+    """Both directions of a chat share one conversation_key, also for rows the 0004 backfill fills in"""
+
+    def test_both_directions(self):
+        first, _ = send_message(self.alice, self.bob, 'hi')
+        second, _ = send_message(self.bob, self.alice, 'hello')
+        self.assertEqual(first.conversation_key, second.conversation_key)
+        self.assertEqual(conversation_key(self.bob.id, self.alice.id), f'{self.alice.id}:{self.bob.id}')
+        key = first.conversation_key
+        self.assertEqual(list(Message.objects.in_conversation(key).order_by('id')), [first, second])
+
+    def test_backfill(self):
+        send_message(self.alice, self.bob, 'hi')
+        send_message(self.carol, self.alice, 'hey')
+        Message.objects.update(conversation_key='')
+        migration = import_module('app.migrations.0004_message_conversation_key')
+        with connection.schema_editor() as schema_editor:
+            migration.backfill_conversation_keys(apps, schema_editor)
+        self.assertEqual(
+            sorted(Message.objects.values_list('conversation_key', flat=True)),
+            sorted([conversation_key(self.alice.id, self.bob.id), conversation_key(self.alice.id, self.carol.id)]),
+        )
+
+
+@override_settings(MESSENGER_PAGE_SIZE=5)
+class HistoryPaginationTests(MessengerTestCase):
+    """Chat history comes in bounded pages, walked back with before_id"""
+
+    def setUp(self):
+        super().setUp()
+        self.ids = [send_message(self.bob, self.alice, f'message {i}')[0].id for i in range(8)]
+
+    def test_api_pages(self):
+        latest = self.client.get('/api/messages/', {'contact_id': self.bob.id}).json()
+        self.assertEqual([message['id'] for message in latest['messages']], self.ids[3:])
+        self.assertTrue(latest['has_more'])
+        older = self.client.get('/api/messages/', {'contact_id': self.bob.id, 'before_id': self.ids[3]}).json()
+        self.assertEqual([message['id'] for message in older['messages']], self.ids[:3])
+        self.assertFalse(older['has_more'])
+
+    def test_chat_page(self):
+        response = self.client.get('/chat/', {'contact_id': self.bob.id})
+        self.assertEqual([message.id for message in response.context['conversation']], self.ids[3:])
+        self.assertTrue(response.context['has_older'])
+        response = self.client.get('/chat/', {'contact_id': self.bob.id, 'before_id': self.ids[3]})
+        self.assertEqual([message.id for message in response.context['conversation']], self.ids[:3])
+        self.assertFalse(response.context['has_older'])
+
+
+class UserSearchTests(MessengerTestCase):
+    """Nickname typeahead: prefix matches first, then substrings, bounded and cached"""
+
+    def setUp(self):
+        super().setUp()
+        _user_search_cache.clear()
+        self.addCleanup(_user_search_cache.clear)
+        for user, nickname in ((self.alice, 'Alice'), (self.bob, 'Malice'), (self.carol, 'Alicia')):
+            user.userprofile.nickname = nickname
+            user.userprofile.save()
+
+    def test_prefix_before_substring(self):
+        response = self.client.get('/api/users/search/', {'q': 'ALI'})
+        # The requesting user is never suggested
+        self.assertEqual([result['nickname'] for result in response.json()['results']], ['Alicia', 'Malice'])
+        self.assertEqual([result['nickname'] for result in search_users('ali', limit=1)], ['Alice'])
+
+    def test_longer_query_from_cache(self):
+        search_users('ali')
+        with self.assertNumQueries(0):
+            self.assertEqual([result['nickname'] for result in search_users('alic')], ['Alice', 'Alicia', 'Malice'])
+
+
+@override_settings(MESSENGER_PRESENCE_FLUSH_INTERVAL=3600)
+class PresenceTests(MessengerTestCase):
+    """Heartbeats mark users online in the cache; last_seen reaches the database only in batched flushes"""
+
+    def setUp(self):
+        super().setUp()
+        presence.flush()
+
+    def last_seen(self, user):
+        return UserProfile.objects.get(user=user).last_seen
+
+    def test_heartbeat_then_flush(self):
+        before = self.last_seen(self.alice), self.last_seen(self.bob)
+        self.assertEqual(self.client.post('/api/presence/heartbeat/').status_code, 204)
+        self.client.force_login(self.bob)
+        self.client.post('/api/presence/heartbeat/')
+        response = self.client.get('/api/presence/', {'ids': f'{self.alice.id},{self.bob.id},{self.carol.id}'})
+        self.assertEqual(response.json()['online'], sorted([self.alice.id, self.bob.id]))
+        self.assertEqual((self.last_seen(self.alice), self.last_seen(self.bob)), before)
+
+        with self.assertNumQueries(1):
+            presence.flush()
+        self.assertGreater(self.last_seen(self.alice), before[0])
+        self.assertGreater(self.last_seen(self.bob), before[1])
+
+    def test_logout_goes_offline(self):
+        self.client.post('/api/presence/heartbeat/')
+        self.client.get('/logout/')
+        self.assertEqual(presence.online_user_ids([self.alice.id]), set())
+
+
+class MessagesETagTests(MessengerTestCase):
+    """Unchanged polls are answered 304 or from the cached body, without reading app_message"""
+
+    def get(self, **headers):
+        return self.client.get('/api/messages/', {'contact_id': self.bob.id}, headers=headers)
+
+    def message_queries(self, queries):
+        return [query['sql'] for query in queries if 'app_message' in query['sql']]
+
+    def test_not_modified_until_a_send(self):
+        send_message(self.bob, self.alice, 'hi')
+        first = self.get()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get(**{'If-None-Match': first['ETag']}).status_code, 304)
+            cached = self.get()
+        self.assertEqual(self.message_queries(queries), [])
+        self.assertEqual((cached.content, cached['ETag']), (first.content, first['ETag']))
+
+        send_message(self.bob, self.alice, 'again')
+        response = self.get(**{'If-None-Match': first['ETag']})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+        self.assertEqual(response.json()['messages'][-1]['content'], 'again')
+
+
+class SessionUserTests(MessengerTestCase):
+    """request.user and its profile come from one query, then from the cache until either changes"""
+
+    def request(self):
+        request = RequestFactory().get('/')
+        request.session = self.client.session
+        request.session.load()
+        return request
+
+    def test_one_query_then_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(get_user(self.request()).userprofile.user_id, self.alice.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user(self.request()).userprofile.user_id, self.alice.id)
+
+    def test_profile_update_drops_cached_user(self):
+        get_user(self.request())
+        self.client.post('/profile/', {'nickname': 'Ally', 'avatar_emoji': '🙂', 'theme_preference': 'light'})
+        self.assertEqual(get_user(self.request()).userprofile.nickname, 'Ally')
+
+    def test_password_change_logs_out(self):
+        get_user(self.request())
+        self.alice.set_password('new')
+        self.alice.save()
+        self.assertFalse(get_user(self.request()).is_authenticated)
+
+
+class ChatFragmentTests(MessengerTestCase):
+    """The sidebar and conversation pane render on their own; the sidebar is cached until the inbox changes"""
+
+    def test_sidebar_cached_per_inbox_version(self):
+        send_message(self.bob, self.alice, 'hi')
+        first = self.client.get('/chat/sidebar/')
+        self.assertTemplateUsed(first, 'app/chat_sidebar.html')
+        self.assertTemplateNotUsed(first, 'app/chat.html')
+        self.assertEqual(self.client.get('/chat/sidebar/', headers={'If-None-Match': first['ETag']}).status_code, 304)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get('/chat/sidebar/').content, first.content)
+        self.assertFalse([query for query in queries if 'app_conversationsummary' in query['sql']])
+
+        send_message(self.carol, self.alice, 'news from carol')
+        response = self.client.get('/chat/sidebar/', headers={'If-None-Match': first['ETag']})
+        self.assertContains(response, 'news from carol')
+
+    def test_conversation_pane(self):
+        send_message(self.bob, self.alice, 'hi')
+        response = self.client.get('/chat/conversation/', {'contact_id': self.bob.id})
+        self.assertTemplateUsed(response, 'app/chat_conversation.html')
+        self.assertTemplateNotUsed(response, 'app/chat_sidebar.html')
+        self.assertContains(response, 'hi')
+
+
+class IdempotentSendTests(MessengerTestCase):
+    """A retried send with the same idempotency_key returns the first message instead of storing another"""
+
+    def send(self, receiver, **data):
+        return self.client.post('/api/messages/send/', {'contact_id': receiver.id, 'content': 'hi', **data})
+
+    def test_retry_replays_first_message(self):
+        first = self.send(self.bob, idempotency_key='k1')
+        retry = self.send(self.bob, idempotency_key='k1', content='hi again')
+        self.assertEqual((first.status_code, retry.status_code), (201, 200))
+        self.assertFalse(retry.json()['created'])
+        self.assertEqual(retry.json()['message'], first.json()['message'])
+        self.assertEqual(Message.objects.filter(sender=self.alice).count(), 1)
+
+    def test_key_reused_for_another_conversation(self):
+        self.send(self.bob, idempotency_key='k1')
+        response = self.send(self.carol, idempotency_key='k1')
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(Message.objects.filter(receiver=self.carol).exists())
+
+    def test_sends_without_key_are_distinct(self):
+        self.assertEqual([self.send(self.bob).status_code for _ in range(2)], [201, 201])
+        self.assertEqual(Message.objects.filter(sender=self.alice).count(), 2)
+
+
+class UnreadCountTests(MessengerTestCase):
+    """Per-peer unread counters follow sends and reads, including reads that race queued jobs"""
+
+    def unread(self, user, peer):
+        return ConversationSummary.objects.get(user=user, peer=peer).unread_count
+
+    def test_reply_then_open(self):
+        send_message(self.bob, self.alice, 'hi')
+        send_message(self.alice, self.bob, 'hello back')
+        self.assertEqual(self.unread(self.alice, self.bob), 1)
+        self.client.get('/chat/', {'contact_id': self.bob.id})
+        self.assertEqual(self.unread(self.alice, self.bob), 0)
+        self.assertEqual(self.client.get('/api/unread/').json()['total'], 0)
+
+    def test_job_after_read(self):
+        # Queued: the inbox job runs on the worker, possibly after the reader opened the chat
+        with self.settings(MESSENGER_TASKS_EAGER=False):
+            send_message(self.bob, self.alice, 'one')
+            self.client.get('/chat/', {'contact_id': self.bob.id})
+            send_message(self.bob, self.alice, 'two')
+            run_jobs(claim('test', 100))
+        self.assertEqual(self.unread(self.alice, self.bob), 1)
+        self.assertEqual(self.client.get('/api/unread/').json()['total'], 1)
+        self.client.get('/chat/', {'contact_id': self.bob.id})
+        self.assertEqual(self.unread(self.alice, self.bob), 0)
+
+    def test_read_while_chat_open(self):
+        send_message(self.bob, self.alice, 'hi')
+        self.client.get('/chat/', {'contact_id': self.bob.id})
+        # Arrives by poll or socket while the chat is on screen
+        message, _ = send_message(self.bob, self.alice, 'still there?')
+        self.assertEqual(self.unread(self.alice, self.bob), 1)
+        response = self.client.post('/api/messages/read/', {'contact_id': self.bob.id, 'message_id': message.id + 1000})
+        self.assertEqual(response.json()['read_up_to'], message.id)
+        self.assertEqual(self.unread(self.alice, self.bob), 0)
+        self.client.force_login(self.bob)
+        messages = self.client.get('/api/messages/', {'contact_id': self.alice.id}).json()['messages']
+        self.assertEqual(messages[-1]['status'], 'read')
+
+    def test_read_needs_a_conversation(self):
+        for contact_id in (self.bob.id, self.alice.id):
+            response = self.client.post('/api/messages/read/', {'contact_id': contact_id, 'message_id': 1})
+            self.assertEqual(response.status_code, 404)
+
+    def test_unread_after_read_point_kept(self):
+        first, _ = send_message(self.bob, self.alice, 'one')
+        send_message(self.bob, self.alice, 'two')
+        send_message(self.alice, self.bob, 'reply')
+        ConversationSummary.objects.mark_read(self.alice, self.bob, first.id)
+        self.assertEqual(self.unread(self.alice, self.bob), 1)
+
+    def test_badge_counts_contacts_and_groups(self):
+        send_message(self.bob, self.alice, 'hi')
+        send_message(self.carol, self.alice, 'one')
+        send_message(self.carol, self.alice, 'two')
+        group = Conversation.objects.create_group(self.bob, 'team', [self.alice.id])
+        send_group_message(self.bob, group.id, 'hi all')
+        response = self.client.get('/api/unread/')
+        self.assertEqual(response.json(), {
+            'total': 4,
+            'contacts': {str(self.bob.id): 1, str(self.carol.id): 2},
+            'groups': {str(group.id): 1},
+        })
+        self.assertEqual(self.client.get('/api/unread/', headers={'If-None-Match': response['ETag']}).status_code, 304)
+
+    def test_reconcile_fixes_drift(self):
+        send_message(self.bob, self.alice, 'one')
+        send_message(self.bob, self.alice, 'two')
+        ConversationSummary.objects.filter(user=self.alice).update(unread_count=7)
+        ConversationSummary.objects.filter(user=self.bob).update(unread_count=1)
+        call_command('reconcile_unread_counts', stdout=io.StringIO())
+        self.assertEqual((self.unread(self.alice, self.bob), self.unread(self.bob, self.alice)), (2, 0))
+        self.assertEqual(self.client.get('/api/unread/').json()['total'], 2)
+
+
+class ReceiptTests(MessengerTestCase):
+    """Delivery and read receipts only move watermarks in the caller's conversations, up to their newest message"""
+
+    def test_ack_clamped_to_newest_message(self):
+        message, _ = send_message(self.bob, self.alice, 'hi')
+        response = self.client.post('/api/messages/ack/', {'contact_id': self.bob.id, 'message_id': message.id + 1000})
+        self.assertEqual(response.json()['delivered_up_to'], message.id)
+        read = ConversationRead.objects.get(user=self.alice, conversation_key=message.conversation_key)
+        self.assertEqual(read.last_delivered_message_id, message.id)
+
+    def test_ack_without_messages_stores_nothing(self):
+        for target in ({'contact_id': self.carol.id}, {'contact_id': self.alice.id}, {'conversation_id': 999}):
+            with self.subTest(**target):
+                response = self.client.post('/api/messages/ack/', {'message_id': 5, **target})
+                self.assertEqual(response.status_code, 404)
+        self.assertFalse(ConversationRead.objects.exists())
+
+    def test_group_read(self):
+        group = Conversation.objects.create_group(self.bob, 'team', [self.alice.id])
+        message, _ = send_group_message(self.bob, group.id, 'hi all')
+        response = self.client.post('/api/groups/read/', {'conversation_id': group.id, 'message_id': message.id + 1000})
+        self.assertEqual(response.json()['read_up_to'], message.id)
+
+        self.client.force_login(self.carol)
+        response = self.client.post('/api/groups/read/', {'conversation_id': group.id, 'message_id': message.id})
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(ConversationRead.objects.filter(user=self.carol).exists())
+
+
+class MessageSearchTests(MessengerTestCase):
+    """Search covers the user's direct and group conversations, paged by cursor"""
+
+    def search(self, **params):
+        return self.client.get('/api/messages/search/', {'q': 'report', **params}).json()
+
+    def test_direct_and_group_messages(self):
+        send_message(self.bob, self.alice, 'the report is ready')
+        send_message(self.bob, self.carol, 'report for carol only')
+        group = Conversation.objects.create_group(self.bob, 'team', [self.alice.id])
+        send_group_message(self.bob, group.id, 'group report attached')
+        other = Conversation.objects.create_group(self.bob, 'private', [self.carol.id])
+        send_group_message(self.bob, other.id, 'secret report')
+
+        results = self.search()['results']
+        self.assertEqual(
+            sorted(result['message']['content'] for result in results),
+            ['group report attached', 'the report is ready'],
+        )
+        self.assertEqual({result['group'] for result in results}, {'team', None})
+        response = self.client.get('/search/', {'q': 'report'})
+        self.assertContains(response, f'?conversation_id={group.id}')
+
+    def test_cursor_pages(self):
+        for i in range(5):
+            send_message(self.bob, self.alice, f'report {i}')
+        seen = []
+        cursor = None
+        with self.settings(MESSENGER_MESSAGE_SEARCH_PAGE_SIZE=2):
+            while True:
+                response = self.search(**({'cursor': cursor} if cursor else {}))
+                seen += [result['message']['content'] for result in response['results']]
+                cursor = response['next_cursor']
+                if cursor is None:
+                    break
+        self.assertEqual(sorted(seen), [f'report {i}' for i in range(5)])
+
+
+class GroupChatTests(MessengerTestCase):
+    """Groups are listed in the sidebar and open in the chat page, for their members only"""
+
+    def setUp(self):
+        super().setUp()
+        self.group = Conversation.objects.create_group(self.bob, 'team', [self.alice.id])
+
+    def test_sidebar_and_chat_page(self):
+        message, _ = send_group_message(self.bob, self.group.id, 'hi team')
+        sidebar = self.client.get('/chat/sidebar/')
+        self.assertContains(sidebar, f'data-conversation-id="{self.group.id}"')
+        self.assertContains(sidebar, 'team')
+
+        response = self.client.get('/chat/', {'conversation_id': self.group.id})
+        self.assertContains(response, 'hi team')
+        self.assertContains(response, '2 members')
+        # Opening the group reads it
+        read = ConversationRead.objects.get(user=self.alice, conversation_key=self.group.key)
+        self.assertEqual(read.last_read_message_id, message.id)
+
+        self.client.force_login(self.carol)
+        self.assertEqual(self.client.get('/chat/conversation/', {'conversation_id': self.group.id}).status_code, 404)
+
+    def test_membership_change_clears_members_without_a_query(self):
+        self.assertEqual(Conversation.objects.members(self.group.id)[1], {self.alice.id, self.bob.id})
+        with self.assertNumQueries(1):
+            Membership.objects.create(conversation_id=self.group.key, user=self.carol)
+        self.assertEqual(Conversation.objects.members(self.group.id)[1], {self.alice.id, self.bob.id, self.carol.id})
+
+
+@override_settings(MESSENGER_MESSAGE_SHARDS=['default', 'messages_1'])
+class ShardedMessageTests(TestCase):
+    """A conversation's messages and read marks live on the shard its key hashes to"""
+
+    databases = {'default', 'messages_1'}
+
+    def setUp(self):
+        cache.clear()
+        get_recent_messages().clear()
+        self.alice = User.objects.create_user('alice', password='pw')
+        # A peer whose conversation with alice is placed on the second shard
+        for i in range(20):
+            self.bob = User.objects.create_user(f'bob{i}', password='pw')
+            self.key = conversation_key(self.alice.id, self.bob.id)
+            if message_db_for_key(self.key) == 'messages_1':
+                break
+        self.assertEqual(message_db_for_key(self.key), 'messages_1')
+
+    def test_send_and_read_back(self):
+        message, created = send_message(self.bob, self.alice, 'hello from the shard')
+        self.assertTrue(created)
+        self.assertEqual(Message.objects.using('messages_1').get(id=message.id).content, 'hello from the shard')
+        self.assertFalse(Message.objects.using('default').filter(conversation_key=self.key).exists())
+        self.assertEqual(list(Message.objects.in_conversation(self.key).values_list('id', flat=True)), [message.id])
+
+        self.client.force_login(self.alice)
+        response = self.client.get('/api/messages/', {'contact_id': self.bob.id}).json()
+        self.assertEqual([item['content'] for item in response['messages']], ['hello from the shard'])
+        self.client.post('/api/messages/ack/', {'contact_id': self.bob.id, 'message_id': message.id})
+        self.assertTrue(ConversationRead.objects.using('messages_1').filter(
+            user=self.alice, conversation_key=self.key, last_delivered_message_id=message.id
+        ).exists())
+
+    def test_search_across_shards(self):
+        # And one whose conversation stays on the first
+        for i in range(20):
+            carol = User.objects.create_user(f'carol{i}', password='pw')
+            if message_db_for_key(conversation_key(self.alice.id, carol.id)) == 'default':
+                break
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(2):
+                send_message(self.bob, self.alice, f'report {i}')
+                send_message(carol, self.alice, f'report {i}')
+
+        self.client.force_login(self.alice)
+        seen, cursor = [], ''
+        with self.settings(MESSENGER_MESSAGE_SEARCH_PAGE_SIZE=1):
+            while cursor is not None:
+                response = self.client.get('/api/messages/search/', {'q': 'report', 'cursor': cursor}).json()
+                seen += [(result['contact'], result['message']['content']) for result in response['results']]
+                cursor = response['next_cursor']
+        self.assertEqual(sorted(seen), sorted((name, f'report {i}') for name in (carol.username, self.bob.username) for i in range(2)))
+
+
+@override_settings(MESSENGER_TASKS_EAGER=False, MESSENGER_TASKS_MAX_ATTEMPTS=2)
+class JobQueueTests(MessengerTestCase):
+    """A send only stores the message and its jobs; the worker applies them in batches and retries failures"""
+
+    def test_send_defers_side_effects(self):
+        for content in ('one', 'two', 'three'):
+            self.client.post('/api/messages/send/', {'contact_id': self.bob.id, 'content': content})
+        self.assertEqual(Message.objects.count(), 3)
+        self.assertFalse(ConversationSummary.objects.exists())
+        self.assertFalse(Contact.objects.exists())
+
+        jobs = claim('test', 100)
+        self.assertEqual(run_jobs(jobs), len(jobs))
+        self.assertFalse(Job.objects.exists())
+        summary = ConversationSummary.objects.get(user=self.bob, peer=self.alice)
+        self.assertEqual((summary.unread_count, summary.last_message_preview), (3, 'three'))
+        self.assertTrue(Contact.objects.filter(user=self.bob, contact_user=self.alice).exists())
+
+    def test_failed_job_retried_then_kept(self):
+        good = Job.objects.create(name='add_mutual_contacts', payload={'user_id': self.alice.id, 'peer_id': self.bob.id})
+        bad = Job.objects.create(name='add_mutual_contacts', payload={'user_id': None, 'peer_id': self.bob.id})
+        with self.assertLogs('app.tasks', 'WARNING'):
+            self.assertEqual(run_jobs(claim('test', 10)), 1)
+        self.assertFalse(Job.objects.filter(id=good.id).exists())
+        bad.refresh_from_db()
+        self.assertEqual((bad.attempts, bad.failed, bad.locked_by), (1, False, ''))
+        self.assertGreater(bad.run_after, timezone.now())
+
+        Job.objects.filter(id=bad.id).update(run_after=timezone.now())
+        with self.assertLogs('app.tasks', 'ERROR'):
+            run_jobs(claim('test', 10))
+        bad.refresh_from_db()
+        self.assertEqual((bad.attempts, bad.failed), (2, True))
+        self.assertEqual(claim('test', 10), [])
+
+
+class JobClaimTests(TestCase):
+    """Workers can split the queue by job name, so file jobs run where the files are"""
+
+    def test_only_and_exclude(self):
+        thumbnail = Job.objects.create(name='make_thumbnails', payload={'blob_id': 1})
+        inbox = Job.objects.create(name='record_messages', payload={})
+        self.assertEqual(claim('worker', 10, exclude=['make_thumbnails']), [inbox])
+        self.assertEqual(claim('web', 10, only=['make_thumbnails']), [thumbnail])
+        self.assertEqual(claim('other', 10), [])
+
+
+class BrokerTests(SimpleTestCase):
+    def test_publish_from_another_thread(self):
+        broker = InProcessBroker()
+
+        async def run():
+            subscription, other = broker.subscribe(1), broker.subscribe(2)
+            # Views publish from a worker thread, never the socket's event loop
+            await asyncio.to_thread(broker.publish, 1, {'type': 'message', 'id': 7})
+            event = await asyncio.wait_for(subscription.get(), 1)
+            broker.unsubscribe(subscription)
+            broker.publish(1, {'type': 'message', 'id': 8})
+            await asyncio.sleep(0)
+            return event, subscription.queue.empty(), other.queue.empty()
+
+        self.assertEqual(async_to_sync(run)(), ({'type': 'message', 'id': 7}, True, True))
+
+    def test_production_refuses_in_process_broker(self):
+        with self.settings(MESSENGER_REQUIRE_SHARED_CACHE=True):
+            self.assertEqual([error.id for error in check_shared_broker(None)], ['app.E003'])
+            with self.settings(MESSENGER_BROKER='app.pubsub.RedisBroker'):
+                self.assertEqual(check_shared_broker(None), [])
+
+
+class FakeRedis:
+    """Just enough of redis-py for RedisBroker: publish, and PubSub objects that see it"""
+
+    def __init__(self):
+        self.pubsubs = []
+
+    def pubsub(self, ignore_subscribe_messages):
+        pubsub = FakePubSub(self)
+        self.pubsubs.append(pubsub)
+        return pubsub
+
+    def publish(self, channel, data):
+        for pubsub in list(self.pubsubs):
+            if channel in pubsub.channels:
+                pubsub.messages.put({'type': 'message', 'channel': channel.encode(), 'data': data.encode()})
+
+
+class FakePubSub:
+    def __init__(self, redis):
+        self.redis = redis
+        self.channels = set()
+        self.messages = queue.Queue()
+
+    def subscribe(self, *channels):
+        self.channels.update(channels)
+
+    def unsubscribe(self, *channels):
+        self.channels.difference_update(channels)
+
+    def get_message(self, timeout):
+        try:
+            message = self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if isinstance(message, Exception):
+            raise message
+        return message
+
+    def close(self):
+        self.redis.pubsubs.remove(self)
+
+
+class RedisBrokerTests(SimpleTestCase):
+    """Each process subscribes only to the users it holds sockets for, and resubscribes after any error"""
+
+    def test_subscribes_per_user(self):
+        redis = FakeRedis()
+        broker = RedisBroker(redis)
+
+        async def until(condition):
+            for _ in range(100):
+                if condition():
+                    return
+                await asyncio.sleep(0.05)
+            self.fail('timed out')
+
+        def channels():
+            return [pubsub.channels for pubsub in redis.pubsubs]
+
+        async def run():
+            subscription = broker.subscribe(1)
+            await until(lambda: channels() == [{'messenger:user:1'}])
+            broker.publish(1, {'type': 'message', 'id': 7})
+            broker.publish(2, {'type': 'message', 'id': 8})
+            first = await asyncio.wait_for(subscription.get(), 1)
+
+            # A failure in the listener: a new connection picks up the same users
+            redis.pubsubs[0].messages.put(ValueError('bad payload'))
+            await until(lambda: len(redis.pubsubs) == 1 and redis.pubsubs[0].channels == {'messenger:user:1'}
+                        and redis.pubsubs[0].messages.empty())
+            broker.publish(1, {'type': 'message', 'id': 9})
+            second = await asyncio.wait_for(subscription.get(), 1)
+
+            broker.unsubscribe(subscription)
+            await until(lambda: channels() == [set()])
+            return first['id'], second['id'], subscription.queue.empty()
+
+        with self.assertLogs('app.pubsub', 'ERROR'):
+            self.assertEqual(async_to_sync(run)(), (7, 9, True))
+
+
+class AttachmentTests(MessengerTestCase):
+    """Attachments are stored once per content and served only to the conversation's participants"""
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        settings_override = self.settings(MEDIA_ROOT=media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, receiver, data, name='data.bin'):
+        response = self.client.post('/api/attachments/', {
+            'contact_id': receiver.id, 'file': SimpleUploadedFile(name, data),
+        })
+        self.assertEqual(response.status_code, 201)
+        return response.json()['message']['attachment']['url']
+
+    def test_same_content_stored_once(self):
+        self.upload(self.bob, b'same bytes', 'a.bin')
+        self.upload(self.carol, b'same bytes', 'b.bin')
+        self.assertEqual(Blob.objects.count(), 1)
+        self.assertEqual(Attachment.objects.count(), 2)
+
+    def test_range_request(self):
+        url = self.upload(self.bob, b'0123456789' * 100)
+        response = self.client.get(url, headers={'Range': 'bytes=5-14'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'5678901234')
+        self.assertEqual(response['Content-Range'], 'bytes 5-14/1000')
+
+    def test_only_participants_download(self):
+        url = self.upload(self.bob, b'private')
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.client.force_login(self.carol)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class ExportImportTests(MessengerTestCase):
+    """An NDJSON export loads back with the same messages and send times, once however often it is imported"""
+
+    def snapshot(self):
+        return list(Message.objects.order_by('timestamp', 'id').values_list(
+            'sender__username', 'receiver__username', 'content', 'timestamp'
+        ))
+
+    def test_round_trip(self):
+        send_message(self.alice, self.bob, 'one')
+        send_message(self.bob, self.alice, 'two')
+        send_message(self.alice, self.bob, 'three')
+        original = self.snapshot()
+        response = self.client.get('/api/export/')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 4)  # three messages and alice's contact
+
+        Message.objects.all().delete()
+        Contact.objects.all().delete()
+        counts = import_records(lines, 'old')
+        self.assertEqual(counts, {'messages': 3, 'contacts': 1, 'skipped': 0})
+        self.assertEqual(self.snapshot(), original)
+        self.assertTrue(Contact.objects.filter(user=self.alice, contact_user=self.bob).exists())
+
+        # Running the same import again, e.g. after an interruption, adds nothing
+        self.assertEqual(import_records(lines, 'old'), {'messages': 0, 'contacts': 0, 'skipped': 4})
+        self.assertEqual(self.snapshot(), original)
+
+
+class MessageAdminTests(TransactionTestCase):
+    """The Message admin validates receivers and keeps its changelist bounded on large tables"""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+        self.client.force_login(self.admin)
+
+    def test_add_without_receiver_is_a_form_error(self):
+        response = self.client.post('/admin/app/message/add/', {
+            'sender': self.admin.id, 'content': 'hello', 'status': 'sent',
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('receiver', response.context['adminform'].form.errors)
+        self.assertFalse(Message.objects.exists())
+
+    def test_add_direct_message(self):
+        response = self.client.post('/admin/app/message/add/', {
+            'sender': self.admin.id, 'receiver': self.bob.id, 'content': 'hello', 'status': 'sent',
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Message.objects.get().conversation_key, conversation_key(self.admin.id, self.bob.id))
+
+    def changelist(self, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/admin/app/message/', params)
+        self.assertEqual(response.status_code, 200)
+        return response, [query['sql'] for query in queries]
+
+    def test_changelist_queries_independent_of_size(self):
+        send_message(self.bob, self.admin, 'first')
+        self.changelist()  # caches the session user
+        _, few = self.changelist()
+        for i in range(30):
+            send_message(self.bob, self.admin, f'message {i}')
+        response, many = self.changelist()
+        self.assertEqual(len(many), len(few))
+        self.assertFalse([sql for sql in many if 'COUNT(' in sql and 'app_message' in sql])
+        self.assertEqual(len(response.context['cl'].result_list), 31)
+        # The estimate is the highest id: never less than the rows there are
+        self.assertGreaterEqual(response.context['cl'].result_count, 31)
+
+    def test_search(self):
+        carol = User.objects.create_user('carol', password='pw')
+        send_message(self.bob, self.admin, 'quarterly report')
+        send_message(self.bob, carol, 'lunch?')
+        response, _ = self.changelist(q='report')
+        self.assertEqual([message.content for message in response.context['cl'].result_list], ['quarterly report'])
+        response, _ = self.changelist(q=conversation_key(self.bob.id, carol.id))
+        self.assertEqual([message.content for message in response.context['cl'].result_list], ['lunch?'])
+
+
+@override_settings(MESSENGER_PERF_INSTRUMENTATION=True)
+class PerfInstrumentationTests(MessengerTestCase):
+    """Server-Timing counts the queries of sync and async views alike"""
+
+    def setUp(self):
+        super().setUp()
+        send_message(self.bob, self.alice, 'hi')
+
+    def query_count(self, response):
+        return int(re.search(r'desc="(\d+) queries"', response['Server-Timing']).group(1))
+
+    def test_sync_view(self):
+        self.assertGreater(self.query_count(self.client.get('/chat/', {'contact_id': self.bob.id})), 0)
+
+    def test_async_view_under_asgi(self):
+        async def get():
+            client = AsyncClient()
+            client.cookies[settings.SESSION_COOKIE_NAME] = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+            return await client.get('/api/messages/', {'contact_id': self.bob.id})
+        self.assertGreater(self.query_count(async_to_sync(get)()), 0)
+
+    def test_staff_only_histograms(self):
+        perf.reset_view_stats()
+        self.addCleanup(perf.reset_view_stats)
+        self.client.get('/chat/', {'contact_id': self.bob.id})
+        self.assertEqual(self.client.get('/api/perf/').status_code, 302)
+        self.alice.is_staff = True
+        self.alice.save()
+        stats = self.client.get('/api/perf/').json()['views']
+        self.assertEqual(stats['chat']['requests'], 1)
+        self.assertGreater(stats['chat']['mean_sql_count'], 0)
+
+    def test_repeated_query_shape_reported(self):
+        recorder = perf.RequestRecorder(duplicate_threshold=3)
+        for ids in ((1,), (2, 3), (4, 5, 6)):
+            sql = f"SELECT * FROM app_message WHERE id IN ({', '.join(['%s'] * len(ids))})"
+            recorder(lambda *args: None, sql, ids, False, {})
+        self.assertEqual(recorder.sql_count, 3)
+        (shape, location), = recorder.duplicates.items()
+        self.assertEqual(shape, 'SELECT * FROM app_message WHERE id IN (...)')
+        self.assertIn('test_repeated_query_shape_reported', location)
+
+
+class AsgiStreamingTests(MessengerTestCase):
+    """Under ASGI exports and downloads are async iterators, so Django streams them instead of reading them whole"""
+
+    def setUp(self):
+        super().setUp()
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+
+    def get(self, path, **headers):
+        async def get():
+            client = AsyncClient()
+            client.cookies[settings.SESSION_COOKIE_NAME] = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+            response = await client.get(path, headers=headers)
+            return response, b''.join([part async for part in response])
+        with warnings.catch_warnings():
+            # Django warns when it has to consume a synchronous iterator
+            warnings.simplefilter('error')
+            return async_to_sync(get)()
+
+    def test_export(self):
+        for i in range(3):
+            send_message(self.alice, self.bob, f'message {i}')
+        response, body = self.get('/api/export/')
+        self.assertTrue(response.is_async)
+        self.assertEqual(body.count(b'"type": "message"'), 3)
+
+    def test_attachment(self):
+        data = b'0123456789' * 10000
+        with self.settings(MEDIA_ROOT=self.media):
+            upload = self.client.post('/api/attachments/', {
+                'contact_id': self.bob.id, 'file': SimpleUploadedFile('data.bin', data),
+            }).json()
+            url = upload['message']['attachment']['url']
+            response, body = self.get(url)
+            self.assertTrue(response.is_async)
+            self.assertEqual(body, data)
+            response, body = self.get(url, Range='bytes=10-19')
+            self.assertEqual((response.status_code, body), (206, b'0123456789'))
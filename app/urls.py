@@ -9,6 +9,25 @@ urlpatterns = [
     path('profile-setup/', views.profile_setup, name='profile_setup'),
     path('profile/', views.profile_update, name='profile_update'),
     path('chat/', views.chat, name='chat'),
+    path('chat/sidebar/', views.chat_sidebar, name='chat_sidebar'),
+    path('chat/conversation/', views.chat_conversation, name='chat_conversation'),
     path('add-contact/', views.add_contact, name='add_contact'),
+    path('search/', views.message_search, name='message_search'),
     path('api/messages/', views.get_messages, name='get_messages'),
+    path('api/messages/send/', views.send_message_api, name='send_message'),
+    path('api/messages/ack/', views.acknowledge_messages, name='acknowledge_messages'),
+    path('api/messages/read/', views.read_messages, name='read_messages'),
+    path('api/attachments/', views.upload_attachment, name='upload_attachment'),
+    path('attachments/<int:attachment_id>/', views.download_attachment, name='attachment'),
+    path('attachments/<int:attachment_id>/thumbnail/', views.download_attachment, {'thumbnail': True},
+         name='attachment_thumbnail'),
+    path('api/groups/', views.groups, name='groups'),
+    path('api/groups/read/', views.group_read, name='group_read'),
+    path('api/unread/', views.unread_badge, name='unread_badge'),
+    path('api/users/search/', views.user_search, name='user_search'),
+    path('api/messages/search/', views.message_search_api, name='message_search_api'),
+    path('api/presence/', views.presence_status, name='presence_status'),
+    path('api/presence/heartbeat/', views.presence_heartbeat, name='presence_heartbeat'),
+    path('api/export/', views.export_messages, name='export_messages'),
+    path('api/perf/', views.performance_stats, name='performance_stats'),
 ]
@@ -1,13 +1,310 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login as auth_login, authenticate, logout as auth_logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.models import User
 from django.contrib import messages
-from django.http import JsonResponse
-from django.db.models import Q, Max
-from django.utils import timezone
-from .models import Message, Contact, UserProfile
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import require_POST
+from django.utils.cache import get_conditional_response
+from django.utils.functional import SimpleLazyObject
+from django.utils.http import content_disposition_header, quote_etag
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from datetime import datetime, timedelta, timezone as dt_timezone
+from asgiref.sync import sync_to_async
+from urllib.parse import urlencode
+import hashlib
+from .models import (
+    Message, Contact, UserProfile, Conversation, ConversationSummary, ConversationRead, Membership, Attachment, Blob,
+    conversation_key,
+)
 from .forms import SimpleRegistrationForm, SimpleLoginForm, MessageForm, ProfileUpdateForm
+from . import perf, presence
+from .attachments import HashingUploadHandler, serve_file
+from .caching import (
+    NO_WATERMARK, Watermark, aconversation_version, ainbox_version, conversation_version, get_recent_messages,
+    inbox_version,
+)
+from .routers import message_db_for_key
+from .pubsub import get_broker
+from .search import search_users, search_messages
+from .exports import FORMATS as EXPORT_FORMATS, export_rows, export_stream, user_conversation_keys
+from .streaming import response_body
+from .tasks import enqueue
+
+SYNC_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+# Changes are re-sent for this long after the cursor, so a row whose transaction
+# committed slightly after a newer one is never skipped; clients dedupe by id
+SYNC_LAG = timedelta(seconds=5)
+
+def encode_sync_cursor(since):
+    """Pack the client's sync position (last change time seen) into an opaque token"""
+    since_us = (since - SYNC_EPOCH) // timedelta(microseconds=1) if since else 0
+    return str(since_us)
+
+def decode_sync_cursor(cursor):
+    """Inverse of encode_sync_cursor, returns None for missing or malformed tokens"""
+    try:
+        since_us = int(cursor)
+    except (TypeError, ValueError):
+        return None
+    return SYNC_EPOCH + timedelta(microseconds=since_us)
+
+def advance_sync_cursor(messages, since=None):
+    """Move a sync position past every message in `messages`"""
+    for msg in messages:
+        if since is None or msg.updated_at > since:
+            since = msg.updated_at
+    return encode_sync_cursor(since)
+
+def parse_id(value):
+    """Positive integer id from a query parameter, or None"""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+def history_page(key, before_id=None, limit=None):
+    """Newest `limit` messages of a conversation older than `before_id`, oldest first
+    
+    Keyset pagination on (timestamp, id) so every page is one range scan of
+    app_msg_conversation_idx, however deep the user scrolls. Returns
+    (messages, has_more).
+    """
+    limit = limit or settings.MESSENGER_PAGE_SIZE
+    page = Message.objects.in_conversation(key).with_profiles('sender')
+    if before_id:
+        anchor = Message.objects.in_conversation(key).filter(id=before_id).values_list('timestamp', flat=True).first()
+        if anchor is None:
+            return [], False
+        page = page.filter(Q(timestamp__lt=anchor) | Q(timestamp=anchor, id__lt=before_id))
+    
+    rows = list(page.order_by('-timestamp', '-id')[:limit + 1])
+    return rows[:limit][::-1], len(rows) > limit
+
+def clamp_to_latest(key, message_id, entry=None):
+    """`message_id`, or the conversation's newest message id if it is past
+    that; None when the conversation has no messages
+    
+    Receipts must not move a watermark past messages that don't exist yet,
+    and must not leave rows for conversations that have none. No query when
+    the cached page already holds a message at least that new.
+    """
+    if entry is not None and entry.records and entry.records[-1].id >= message_id:
+        return message_id
+    latest = Message.objects.in_conversation(key).order_by('-timestamp', '-id').values_list('id', flat=True).first()
+    return latest and min(message_id, latest)
+
+def recent_page(key):
+    """Latest page of a conversation and its read watermarks, from the
+    recent-messages cache when warm. Returns (messages, has_more, watermarks, entry);
+    `entry` is None when the page came from the database.
+    """
+    recent = get_recent_messages()
+    entry = recent.get(key)
+    if entry is not None:
+        page = [Message.from_record(key, record) for record in entry.records]
+        return page, entry.has_more, dict(entry.watermarks), entry
+    
+    version = conversation_version(key)
+    page, has_more = history_page(key)
+    watermarks = ConversationRead.objects.watermarks(key)
+    recent.fill(key, version, [msg.to_record() for msg in page], has_more, watermarks)
+    return page, has_more, watermarks, None
+
+def serialize_message(msg, viewer):
+    """JSON shape shared by the messages API and real-time pushes"""
+    return {
+        'id': msg.id,
+        'sender': msg.sender.userprofile.nickname,
+        'content': msg.content,
+        'timestamp': msg.timestamp.strftime('%H:%M'),
+        'is_mine': msg.sender_id == viewer.id,
+        'status': msg.status,
+        'attachment': serialize_attachment(msg.attachment),
+    }
+
+def serialize_attachment(attachment):
+    """Message.attachment plus its download links; None for plain messages"""
+    if attachment is None:
+        return None
+    links = {'url': reverse('attachment', args=[attachment['id']]), 'thumbnail_url': None}
+    if attachment['is_image']:
+        links['thumbnail_url'] = reverse('attachment_thumbnail', args=[attachment['id']])
+    return {**attachment, **links}
+
+def publish_message(msg):
+    """Push a new message to the open sockets of both participants"""
+    broker = get_broker()
+    for viewer, peer in ((msg.sender, msg.receiver), (msg.receiver, msg.sender)):
+        broker.publish(viewer.id, {
+            'type': 'message',
+            'contact_id': peer.id,
+            'message': serialize_message(msg, viewer),
+        })
+
+def publish_group_message(msg, conversation_id, member_ids):
+    """Push a new group message to the open sockets of every member"""
+    broker = get_broker()
+    for member_id in member_ids:
+        broker.publish(member_id, {
+            'type': 'message',
+            'conversation_id': conversation_id,
+            'message': serialize_message(msg, User(id=member_id)),
+        })
+
+def mark_conversation_read(reader, peer, key, messages, watermarks):
+    """Advance the reader's watermark past the newest message from `peer` in `messages`"""
+    newest = max((msg.id for msg in messages if msg.sender_id == peer.id), default=0)
+    advance_read(reader, peer, key, newest, watermarks)
+
+def advance_read(reader, peer, key, up_to_id, watermarks):
+    """Move the reader's watermark in a direct chat forward to `up_to_id`
+    
+    A single-row upsert, and nothing when `watermarks` show it already read;
+    the peer's open sockets are told how far was read.
+    """
+    previous = watermarks.get(reader.id, NO_WATERMARK)
+    if up_to_id <= previous.read:
+        return
+    if ConversationRead.objects.advance(reader.id, key, up_to_id):
+        watermarks[reader.id] = Watermark(up_to_id, max(previous.delivered, up_to_id))
+        ConversationSummary.objects.mark_read(reader, peer, up_to_id)
+        transaction.on_commit(lambda: get_broker().publish(peer.id, {
+            'type': 'read',
+            'contact_id': reader.id,
+            'read_up_to': up_to_id,
+        }))
+
+def advance_group_read(reader, conversation_id, group, up_to_id, watermarks=None):
+    """Move the reader's watermark in a group forward to `up_to_id`
+    
+    `group` is (key, member ids). Nothing happens when `watermarks` show it
+    already read; otherwise the other members' open sockets are told.
+    """
+    key, member_ids = group
+    if watermarks is not None and up_to_id <= watermarks.get(reader.id, NO_WATERMARK).read:
+        return
+    
+    def publish_read():
+        broker = get_broker()
+        for member_id in member_ids - {reader.id}:
+            broker.publish(member_id, {
+                'type': 'read',
+                'conversation_id': conversation_id,
+                'user_id': reader.id,
+                'read_up_to': up_to_id,
+            })
+    
+    if ConversationRead.objects.advance(reader.id, key, up_to_id):
+        ConversationSummary.objects.changed(reader.id)
+        transaction.on_commit(publish_read)
+
+def acknowledge_delivery(user, message_id, contact_id=None, conversation_id=None):
+    """Record that `user` has received everything up to `message_id` in a
+    direct chat (`contact_id`) or a group (`conversation_id`)
+    
+    One watermark bump however many messages it covers, and no query at all
+    when the cached watermark already covers it (several tabs, or a poll
+    and a socket delivering the same message). The senders are told.
+    Returns the id acknowledged, at most the conversation's newest, or None
+    when the conversation isn't the user's or has no messages.
+    """
+    if conversation_id is not None:
+        group = group_for_member(user, conversation_id)
+        if group is None:
+            return None
+        key, member_ids = group
+        event = {'conversation_id': conversation_id, 'user_id': user.id}
+    else:
+        if contact_id == user.id:
+            return None
+        key, member_ids = conversation_key(user.id, contact_id), {user.id, contact_id}
+        event = {'contact_id': user.id}
+    
+    entry = get_recent_messages().get(key)
+    if entry is not None and entry.watermarks.get(user.id, NO_WATERMARK).delivered >= message_id:
+        return message_id
+    message_id = clamp_to_latest(key, message_id, entry)
+    if message_id is None:
+        return None
+    
+    def publish_delivered():
+        broker = get_broker()
+        for member_id in member_ids - {user.id}:
+            broker.publish(member_id, {'type': 'delivered', **event, 'delivered_up_to': message_id})
+    
+    if ConversationRead.objects.acknowledge(user.id, key, message_id):
+        transaction.on_commit(publish_delivered)
+    return message_id
+
+def _store_message(message_db, sender, idempotency_key, write):
+    """Run `write` (the message insert and its bookkeeping) in one transaction per database
+    
+    Returns (message, created). A retry with an idempotency_key the sender
+    already used returns the message stored by the first attempt.
+    """
+    try:
+        # No savepoint for the inner block: when both are 'default' it is one transaction
+        with transaction.atomic(using=message_db), transaction.atomic(savepoint=False):
+            return write(), True
+    except IntegrityError:
+        # No lookup before the insert: the unique constraint catches the rare retry
+        if not idempotency_key:
+            raise
+        message = Message.objects.using(message_db).filter(
+            sender=sender, idempotency_key=idempotency_key
+        ).with_profiles('sender').first()
+        if message is None:
+            raise
+        return message, False
+
+def send_message(sender, receiver, content, idempotency_key=None, attachment=None):
+    """Store a message; the two users become mutual contacts in a background job
+    
+    Returns (message, created), see _store_message.
+    """
+    # The message may live on a shard; jobs and contacts are always on the default database
+    message_db = message_db_for_key(conversation_key(sender.id, receiver.id)) or 'default'
+    
+    def write():
+        message = Message.objects.using(message_db).create(
+            sender=sender, receiver=receiver, content=content, idempotency_key=idempotency_key,
+            attachment=attachment,
+        )
+        enqueue('add_mutual_contacts', {'user_id': sender.id, 'peer_id': receiver.id})
+        return message
+    
+    message, created = _store_message(message_db, sender, idempotency_key, write)
+    if created:
+        transaction.on_commit(lambda: publish_message(message))
+    return message, created
+
+def send_group_message(sender, conversation_id, content, idempotency_key=None, attachment=None):
+    """Store one message for every member of a group; returns (message, created)
+    
+    The caller checks that `sender` is a member.
+    """
+    key, member_ids = Conversation.objects.members(conversation_id)
+    message_db = message_db_for_key(key) or 'default'
+    
+    def write():
+        return Message.objects.using(message_db).create(
+            sender=sender, conversation_key=key, content=content, idempotency_key=idempotency_key,
+            attachment=attachment,
+        )
+    
+    message, created = _store_message(message_db, sender, idempotency_key, write)
+    if created:
+        transaction.on_commit(lambda: publish_group_message(message, conversation_id, member_ids))
+    return message, created
 
 def home(request):
     if request.user.is_authenticated:
@@ -44,11 +341,8 @@ def user_login(request):
         form = SimpleLoginForm(request, data=request.POST)
         if form.is_valid():
             user = form.get_user()
-            # Update online status
-            if hasattr(user, 'userprofile'):
-                user.userprofile.is_online = True
-                user.userprofile.save()
             auth_login(request, user)
+            presence.heartbeat(user.id)
             messages.success(request, f'Welcome back, {user.userprofile.nickname}!')
             return redirect('chat')
     else:
@@ -57,131 +351,167 @@ def user_login(request):
 
 def user_logout(request):
     # Update online status
-    if request.user.is_authenticated and hasattr(request.user, 'userprofile'):
-        request.user.userprofile.is_online = False
-        request.user.userprofile.save()
+    if request.user.is_authenticated:
+        presence.mark_offline(request.user.id)
     auth_logout(request)
     return redirect('home')
 
+def sidebar_context(user, active_id=None, active_group_id=None):
+    """Template context for chat_sidebar.html
+    
+    The rendered sidebar is cached under `sidebar_version`: the user's inbox
+    version, the active contact or group and which peers are online. The
+    inbox and the groups are passed lazily, so they are only queried when the
+    fragment has to be rendered again. Peer ids for the online lookup are
+    cached under the inbox version too.
+    """
+    # Read before the inbox, so nothing older than this version is cached under it
+    version = inbox_version(user.id)
+    inbox = ConversationSummary.objects.filter(user=user).select_related(
+        'peer__userprofile'
+    ).order_by('-last_activity_at')
+    
+    peers_key = f'inbox-peers:{user.id}:{version}'
+    peer_ids = cache.get(peers_key)
+    if peer_ids is None:
+        inbox = list(inbox)
+        peer_ids = [summary.peer_id for summary in inbox]
+        cache.set(peers_key, peer_ids, settings.MESSENGER_SIDEBAR_CACHE_TTL)
+    
+    # Online dots for the whole sidebar in one presence lookup
+    online_ids = presence.online_user_ids(peer_ids)
+    online = ','.join(map(str, sorted(online_ids)))
+    return {
+        'inbox': inbox,
+        # Group sends and reads bump the members' inbox versions too
+        'groups': SimpleLazyObject(lambda: Membership.objects.group_inbox(user)),
+        'online_ids': online_ids,
+        'active_id': active_id,
+        'active_group_id': active_group_id,
+        'sidebar_version': '-'.join([
+            str(version), str(active_id or 0), f'g{active_group_id or 0}', hashlib.md5(online.encode()).hexdigest(),
+        ]),
+        'sidebar_cache_ttl': settings.MESSENGER_SIDEBAR_CACHE_TTL,
+    }
+
+def conversation_context(request, active_contact, before_id=None):
+    """Template context for chat_conversation.html; marks what it shows as read"""
+    if active_contact is None:
+        return {'active_contact': None}
+    
+    # Latest window of the conversation (or the one before `before_id`)
+    key = conversation_key(request.user.id, active_contact.id)
+    if before_id:
+        conversation, has_older = history_page(key, before_id)
+        watermarks = ConversationRead.objects.watermarks(key)
+    else:
+        conversation, has_older, watermarks, _ = recent_page(key)
+    
+    # Auto-add contact if not already added and there are messages between them
+    if conversation:
+        Contact.objects.get_or_create(
+            user=request.user,
+            contact_user=active_contact
+        )
+    
+    # Mark what is on screen as read, then derive per-message status
+    mark_conversation_read(request.user, active_contact, key, conversation, watermarks)
+    ConversationRead.objects.apply_status(conversation, watermarks)
+    
+    return {
+        'active_contact': active_contact,
+        'contact_online': bool(presence.online_user_ids([active_contact.id])),
+        'conversation': conversation,
+        'has_older': has_older,
+        # Live updates only make sense when the newest window is on screen
+        'sync_cursor': '' if before_id else advance_sync_cursor(conversation),
+    }
+
+def group_conversation_context(request, conversation_id, before_id=None):
+    """conversation_context for a group the user belongs to; 404 for anyone else"""
+    group = group_for_member(request.user, conversation_id)
+    if group is None:
+        raise Http404('Conversation not found')
+    key, member_ids = group
+    if before_id:
+        conversation, has_older = history_page(key, before_id)
+        watermarks = ConversationRead.objects.watermarks(key)
+    else:
+        conversation, has_older, watermarks, _ = recent_page(key)
+    
+    newest = max((msg.id for msg in conversation if msg.sender_id != request.user.id), default=0)
+    if newest:
+        advance_group_read(request.user, conversation_id, group, newest, watermarks)
+    ConversationRead.objects.apply_status(conversation, watermarks, member_ids)
+    
+    return {
+        'active_contact': None,
+        'active_group': get_object_or_404(Conversation, id=conversation_id),
+        'member_count': len(member_ids),
+        'conversation': conversation,
+        'has_older': has_older,
+        'sync_cursor': '' if before_id else advance_sync_cursor(conversation),
+    }
+
 @login_required
 def chat(request):
     """Main chat interface combining contacts and messages"""
-    contacts = Contact.objects.filter(user=request.user).select_related('contact_user__userprofile')
-    all_users = User.objects.exclude(id=request.user.id).select_related('userprofile')
-    
     contact_id = request.GET.get('contact_id')
+    conversation_id = parse_id(request.GET.get('conversation_id'))
     active_contact = None
-    conversation = []
     
     if contact_id:
         active_contact = get_object_or_404(User, id=contact_id)
-        # Get all messages between current user and selected contact
-        conversation = Message.objects.filter(
-            Q(sender=request.user, receiver=active_contact) |
-            Q(sender=active_contact, receiver=request.user)
-        ).order_by('timestamp')
-        
-        # Mark messages as read
-        Message.objects.filter(
-            sender=active_contact, 
-            receiver=request.user,
-            status='sent'
-        ).update(status='read')
-        
-        # Auto-add contact if not already added and there are messages between them
-        if conversation.exists():
-            Contact.objects.get_or_create(
-                user=request.user,
-                contact_user=active_contact
-            )
     
     # Handle new message
     if request.method == 'POST':
         content = request.POST.get('content', '').strip()
+        if content and conversation_id:
+            if group_for_member(request.user, conversation_id) is None:
+                raise Http404('Conversation not found')
+            send_group_message(request.user, conversation_id, content)
+            return redirect(f'/chat/?conversation_id={conversation_id}')
         if content and active_contact:
-            # Create the message
-            Message.objects.create(
-                sender=request.user,
-                receiver=active_contact,
-                content=content
-            )
-            # Auto-add contact for both users if not already added
-            Contact.objects.get_or_create(
-                user=request.user,
-                contact_user=active_contact
-            )
-            Contact.objects.get_or_create(
-                user=active_contact,
-                contact_user=request.user
-            )
+            send_message(request.user, active_contact, content)
             return redirect(f'/chat/?contact_id={contact_id}')
     
-    # Get all users who have had conversations with current user (for contact list)
-    conversation_users = User.objects.filter(
-        Q(sent_messages__receiver=request.user) |
-        Q(received_messages__sender=request.user)
-    ).exclude(id=request.user.id).distinct().select_related('userprofile')
-    
-    # Combine explicit contacts with conversation partners
-    all_contact_users = set()
-    contacts_with_info = []
-    
-    # Add explicit contacts
-    for contact in contacts:
-        all_contact_users.add(contact.contact_user.id)
-        last_message = Message.objects.filter(
-            Q(sender=request.user, receiver=contact.contact_user) |
-            Q(sender=contact.contact_user, receiver=request.user)
-        ).order_by('-timestamp').first()
-        
-        unread_count = Message.objects.filter(
-            sender=contact.contact_user,
-            receiver=request.user,
-            status='sent'
-        ).count()
-        
-        contacts_with_info.append({
-            'contact': contact,
-            'user': contact.contact_user,
-            'last_message': last_message,
-            'unread_count': unread_count,
-            'is_explicit_contact': True
-        })
-    
-    # Add conversation partners who aren't explicit contacts
-    for user in conversation_users:
-        if user.id not in all_contact_users:
-            last_message = Message.objects.filter(
-                Q(sender=request.user, receiver=user) |
-                Q(sender=user, receiver=request.user)
-            ).order_by('-timestamp').first()
-            
-            unread_count = Message.objects.filter(
-                sender=user,
-                receiver=request.user,
-                status='sent'
-            ).count()
-            
-            contacts_with_info.append({
-                'contact': None,
-                'user': user,
-                'last_message': last_message,
-                'unread_count': unread_count,
-                'is_explicit_contact': False
-            })
+    # The conversation first: reading it can change the sidebar's unread counts
+    before_id = parse_id(request.GET.get('before_id'))
+    if conversation_id:
+        context = group_conversation_context(request, conversation_id, before_id)
+    else:
+        context = conversation_context(request, active_contact, before_id)
+    context.update(sidebar_context(request.user, active_contact.id if active_contact else None, conversation_id))
+    return render(request, 'app/chat.html', context)
+
+@login_required
+@cache_control(private=True, no_cache=True)
+def chat_sidebar(request):
+    """The contact list alone, for refreshing it without reloading the page
     
-    # Sort by last message timestamp
-    contacts_with_info.sort(
-        key=lambda x: x['last_message'].timestamp if x['last_message'] else timezone.now() - timezone.timedelta(days=365),
-        reverse=True
+    ETagged by the same version as the fragment cache, so an unchanged
+    sidebar is a 304.
+    """
+    context = sidebar_context(
+        request.user, parse_id(request.GET.get('contact_id')), parse_id(request.GET.get('conversation_id'))
     )
-    
-    return render(request, 'app/chat.html', {
-        'contacts_with_info': contacts_with_info,
-        'all_users': all_users,
-        'active_contact': active_contact,
-        'conversation': conversation,
-    })
+    etag = quote_etag(f"{request.user.id}-{context['sidebar_version']}")
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = render(request, 'app/chat_sidebar.html', context)
+        response['ETag'] = etag
+    return response
+
+@login_required
+def chat_conversation(request):
+    """The conversation pane alone (header, messages, input), for switching chats in place"""
+    before_id = parse_id(request.GET.get('before_id'))
+    if 'conversation_id' in request.GET:
+        context = group_conversation_context(request, parse_id(request.GET['conversation_id']), before_id)
+    else:
+        active_contact = get_object_or_404(User, id=parse_id(request.GET.get('contact_id')))
+        context = conversation_context(request, active_contact, before_id)
+    return render(request, 'app/chat_conversation.html', context)
 
 @login_required
 def add_contact(request):
@@ -216,28 +546,489 @@ def profile_update(request):
     
     return render(request, 'app/profile_update.html', {'form': form})
 
+def group_for_member(user, conversation_id):
+    """(key, member ids) of a group `user` belongs to, or None; no query once cached"""
+    found = Conversation.objects.members(conversation_id) if conversation_id else None
+    if found is None or user.id not in found[1]:
+        return None
+    return found
+
+async def agroup_for_member(user, conversation_id):
+    """group_for_member for async views"""
+    found = await Conversation.objects.amembers(conversation_id) if conversation_id else None
+    if found is None or user.id not in found[1]:
+        return None
+    return found
+
+def messages_cache_variant(request, user, version):
+    """Version tag for a messages API response: the conversation version plus
+    everything else the body depends on (viewer and query parameters)"""
+    params = hashlib.md5(urlencode(sorted(request.GET.items())).encode()).hexdigest()
+    return f'{version}-{user.id}-{params}'
+
+def _messages_payload(request, key, member_ids):
+    # How far every other member has read and received; lets clients update receipts without refetching rows
+    def receipts(watermarks):
+        others = [watermarks.get(user_id, NO_WATERMARK) for user_id in member_ids if user_id != request.user.id]
+        return {
+            'read_up_to': min((watermark.read for watermark in others), default=0),
+            'delivered_up_to': min((watermark.delivered for watermark in others), default=0),
+        }
+    
+    before_id = parse_id(request.GET.get('before_id'))
+    if before_id:
+        page, has_more = history_page(key, before_id)
+        watermarks = ConversationRead.objects.watermarks(key)
+        ConversationRead.objects.apply_status(page, watermarks, member_ids)
+        return {
+            'messages': [serialize_message(msg, request.user) for msg in page],
+            'has_more': has_more,
+            **receipts(watermarks),
+        }
+    
+    page, has_more, watermarks, entry = recent_page(key)
+    
+    since = decode_sync_cursor(request.GET.get('cursor'))
+    if since is not None:
+        limit = settings.MESSENGER_PAGE_SIZE
+        cutoff = since - SYNC_LAG
+        # A cached page holds every change since the cutoff if it is the whole
+        # conversation, or if it was filled before the cutoff (later edits
+        # invalidate it) and still reaches back past it: write-through keeps
+        # only the newest page, so a burst of sends can push changes out of it
+        if entry is not None and (not entry.has_more or (
+            cutoff.timestamp() >= entry.stored_at and page and page[0].timestamp < cutoff
+        )):
+            delta = sorted((msg for msg in page if msg.updated_at >= cutoff), key=lambda msg: (msg.updated_at, msg.id))
+        else:
+            delta = list(
+                Message.objects.in_conversation(key).filter(updated_at__gte=cutoff)
+                .with_profiles('sender').order_by('updated_at', 'id')[:limit + 1]
+            )
+        if len(delta) <= limit:
+            delta.sort(key=lambda msg: (msg.timestamp, msg.id))
+            ConversationRead.objects.apply_status(delta, watermarks, member_ids)
+            return {
+                'messages': [serialize_message(msg, request.user) for msg in delta],
+                'cursor': advance_sync_cursor(delta, since),
+                'is_delta': True,
+                **receipts(watermarks),
+            }
+    
+    ConversationRead.objects.apply_status(page, watermarks, member_ids)
+    return {
+        'messages': [serialize_message(msg, request.user) for msg in page],
+        'has_more': has_more,
+        'cursor': advance_sync_cursor(page),
+        'is_delta': False,
+        **receipts(watermarks),
+    }
+
 @login_required
-def get_messages(request):
-    """API endpoint for real-time message updates"""
-    contact_id = request.GET.get('contact_id')
-    if not contact_id:
-        return JsonResponse({'messages': []})
+@cache_control(private=True, no_cache=True)
+async def get_messages(request):
+    """API endpoint for real-time message updates
     
-    try:
-        contact_user = User.objects.get(id=contact_id)
-        messages_data = Message.objects.filter(
-            Q(sender=request.user, receiver=contact_user) |
-            Q(sender=contact_user, receiver=request.user)
-        ).order_by('timestamp')
+    - `before_id`: the page of older messages preceding that id ("load older").
+    - `cursor` from a previous response: only messages created or changed
+      since then, so polling a quiet conversation is nearly free.
+    - neither: the latest page plus a fresh cursor.
+    
+    Every response is bounded by MESSENGER_PAGE_SIZE; a delta that would be
+    larger is replaced by a fresh latest page (`is_delta` false).
+    
+    Responses carry an ETag derived from the conversation version, so a poll
+    with nothing new is answered 304 before any query runs. Bodies are kept in
+    the cache under the same version and go stale as soon as it is bumped.
+    
+    Each message's `status` is sent, delivered (acknowledged by one of the
+    receiver's clients, see acknowledge_messages) or read; `delivered_up_to`
+    and `read_up_to` carry the same watermarks for updating receipts in place.
+    Group chats pass `conversation_id` instead of `contact_id`; the
+    watermarks are then the lowest among the other members.
+    
+    Async: under ASGI a poll answered from the cache (most of them) does no
+    blocking work in the view, only async cache reads. Building a new page
+    runs the same sync helpers as the chat view, in a single hop to a thread.
+    Django's own middleware (sessions, CSRF, messages...) still runs its
+    hooks in a thread, one hop each.
+    """
+    user = await request.auser()
+    if 'conversation_id' in request.GET:
+        target = await agroup_for_member(user, parse_id(request.GET['conversation_id']))
+        if target is None:
+            return JsonResponse({'error': 'Conversation not found'}, status=404)
+    else:
+        if not request.GET.get('contact_id'):
+            return JsonResponse({'messages': []})
+        contact_id = parse_id(request.GET['contact_id'])
+        if contact_id is None:
+            return JsonResponse({'error': 'Contact not found'}, status=404)
+        target = conversation_key(user.id, contact_id), (user.id, contact_id)
+    key, member_ids = target
+    
+    variant = messages_cache_variant(request, user, await aconversation_version(key))
+    etag = quote_etag(variant)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        cache_key = f'messages-api:{variant}'
+        body = await cache.aget(cache_key)
+        if body is not None:
+            response = HttpResponse(body, content_type='application/json')
+        else:
+            if 'conversation_id' not in request.GET and not await User.objects.filter(id=contact_id).aexists():
+                return JsonResponse({'error': 'Contact not found'}, status=404)
+            response = JsonResponse(await sync_to_async(_messages_payload)(request, key, member_ids))
+            await cache.aset(cache_key, response.content, settings.MESSENGER_MESSAGES_CACHE_TTL)
+    response['ETag'] = etag
+    return response
+
+@login_required
+@require_POST
+async def send_message_api(request):
+    """Send a message and return it, so the client can render it without refetching
+    
+    POST `contact_id` (or a group's `conversation_id`), `content` and an
+    optional `idempotency_key` (a client-generated string of up to 64
+    characters, reused when retrying a send).
+    """
+    user = await request.auser()
+    content = request.POST.get('content', '').strip()
+    idempotency_key = request.POST.get('idempotency_key') or None
+    if not content:
+        return JsonResponse({'error': 'Message is empty'}, status=400)
+    if idempotency_key and len(idempotency_key) > 64:
+        return JsonResponse({'error': 'idempotency_key is too long'}, status=400)
+    
+    if 'conversation_id' in request.POST:
+        conversation_id = parse_id(request.POST['conversation_id'])
+        group = await agroup_for_member(user, conversation_id)
+        if group is None:
+            return JsonResponse({'error': 'Conversation not found'}, status=404)
         
-        messages_list = [{
-            'sender': msg.sender.userprofile.nickname,
-            'content': msg.content,
-            'timestamp': msg.timestamp.strftime('%H:%M'),
-            'is_mine': msg.sender == request.user,
-            'status': msg.status
-        } for msg in messages_data]
+        def send():
+            message, created = send_group_message(user, conversation_id, content, idempotency_key)
+            return message.conversation_key == group[0], serialize_message(message, user), created
+    else:
+        receiver = await User.objects.filter(id=parse_id(request.POST.get('contact_id'))).afirst()
+        if receiver is None:
+            return JsonResponse({'error': 'Contact not found'}, status=404)
         
-        return JsonResponse({'messages': messages_list})
-    except User.DoesNotExist:
-        return JsonResponse({'error': 'Contact not found'}, status=404)
+        def send():
+            message, created = send_message(user, receiver, content, idempotency_key)
+            return message.receiver_id == receiver.id, serialize_message(message, user), created
+    
+    # Transactions and on_commit hooks only exist in sync code
+    same_conversation, message, created = await sync_to_async(send)()
+    if not same_conversation:
+        return JsonResponse({'error': 'idempotency_key was already used for another conversation'}, status=409)
+    return JsonResponse({'message': message, 'created': created}, status=201 if created else 200)
+
+@login_required
+@require_POST
+def acknowledge_messages(request):
+    """Delivery receipt: the client has everything up to `message_id` of a
+    `contact_id` or `conversation_id` chat (socket clients send an 'ack' frame instead)"""
+    message_id = parse_id(request.POST.get('message_id'))
+    if 'conversation_id' in request.POST:
+        target = {'conversation_id': parse_id(request.POST['conversation_id'])}
+    else:
+        target = {'contact_id': parse_id(request.POST.get('contact_id'))}
+    if not message_id or None in target.values():
+        return JsonResponse({'error': 'message_id and contact_id or conversation_id are required'}, status=400)
+    delivered_up_to = acknowledge_delivery(request.user, message_id, **target)
+    if delivered_up_to is None:
+        return JsonResponse({'error': 'Conversation not found'}, status=404)
+    return JsonResponse({'delivered_up_to': delivered_up_to})
+
+@login_required
+@require_POST
+def read_messages(request):
+    """Read receipt for a direct chat open on screen: messages that arrived by
+    poll or socket are read up to `message_id`, at most the chat's newest"""
+    contact = User.objects.filter(id=parse_id(request.POST.get('contact_id'))).first()
+    message_id = parse_id(request.POST.get('message_id'))
+    if contact is None or contact.id == request.user.id or not message_id:
+        return JsonResponse({'error': 'Conversation not found'}, status=404)
+    key = conversation_key(request.user.id, contact.id)
+    entry = get_recent_messages().get(key)
+    message_id = clamp_to_latest(key, message_id, entry)
+    if message_id is None:
+        return JsonResponse({'error': 'Conversation not found'}, status=404)
+    watermarks = dict(entry.watermarks) if entry is not None else ConversationRead.objects.watermarks(key)
+    advance_read(request.user, contact, key, message_id, watermarks)
+    return JsonResponse({'read_up_to': max(message_id, watermarks.get(request.user.id, NO_WATERMARK).read)})
+
+@csrf_exempt
+@login_required
+@require_POST
+def upload_attachment(request):
+    """Send a `file` to `contact_id` (or a group's `conversation_id`), with an
+    optional `content` caption; returns the new message like send_message_api
+    
+    The body streams to a temporary file and is hashed on the way, and a file
+    whose content is already stored is not written again.
+    """
+    if int(request.META.get('CONTENT_LENGTH') or 0) > settings.MESSENGER_ATTACHMENT_MAX_SIZE + 64 * 1024:
+        return JsonResponse({'error': 'File is too large'}, status=413)
+    # Upload handlers must be set before anything reads request.POST, the
+    # CSRF check included; hence csrf_exempt here and csrf_protect inside
+    handler = HashingUploadHandler(request)
+    request.upload_handlers = [handler]
+    return _store_attachment(request, handler)
+
+@csrf_protect
+def _store_attachment(request, handler):
+    uploaded = request.FILES.get('file')
+    if handler.too_large:
+        return JsonResponse({'error': 'File is too large'}, status=413)
+    if uploaded is None:
+        return JsonResponse({'error': 'file is required'}, status=400)
+    
+    if 'conversation_id' in request.POST:
+        conversation_id = parse_id(request.POST['conversation_id'])
+        group = group_for_member(request.user, conversation_id)
+        if group is None:
+            return JsonResponse({'error': 'Conversation not found'}, status=404)
+        key = group[0]
+    else:
+        receiver = User.objects.filter(id=parse_id(request.POST.get('contact_id'))).first()
+        if receiver is None:
+            return JsonResponse({'error': 'Contact not found'}, status=404)
+        key = conversation_key(request.user.id, receiver.id)
+    
+    blob = Blob.objects.store(uploaded)
+    with transaction.atomic():
+        attachment = Attachment.objects.create(
+            blob=blob, conversation_key=key, uploader=request.user, name=uploaded.name[:255]
+        )
+        content = request.POST.get('content', '').strip() or attachment.name
+        if key.startswith('g'):
+            message, _ = send_group_message(request.user, conversation_id, content, attachment=attachment.summary())
+        else:
+            message, _ = send_message(request.user, receiver, content, attachment=attachment.summary())
+        if blob.is_image and not blob.thumbnail:
+            enqueue('make_thumbnails', {'blob_id': blob.id})
+    return JsonResponse({'message': serialize_message(message, request.user), 'created': True}, status=201)
+
+@login_required
+def download_attachment(request, attachment_id, thumbnail=False):
+    """An attachment's file, or its image thumbnail, for the conversation's participants only"""
+    attachment = Attachment.objects.select_related('blob').filter(id=attachment_id).first()
+    if attachment is None or not Conversation.objects.has_member(attachment.conversation_key, request.user.id):
+        raise Http404('Attachment not found')
+    
+    blob = attachment.blob
+    if not thumbnail:
+        return serve_file(request, blob.file, blob.content_type, attachment.name, blob.sha256)
+    if not blob.thumbnail:
+        raise Http404('No thumbnail')
+    return serve_file(request, blob.thumbnail, 'image/jpeg', attachment.name, f'{blob.sha256}-thumbnail')
+
+@login_required
+def groups(request):
+    """Group chats: GET lists the user's groups with unread counts, newest
+    first; POST `title` and `member_ids` (repeated or comma-separated)
+    creates one"""
+    if request.method == 'POST':
+        title = request.POST.get('title', '').strip()
+        if not title or len(title) > 100:
+            return JsonResponse({'error': 'A title of up to 100 characters is required'}, status=400)
+        requested = {parse_id(value) for raw in request.POST.getlist('member_ids') for value in raw.split(',')}
+        member_ids = set(User.objects.filter(id__in=requested - {None}).values_list('id', flat=True))
+        if not member_ids - {request.user.id}:
+            return JsonResponse({'error': 'Add at least one other member'}, status=400)
+        conversation = Conversation.objects.create_group(request.user, title, member_ids)
+        return JsonResponse({
+            'id': conversation.id,
+            'title': conversation.title,
+            'member_ids': sorted(member_ids | {request.user.id}),
+        }, status=201)
+    
+    return JsonResponse({'groups': [{
+        'id': membership.conversation.id,
+        'title': membership.conversation.title,
+        'last_message_preview': membership.conversation.last_message_preview,
+        'last_message_is_mine': membership.conversation.last_sender_id == request.user.id,
+        'last_activity_at': membership.conversation.last_activity_at.isoformat(),
+        'unread_count': membership.unread_count,
+    } for membership in Membership.objects.group_inbox(request.user)]})
+
+@login_required
+@require_POST
+def group_read(request):
+    """Move the user's read point in a group to `message_id`, at most its
+    newest message; the other members are told"""
+    conversation_id = parse_id(request.POST.get('conversation_id'))
+    message_id = parse_id(request.POST.get('message_id'))
+    group = group_for_member(request.user, conversation_id)
+    if group is None or not message_id:
+        return JsonResponse({'error': 'Conversation not found'}, status=404)
+    key, member_ids = group
+    message_id = clamp_to_latest(key, message_id, get_recent_messages().get(key))
+    if message_id is None:
+        return JsonResponse({'error': 'Conversation not found'}, status=404)
+    advance_group_read(request.user, conversation_id, group, message_id)
+    return JsonResponse({'read_up_to': message_id})
+
+def _unread_counts_key(user_id, version):
+    return f'unread-counts:{user_id}:{version}'
+
+def unread_counts(user):
+    """(inbox version, unread counts per contact, per group and in total)
+    
+    Summed from the per-conversation counters and cached under the inbox
+    version, which every send and read bumps, so the sums are only redone
+    after something changed.
+    """
+    version = inbox_version(user.id)
+    cache_key = _unread_counts_key(user.id, version)
+    counts = cache.get(cache_key)
+    if counts is None:
+        contacts = ConversationSummary.objects.unread_by_peer(user)
+        groups = {
+            membership.conversation.id: membership.unread_count
+            for membership in Membership.objects.group_inbox(user) if membership.unread_count
+        }
+        counts = {
+            'total': sum(contacts.values()) + sum(groups.values()),
+            'contacts': contacts,
+            'groups': groups,
+        }
+        cache.set(cache_key, counts, settings.MESSENGER_SIDEBAR_CACHE_TTL)
+    return version, counts
+
+@login_required
+@cache_control(private=True, no_cache=True)
+async def unread_badge(request):
+    """The user's unread counts, for the title bar and badges
+    
+    ETagged by the inbox version: polling it is a 304 with no query until a
+    message arrives or something is read.
+    """
+    user = await request.auser()
+    version = await ainbox_version(user.id)
+    etag = quote_etag(f'{user.id}-{version}')
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        counts = await cache.aget(_unread_counts_key(user.id, version))
+        if counts is None:
+            version, counts = await sync_to_async(unread_counts)(user)
+            etag = quote_etag(f'{user.id}-{version}')
+        response = JsonResponse(counts)
+        response['ETag'] = etag
+    return response
+
+@login_required
+def user_search(request):
+    """Typeahead for the add-contact box: nickname prefix/substring matches"""
+    results = search_users(request.GET.get('q', ''), exclude_user_id=request.user.id)
+    return JsonResponse({'results': results})
+
+def _search_page(request):
+    cursor = request.GET.get('cursor')
+    results, next_cursor = search_messages(request.user, request.GET.get('q', ''), cursor)
+    # Group messages have no receiver: they are listed under the group's title
+    group_keys = {result['message'].conversation_key for result in results if result['message'].receiver_id is None}
+    groups = Conversation.objects.in_bulk(group_keys, field_name='key') if group_keys else {}
+    for result in results:
+        msg = result['message']
+        result['group'] = groups.get(msg.conversation_key)
+        if result['group'] is None:
+            result['contact'] = msg.receiver if msg.sender_id == request.user.id else msg.sender
+    return results, cursor, next_cursor
+
+@login_required
+def message_search(request):
+    """Search page over the user's own conversations"""
+    results, cursor, next_cursor = _search_page(request)
+    return render(request, 'app/search.html', {
+        'query': request.GET.get('q', ''),
+        'results': results,
+        'cursor': cursor,
+        'next_cursor': next_cursor,
+    })
+
+@login_required
+def message_search_api(request):
+    """JSON variant of the search page; pass `next_cursor` back as `cursor` for the next page"""
+    results, _, next_cursor = _search_page(request)
+    return JsonResponse({
+        'results': [{
+            'message': serialize_message(result['message'], request.user),
+            'conversation_id': result['message'].conversation_key,
+            'group': result['group'].title if result['group'] else None,
+            'contact_id': result['contact'].id if not result['group'] else None,
+            'contact': result['contact'].userprofile.nickname if not result['group'] else None,
+            'snippet_html': result['snippet'],
+        } for result in results],
+        'next_cursor': next_cursor,
+    })
+
+@login_required
+@require_POST
+def presence_heartbeat(request):
+    """Keep-alive sent by open pages; refreshes the user's online TTL"""
+    presence.heartbeat(request.user.id)
+    return HttpResponse(status=204)
+
+@login_required
+async def presence_status(request):
+    """Which of the given user ids (`?ids=1,2,3`) are online"""
+    user_ids = [parse_id(value) for value in request.GET.get('ids', '').split(',')]
+    user_ids = [user_id for user_id in user_ids if user_id][:settings.MESSENGER_PRESENCE_BATCH_LIMIT]
+    return JsonResponse({'online': sorted(await presence.aonline_user_ids(user_ids))})
+
+@login_required
+def export_messages(request):
+    """Stream the user's message history, contacts included, as a download
+    
+    `format` is ndjson (the default, what `manage.py import_messages` reads)
+    or csv, and `gzip=1` compresses it. `contact_id` or `conversation_id`
+    limits it to one conversation; staff may pass `user_id` to export
+    someone else's history.
+    """
+    export_format = request.GET.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'error': f"format must be one of {', '.join(EXPORT_FORMATS)}"}, status=400)
+    
+    user = request.user
+    if 'user_id' in request.GET:
+        if not request.user.is_staff:
+            return JsonResponse({'error': 'Only staff can export other users'}, status=403)
+        user = User.objects.filter(id=parse_id(request.GET['user_id'])).first()
+        if user is None:
+            return JsonResponse({'error': 'User not found'}, status=404)
+    
+    contacts_of = None
+    if 'conversation_id' in request.GET:
+        group = group_for_member(user, parse_id(request.GET['conversation_id']))
+        if group is None:
+            return JsonResponse({'error': 'Conversation not found'}, status=404)
+        keys = [group[0]]
+    elif 'contact_id' in request.GET:
+        contact_id = parse_id(request.GET['contact_id'])
+        if contact_id is None:
+            return JsonResponse({'error': 'Contact not found'}, status=404)
+        keys = [conversation_key(user.id, contact_id)]
+    else:
+        keys, contacts_of = user_conversation_keys(user.id), user
+    
+    compress = request.GET.get('gzip') == '1'
+    response = StreamingHttpResponse(
+        response_body(request, export_stream(export_rows(keys, contacts_of), export_format, compress)),
+        content_type='application/gzip' if compress else f'{EXPORT_FORMATS[export_format]}; charset=utf-8',
+    )
+    filename = f"messages-{user.username}.{export_format}{'.gz' if compress else ''}"
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    response['Cache-Control'] = 'private, no-store'
+    return response
+
+@staff_member_required
+def performance_stats(request):
+    """Rolling per-view latency histograms collected by app.perf.PerformanceMiddleware"""
+    return JsonResponse({
+        'enabled': settings.MESSENGER_PERF_INSTRUMENTATION,
+        'views': perf.view_stats(),
+        'recent_messages': get_recent_messages().stats(),
+    })
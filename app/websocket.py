@@ -0,0 +1,132 @@
+"""
+Raw ASGI WebSocket endpoint mounted by web_messenger.asgi.
+
+A connected client receives every event published to its user id through
+app.pubsub. Authentication reuses the Django session cookie.
+
+Clients send one kind of frame, a delivery receipt:
+{"type": "ack", "contact_id" or "conversation_id": ..., "message_id": ...}.
+Receipts are coalesced per conversation for MESSENGER_DELIVERY_ACK_WINDOW
+seconds, so a burst of messages costs one watermark bump.
+"""
+
+import asyncio
+import json
+from http.cookies import SimpleCookie
+from importlib import import_module
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import aget_user
+
+from .pubsub import get_broker
+from .views import acknowledge_delivery, parse_id
+
+WEBSOCKET_PATH = '/ws/'
+
+# Application-defined close codes (4000-4999)
+CLOSE_NOT_FOUND = 4404
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_FORBIDDEN = 4403
+
+
+def _headers(scope):
+    return {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope.get('headers', [])}
+
+
+def _same_origin(headers):
+    """Reject cross-site socket hijacking: Origin, when sent, must match Host"""
+    origin = headers.get('origin')
+    if not origin:
+        return True
+    return urlsplit(origin).netloc == headers.get('host')
+
+
+async def _get_user(headers):
+    cookies = SimpleCookie()
+    cookies.load(headers.get('cookie', ''))
+    morsel = cookies.get(settings.SESSION_COOKIE_NAME)
+    engine = import_module(settings.SESSION_ENGINE)
+    session = engine.SessionStore(morsel.value if morsel else None)
+    return await aget_user(SimpleNamespace(session=session))
+
+
+def _parse_ack(text):
+    """((target field, id), message_id) of an ack frame, or None for anything else"""
+    try:
+        frame = json.loads(text or '')
+    except ValueError:
+        return None
+    if not isinstance(frame, dict) or frame.get('type') != 'ack':
+        return None
+    message_id = parse_id(frame.get('message_id'))
+    field = 'conversation_id' if 'conversation_id' in frame else 'contact_id'
+    target_id = parse_id(frame.get(field))
+    if not message_id or not target_id:
+        return None
+    return (field, target_id), message_id
+
+
+def _apply_acks(user, acks):
+    for (field, target_id), message_id in acks.items():
+        acknowledge_delivery(user, message_id, **{field: target_id})
+
+
+async def websocket_application(scope, receive, send):
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+
+    headers = _headers(scope)
+    if scope['path'] != WEBSOCKET_PATH:
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+        return
+    if not _same_origin(headers):
+        await send({'type': 'websocket.close', 'code': CLOSE_FORBIDDEN})
+        return
+
+    user = await _get_user(headers)
+    if not user.is_authenticated:
+        await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+        return
+
+    broker = get_broker()
+    subscription = broker.subscribe(user.id)
+    await send({'type': 'websocket.accept'})
+
+    receive_task = asyncio.ensure_future(receive())
+    publish_task = asyncio.ensure_future(subscription.get())
+    # Highest acknowledged id per conversation, written when flush_task fires
+    pending_acks = {}
+    flush_task = None
+    try:
+        while True:
+            waiting = {receive_task, publish_task} | ({flush_task} if flush_task else set())
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            if receive_task in done:
+                event = receive_task.result()
+                if event['type'] == 'websocket.disconnect':
+                    break
+                ack = _parse_ack(event.get('text'))
+                if ack:
+                    target, message_id = ack
+                    pending_acks[target] = max(pending_acks.get(target, 0), message_id)
+                    if flush_task is None:
+                        flush_task = asyncio.ensure_future(asyncio.sleep(settings.MESSENGER_DELIVERY_ACK_WINDOW))
+                receive_task = asyncio.ensure_future(receive())
+            if publish_task in done:
+                await send({'type': 'websocket.send', 'text': json.dumps(publish_task.result())})
+                publish_task = asyncio.ensure_future(subscription.get())
+            if flush_task in done:
+                acks, pending_acks, flush_task = pending_acks, {}, None
+                await sync_to_async(_apply_acks)(user, acks)
+    finally:
+        receive_task.cancel()
+        publish_task.cancel()
+        if flush_task:
+            flush_task.cancel()
+        broker.unsubscribe(subscription)
+        if pending_acks:
+            await sync_to_async(_apply_acks)(user, pending_acks)
@@ -10,3 +10,6 @@ python manage.py collectstatic --no-input
 
 # Run migrations
 python manage.py migrate
+
+# Fill the inbox table on the first deploy that has it (a no-op afterwards)
+python manage.py rebuild_conversation_summaries --if-empty
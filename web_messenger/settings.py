@@ -48,12 +48,19 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so it sees the whole request; inert unless MESSENGER_PERF_INSTRUMENTATION is on
+    'app.perf.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    # WhiteNoise, async-capable so it doesn't push ASGI requests onto threads
+    'app.staticfiles.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # Loads request.user and its profile in one cached query (app/sessions.py)
+    'app.sessions.SessionUserMiddleware',
+    # Inert unless MESSENGER_REPLICA_DATABASES is set
+    'app.routers.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -62,7 +69,8 @@ ROOT_URLCONF = 'web_messenger.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Stock Django backend that also reports render time to app.perf
+        'BACKEND': 'app.perf.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -86,7 +94,7 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    },
 }
 
 
@@ -147,8 +155,112 @@ LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'chat'
 LOGOUT_REDIRECT_URL = 'home'
 
+# Cache versions, ETags and cached responses (app/caching.py) need a cache that
+# every process shares: set REDIS_URL in the environment to use Redis. The
+# default per-process LocMemCache only suits a single process, so production
+# refuses it (system check app.E001) unless this is turned off.
+MESSENGER_REQUIRE_SHARED_CACHE = False  # True in production; MESSENGER_REQUIRE_SHARED_CACHE=0 to override
+
+# Messages per history page in the chat view and the messages API
+MESSENGER_PAGE_SIZE = 50
+# Serialized /api/messages/ responses, keyed by conversation version
+MESSENGER_MESSAGES_CACHE_TTL = 300  # seconds
+
+# Write-through cache of each busy conversation's newest page (see app/caching.py).
+# LocalRecentMessages is a per-process LRU bounded by MAX_BYTES of message text;
+# app.caching.DjangoCacheRecentMessages shares entries through CACHES instead.
+MESSENGER_RECENT_MESSAGES_CACHE = 'app.caching.LocalRecentMessages'
+MESSENGER_RECENT_MESSAGES_MAX_BYTES = 16 * 1024 * 1024
+MESSENGER_RECENT_MESSAGES_TTL = 300  # seconds, bounds how long a renamed sender's old nickname can show
+
+# Rendered chat sidebar fragments, keyed by the user's inbox version (see app/caching.py)
+MESSENGER_SIDEBAR_CACHE_TTL = 300  # seconds, bounds how long a peer's renamed nickname or new avatar can show
+
+# Add-contact typeahead: max results, and the in-process prefix cache (0 entries disables it)
+MESSENGER_USER_SEARCH_LIMIT = 10
+MESSENGER_USER_SEARCH_CACHE_SIZE = 256
+MESSENGER_USER_SEARCH_CACHE_TTL = 30  # seconds
+
+# Full-text message search results per page
+MESSENGER_MESSAGE_SEARCH_PAGE_SIZE = 20
+
+# Presence: a user is online while heartbeats keep arriving within the TTL;
+# last_seen is written to the database in bulk at most once per flush interval
+MESSENGER_PRESENCE_TTL = 60  # seconds
+MESSENGER_PRESENCE_FLUSH_INTERVAL = 30  # seconds
+MESSENGER_PRESENCE_BATCH_LIMIT = 200
+
+# Real-time delivery: pub/sub broker behind the /ws/ endpoint (see app/pubsub.py).
+# The in-process broker only reaches sockets held by the same ASGI worker, so
+# production refuses it (app.E003); RedisBroker, used wherever REDIS_URL is set,
+# reaches every worker through the Redis server at BROKER_URL.
+MESSENGER_BROKER = 'app.pubsub.InProcessBroker'
+MESSENGER_BROKER_URL = None
+# Delivery receipts sent over /ws/ are coalesced per conversation for this long
+# before the delivered watermark is written (HTTP clients debounce their own)
+MESSENGER_DELIVERY_ACK_WINDOW = 0.5  # seconds
+
+# Database routing (app/routers.py). Aliases listed here must also be in DATABASES.
+# Replicas serve history and inbox reads of GET requests; after any write the
+# user reads from the primary for STICKY_SECONDS. For local testing a replica
+# can point at the same SQLite file as default (with 'TEST': {'MIRROR': 'default'}).
+# Shards hold Message and ConversationRead rows by conversation key. Set
+# MESSENGER_MESSAGE_SHARD_URLS in the environment to a space-separated list of
+# database URLs: they become messages_1, messages_2, ... and are sharded across
+# together with default. Migrate each alias with
+# `manage.py migrate --database=<alias>`. Changing the shard list remaps
+# conversations, and existing rows are not moved.
+DATABASE_ROUTERS = ['app.routers.MessengerRouter']
+MESSENGER_REPLICA_DATABASES = []
+MESSENGER_REPLICA_STICKY_SECONDS = 5
+MESSENGER_MESSAGE_SHARDS = []
+
+# Sessions: 'cached_db' reads sessions from CACHES and writes through to the
+# database; 'signed_cookies' keeps them in the cookie with no server-side
+# storage, at the cost of not being able to revoke one; 'db' is Django's stock
+# engine. cached_db needs a cache every process shares, or a logout in one
+# process goes unnoticed by another's copy: it is the default for the single
+# runserver process and wherever REDIS_URL is set, and production without a
+# shared cache falls back to 'db'.
+MESSENGER_SESSION_PROFILE = 'cached_db'  # or MESSENGER_SESSION_PROFILE in the environment
+# How long request.user and its profile are cached between saves. Saves drop
+# the cached copy (app.sessions), which other processes only see through a
+# shared cache; the production check for one is app.E001 (app/checks.py)
+MESSENGER_SESSION_USER_TTL = 300  # seconds
+
+# Background jobs (app/tasks.py): inbox rows, unread counters and contact upserts
+# of a send. EAGER runs them inline in the request, for development and tests;
+# production turns it off and runs `manage.py run_worker` (one or more
+# processes, the worker service in render.yaml) to take them off the request.
+# A claimed batch is leased to its worker for LEASE seconds.
+MESSENGER_TASKS_EAGER = True  # False in production; MESSENGER_TASKS_EAGER=0/1 in the environment
+MESSENGER_TASKS_BATCH_SIZE = 100
+MESSENGER_TASKS_MAX_ATTEMPTS = 5
+MESSENGER_TASKS_LEASE = 60  # seconds
+MESSENGER_TASKS_POLL_INTERVAL = 1  # seconds the worker sleeps when the queue is empty
+
+# File attachments (app/attachments.py): uploads stream to a temporary file while
+# being hashed, and each distinct content is stored once under MEDIA_ROOT/attachments.
+# Downloads are checked against conversation membership, so MEDIA_ROOT must not be
+# served publicly. OFFLOAD hands the transfer (Range requests included) to the web
+# server after that check: 'x-accel-redirect' for nginx, with an `internal` location
+# at ACCEL_PREFIX aliasing MEDIA_ROOT, or 'x-sendfile' for Apache/lighttpd.
+MESSENGER_ATTACHMENT_MAX_SIZE = 25 * 1024 * 1024  # bytes
+MESSENGER_ATTACHMENT_OFFLOAD = None
+MESSENGER_ATTACHMENT_ACCEL_PREFIX = '/protected-media/'
+# Longest side of image thumbnails, made by a background job; needs Pillow
+MESSENGER_THUMBNAIL_SIZE = 320  # pixels
+
+# Per-request instrumentation (app/perf.py): Server-Timing headers, rolling
+# per-view histograms at /api/perf/ (staff only), and a warning log for any
+# query shape repeated at least DUPLICATE_THRESHOLD times in one request
+MESSENGER_PERF_INSTRUMENTATION = False  # or MESSENGER_PERF_INSTRUMENTATION=1 in the environment
+MESSENGER_PERF_WINDOW = 1000  # requests kept per view
+MESSENGER_PERF_DUPLICATE_THRESHOLD = 5
+
 # Production settings preparation
 import os
+import sys
 
 # Use environment variables for production settings
 if 'DATABASE_URL' in os.environ:
@@ -161,6 +273,9 @@ if (os.environ.get('DJANGO_ENV') == 'production' or
     'DATABASE_URL' in os.environ):
     DEBUG = False
     print("🚀 PRODUCTION MODE DETECTED")
+    MESSENGER_REQUIRE_SHARED_CACHE = True
+    # Jobs go to the run_worker service rather than the request
+    MESSENGER_TASKS_EAGER = False
     
     # Security settings for production
     SECURE_BROWSER_XSS_FILTER = True
@@ -172,6 +287,63 @@ if (os.environ.get('DJANGO_ENV') == 'production' or
     
     # Static files compression
     STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+    
+    # Parse each template once per process. Django already does this when no
+    # loaders are given; spelled out so a later 'loaders' edit keeps it
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+
+if 'REDIS_URL' in os.environ:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        },
+    }
+    MESSENGER_BROKER = 'app.pubsub.RedisBroker'
+    MESSENGER_BROKER_URL = os.environ['REDIS_URL']
+
+if os.environ.get('MESSENGER_REQUIRE_SHARED_CACHE') == '0':
+    MESSENGER_REQUIRE_SHARED_CACHE = False
+
+if MESSENGER_REQUIRE_SHARED_CACHE and 'REDIS_URL' not in os.environ:
+    # A production deploy without a shared cache (refused by app.E001, but
+    # gunicorn skips system checks): sessions must not live in a per-process cache
+    MESSENGER_SESSION_PROFILE = 'db'
+
+# Message shards besides default (see MESSENGER_MESSAGE_SHARDS above)
+if os.environ.get('MESSENGER_MESSAGE_SHARD_URLS'):
+    import dj_database_url
+    MESSENGER_MESSAGE_SHARDS = ['default']
+    for number, url in enumerate(os.environ['MESSENGER_MESSAGE_SHARD_URLS'].split(), 1):
+        DATABASES[f'messages_{number}'] = dj_database_url.parse(url)
+        MESSENGER_MESSAGE_SHARDS.append(f'messages_{number}')
+elif sys.argv[1:2] == ['test']:
+    # A second database for app.tests.ShardedMessageTests, which lists it in
+    # MESSENGER_MESSAGE_SHARDS itself; the test runner keeps it in memory
+    DATABASES['messages_1'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'messages_1.sqlite3'}
 
 # Use environment variable for secret key
 SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY', SECRET_KEY)
+
+# Attachments on a persistent disk (render.yaml mounts one on the web service)
+MEDIA_ROOT = os.environ.get('MEDIA_ROOT', MEDIA_ROOT)
+
+# Opt into request instrumentation without a settings change
+if os.environ.get('MESSENGER_PERF_INSTRUMENTATION') == '1':
+    MESSENGER_PERF_INSTRUMENTATION = True
+
+if os.environ.get('MESSENGER_TASKS_EAGER') in ('0', '1'):
+    MESSENGER_TASKS_EAGER = os.environ['MESSENGER_TASKS_EAGER'] == '1'
+
+MESSENGER_SESSION_PROFILE = os.environ.get('MESSENGER_SESSION_PROFILE', MESSENGER_SESSION_PROFILE)
+SESSION_ENGINE = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}[MESSENGER_SESSION_PROFILE]